@@ -0,0 +1,146 @@
+from __future__ import annotations
+from typing import AsyncIterator, Optional, Any
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import math
+import time
+
+from constants import USER_RATE_LIMIT, COMMAND_CLASS_RATE_LIMITS, MAX_CONCURRENT_COMMANDS, SHED_READ_ONLY_AT
+from commandDecorators import isReadOnly
+from metrics import admissionRejections
+import tenant as tenantModule
+
+
+"""
+Admission control of commands in the gateway, before they reach the database or Discord.
+
+Every user has a token bucket for all their commands and one for each command class (read only and writing commands).
+A command is admitted only if it can take a token from both. On top of that at most MAX_CONCURRENT_COMMANDS commands
+run at once. Once SHED_READ_ONLY_AT are running, read only commands are turned away with a polite reply, while writing
+ones wait for a free slot. Admins of the tenant are never limited.
+"""
+
+# number of buckets after which the idle (full) ones are dropped
+PRUNE_BUCKETS_OVER = 10000
+
+
+class TokenBucket:
+    """
+    Allows [rate] events per second on average and bursts of up to [burst] events.
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updatedAt = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updatedAt) * self.rate)
+        self.updatedAt = now
+
+    def canTake(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def retryAfter(self) -> float:
+        """
+        returns seconds until a token is available (after refill)
+        """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def isFull(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+def commandClass(commandName: str) -> str:
+    return "read" if isReadOnly(commandName) else "write"
+
+
+class AdmissionControl:
+    def __init__(self, userLimit: tuple[float, float] = USER_RATE_LIMIT, classLimits: dict[str, tuple[float, float]] = COMMAND_CLASS_RATE_LIMITS, maxConcurrent: int = MAX_CONCURRENT_COMMANDS, shedReadOnlyAt: int = SHED_READ_ONLY_AT):
+        self.userLimit = userLimit
+        self.classLimits = classLimits
+        self.maxConcurrent = maxConcurrent
+        self.shedReadOnlyAt = shedReadOnlyAt
+        # buckets by (user id, command class), class None is the bucket of all commands of the user
+        self.buckets: dict[tuple[int, Optional[str]], TokenBucket] = {}
+        self.running = 0
+        self.slots: Optional[asyncio.Semaphore] = None
+
+    def getBucket(self, userId: int, cls: Optional[str]) -> TokenBucket:
+        bucket = self.buckets.get((userId, cls))
+        if bucket == None:
+            if len(self.buckets) > PRUNE_BUCKETS_OVER:
+                self.prune()
+            bucket = TokenBucket(*(self.userLimit if cls == None else self.classLimits[cls]))
+            self.buckets[(userId, cls)] = bucket
+        return bucket
+
+    def prune(self) -> None:
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            if bucket.isFull(now):
+                del self.buckets[key]
+
+    def checkRate(self, userId: int, cls: str) -> Optional[float]:
+        """
+        takes a token for the user's command of given class, returns None if it was admitted or seconds to wait otherwise
+        """
+        now = time.monotonic()
+        buckets = [self.getBucket(userId, None)]
+        if cls in self.classLimits:
+            buckets.append(self.getBucket(userId, cls))
+
+        # tokens are taken only if all buckets allow it, so a rejected command doesn't drain the others
+        empty = [bucket for bucket in buckets if not bucket.canTake(now)]
+        if len(empty) > 0:
+            return max(bucket.retryAfter() for bucket in empty)
+        for bucket in buckets:
+            bucket.take()
+        return None
+
+    @asynccontextmanager
+    async def admit(self, tenant: tenantModule.Tenant, userId: Optional[int], commandName: str, reply: Any = None) -> AsyncIterator[bool]:
+        """
+        Admits a command for the duration of the with block. Yields False (after replying why) if the command was turned away.
+        """
+        if userId == None or tenant.isAdmin(userId):
+            yield True
+            return
+
+        cls = commandClass(commandName.lower())
+        wait = self.checkRate(userId, cls)
+        if wait != None:
+            admissionRejections.inc(reason="rateLimited", commandClass=cls)
+            logging.info(f"rate limited {cls} command {commandName} of user {userId}")
+            if reply != None:
+                await reply(f"You are sending commands too fast, please try again in {math.ceil(wait)} s.")
+            yield False
+            return
+
+        if cls == "read" and self.running >= self.shedReadOnlyAt:
+            admissionRejections.inc(reason="shed", commandClass=cls)
+            logging.info(f"shed command {commandName} of user {userId}, {self.running} commands running")
+            if reply != None:
+                await reply("I'm quite busy right now, please try again in a moment.")
+            yield False
+            return
+
+        if self.slots == None:
+            # created lazily, so it belongs to the running event loop
+            self.slots = asyncio.Semaphore(self.maxConcurrent)
+        async with self.slots:
+            self.running += 1
+            try:
+                yield True
+            finally:
+                self.running -= 1
+
+
+# admission control of this (gateway) process
+admission = AdmissionControl()
@@ -0,0 +1,206 @@
+from __future__ import annotations
+from typing import Optional
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+from constants import HIGHROLLER_LOG_FILE, LOG_MAX_BYTES, LOG_MAX_AGE_SECONDS, LOG_BACKUP_COUNT, LOG_FLUSH_INTERVAL_SECONDS, LOG_FLUSH_BYTES
+
+
+"""
+Logging which never touches the disk on the event loop.
+
+Log records are put into a queue and written by a background thread. Writes are batched and flushed once
+LOG_FLUSH_BYTES are buffered or LOG_FLUSH_INTERVAL_SECONDS pass. Files are rotated once they grow over LOG_MAX_BYTES
+or get older than LOG_MAX_AGE_SECONDS, rotated files are compressed with gzip and only LOG_BACKUP_COUNT newest are kept.
+"""
+
+
+class RotatingBatchFileHandler(logging.Handler):
+    """
+    Writes records into a file without flushing after each of them. Should only be used by LogWriter.
+    """
+    def __init__(self, path: str, maxBytes: int = LOG_MAX_BYTES, maxAgeSeconds: int = LOG_MAX_AGE_SECONDS, backupCount: int = LOG_BACKUP_COUNT):
+        super().__init__()
+        self.path = path
+        self.maxBytes = maxBytes
+        self.maxAgeSeconds = maxAgeSeconds
+        self.backupCount = backupCount
+        self.pendingBytes = 0
+        self._open()
+
+    def _open(self) -> None:
+        self.stream = open(self.path, "a", encoding="utf-8")
+        # file systems don't reliably keep creation time, so a file continued after restart ages from the restart
+        self.openedAt = time.time()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            line = self.format(record) + "\n"
+            self.stream.write(line)
+            self.pendingBytes += len(line)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        self.stream.flush()
+        self.pendingBytes = 0
+
+    def shouldRollover(self) -> bool:
+        return self.stream.tell() >= self.maxBytes or (self.stream.tell() > 0 and time.time() - self.openedAt >= self.maxAgeSeconds)
+
+    def doRollover(self) -> None:
+        """
+        Moves the current file aside as a compressed backup and starts a new one.
+        """
+        self.stream.close()
+        rotatedPath = f"{self.path}.{time.strftime('%Y-%m-%d-%H-%M-%S')}"
+        suffix = 0
+        while os.path.exists(rotatedPath + ".gz"):
+            suffix += 1
+            rotatedPath = f"{self.path}.{time.strftime('%Y-%m-%d-%H-%M-%S')}-{suffix}"
+        os.replace(self.path, rotatedPath)
+        with open(rotatedPath, "rb") as source, gzip.open(rotatedPath + ".gz", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.remove(rotatedPath)
+        self.rotated(rotatedPath + ".gz")
+
+        for backup in self.getBackups()[:-self.backupCount or None]:
+            self.removeBackup(backup)
+        self._open()
+
+    def rotated(self, backupPath: str) -> None:
+        """
+        Called after the file has been rotated into backupPath.
+        """
+        pass
+
+    def removeBackup(self, backupPath: str) -> None:
+        os.remove(backupPath)
+
+    def getBackups(self) -> list[str]:
+        """
+        returns paths of all compressed backups, oldest first
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + "."
+        backups = [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(prefix) and name.endswith(".gz")]
+        return sorted(backups, key=os.path.getmtime)
+
+    def close(self) -> None:
+        self.stream.close()
+        super().close()
+
+
+class QueueingHandler(logging.handlers.QueueHandler):
+    """
+    Puts records meant for target into LogWriter's queue.
+    """
+    def __init__(self, writer: LogWriter, target: RotatingBatchFileHandler):
+        super().__init__(writer.queue) # type: ignore
+        self.target = target
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.queue.put_nowait((self.target, record))
+
+
+class LogWriter(threading.Thread):
+    """
+    Background thread writing queued records into their files.
+    """
+    def __init__(self, flushInterval: float = LOG_FLUSH_INTERVAL_SECONDS, flushBytes: int = LOG_FLUSH_BYTES):
+        super().__init__(name="LogWriter", daemon=True)
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.flushInterval = flushInterval
+        self.flushBytes = flushBytes
+        self.targets: set[RotatingBatchFileHandler] = set()
+
+    def run(self) -> None:
+        lastFlush = time.monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, lastFlush + self.flushInterval - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, threading.Event):
+                # somebody waits until everything is on disk
+                self.flushTargets()
+                lastFlush = time.monotonic()
+                item.set()
+                continue
+
+            if item != None:
+                target, record = item
+                self.targets.add(target)
+                target.handle(record)
+                if target.pendingBytes >= self.flushBytes:
+                    target.flush()
+                    self.rolloverIfNeeded(target)
+
+            if time.monotonic() - lastFlush >= self.flushInterval:
+                self.flushTargets()
+                lastFlush = time.monotonic()
+
+    def flushTargets(self) -> None:
+        for target in self.targets:
+            if target.pendingBytes > 0:
+                target.flush()
+            self.rolloverIfNeeded(target)
+
+    def rolloverIfNeeded(self, target: RotatingBatchFileHandler) -> None:
+        try:
+            if target.shouldRollover():
+                target.doRollover()
+        except Exception as e:
+            # can't log this, as we are the logging
+            print(f"Error rotating log {target.path}: {e}", file=sys.stderr)
+
+    def flushNow(self, timeout: float = 5) -> None:
+        """
+        Blocks until all records queued so far are written and flushed.
+        """
+        event = threading.Event()
+        self.queue.put_nowait(event)
+        event.wait(timeout)
+
+
+_writer: Optional[LogWriter] = None
+
+def setup(logFile: str = HIGHROLLER_LOG_FILE) -> None:
+    """
+    Starts the background writer and sends root logger into logFile through it.
+    """
+    global _writer
+    _writer = LogWriter()
+    _writer.start()
+
+    mainTarget = RotatingBatchFileHandler(logFile)
+    mainTarget.setFormatter(logging.Formatter('%(levelname)s:%(asctime)s:%(message)s', datefmt='%Y-%m-%d-%H-%M-%S'))
+    attach(logging.getLogger(), mainTarget)
+
+    # the writer is a daemon thread, don't lose what it still buffers
+    atexit.register(flushAll)
+
+def attach(logger: logging.Logger, target: RotatingBatchFileHandler) -> None:
+    """
+    Sends records of logger into target through the background writer. setup has to be called first.
+    """
+    if _writer == None:
+        raise ValueError("asyncLogging.setup has to be called first")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(QueueingHandler(_writer, target))
+
+def flushAll() -> None:
+    """
+    Blocks until everything logged so far is on disk. Does nothing if setup wasn't called in this process.
+    """
+    if _writer != None:
+        _writer.flushNow()
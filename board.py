@@ -0,0 +1,178 @@
+from __future__ import annotations
+from typing import Optional, Any, cast
+import asyncio
+import logging
+
+import discord
+
+from constants import BOARD_PAGES, BOARD_CHALLENGES_PER_PAGE, BOARD_EDIT_DEBOUNCE_SECONDS
+from db import Database
+from metrics import discordApiSeconds
+from admission import admission
+
+import challenge as challengeModule
+import player as playerModule
+import tenant as tenantModule
+
+
+class AcceptView(discord.ui.View):
+    """
+    Select under a board page which lets players accept one of the challenges listed on it.
+    """
+    def __init__(self, board: ChallengeBoard, page: int, challenges: list[challengeModule.Challenge]):
+        super().__init__(timeout=None)
+        self.board = board
+
+        if len(challenges) == 0:
+            return
+
+        select: discord.ui.Select = discord.ui.Select(
+            custom_id=f"highroller-board-accept-{page}",
+            placeholder="Accept a challenge",
+            options=[discord.SelectOption(label=f"{challenge.id}", description=f"bet {challenge.bet}, {challenge.map}, {challenge.tribe}", value=str(challenge.id)) for challenge in challenges]
+        )
+        select.callback = lambda interaction: self.accept(interaction, int(select.values[0]))
+        self.add_item(select)
+
+    async def accept(self, interaction: discord.Interaction, challengeId: int) -> None:
+        # accepting sends DMs, which can take longer than discord waits for an answer
+        await interaction.response.defer(ephemeral=True)
+
+        async def reply(message: str) -> None:
+            await interaction.followup.send(message, ephemeral=True)
+
+        tenant = tenantModule.getByGuildId(interaction.guild_id)
+        if tenant == None:
+            await reply("This guild isn't served by the bot!")
+            return
+        tenant = cast(tenantModule.Tenant, tenant)
+
+        with tenantModule.activate(tenant):
+            async with admission.admit(tenant, interaction.user.id if interaction.user != None else None, "accept", reply) as admitted:
+                if admitted and await tenant.commandEvaluator.runCommand("accept", {"challenge": challengeId}, interaction.user, reply=reply, source="board"):
+                    await reply("OK")
+
+
+class ChallengeBoard:
+    """
+    A few pinned messages in challenges list channel listing all open challenges.
+
+    The messages are edited in place. Changes are debounced, so a burst of changes results in one edit per page per window.
+
+    Should be created with create factory method.
+    """
+    channel: discord.TextChannel
+    bot: discord.Bot
+    messenger: Any
+    db: Database
+    # tenant the board belongs to, its page ids are written through the tenant's workers
+    tenant: Optional[tenantModule.Tenant]
+
+    # ids of messages of individual pages
+    pages: list[Optional[int]]
+
+    # text last rendered on each page, so unchanged pages aren't edited
+    renderedPages: list[Optional[str]]
+
+    pendingUpdate: Optional[asyncio.Task]
+
+    @staticmethod
+    async def create(channel: discord.TextChannel, bot: discord.Bot, messenger: Any, db: Database) -> ChallengeBoard:
+        """
+        Creates the board for open challenges of given messenger, reusing page messages from before restart if there are any.
+        """
+        board = ChallengeBoard()
+        board.channel = channel
+        board.bot = bot
+        board.messenger = messenger
+        board.db = db
+        board.tenant = tenantModule.getCurrent()
+        board.pages = [db.getMetaValue(f"boardPage{i}") for i in range(BOARD_PAGES)]
+        board.renderedPages = [None] * BOARD_PAGES
+        board.pendingUpdate = None
+        return board
+
+    def scheduleUpdate(self) -> None:
+        """
+        Makes sure the board is updated at the end of current debounce window.
+        """
+        if self.pendingUpdate == None:
+            self.pendingUpdate = asyncio.create_task(self._updateLater())
+
+    async def _updateLater(self) -> None:
+        await asyncio.sleep(BOARD_EDIT_DEBOUNCE_SECONDS)
+        # changes done while we are editing will need another update
+        self.pendingUpdate = None
+        try:
+            await self.update()
+        except Exception as e:
+            logging.error("Error updating challenge board")
+            logging.error(str(e))
+
+    async def update(self) -> None:
+        """
+        Renders all open challenges and edits pages which have changed.
+        """
+        challenges = sorted(self.messenger.openChallenges.values(), key=lambda challenge: (challenge.timeout or 0, challenge.id))
+
+        for page in range(BOARD_PAGES):
+            pageChallenges = challenges[page*BOARD_CHALLENGES_PER_PAGE: (page+1)*BOARD_CHALLENGES_PER_PAGE]
+            hidden = len(challenges) - (page+1)*BOARD_CHALLENGES_PER_PAGE if page == BOARD_PAGES - 1 else 0
+            text = self._renderPage(page, pageChallenges, hidden)
+
+            if text == self.renderedPages[page]:
+                continue
+
+            # pages are only created once there is something to put on them
+            if len(pageChallenges) == 0 and page > 0 and self.pages[page] == None:
+                continue
+
+            await self._editPage(page, text, AcceptView(self, page, pageChallenges))
+            self.renderedPages[page] = text
+
+    def _renderPage(self, page: int, challenges: list[challengeModule.Challenge], hidden: int) -> str:
+        if page == 0:
+            text = "## ⚔️ Open challenges ⚔️\n"
+        else:
+            text = ""
+
+        if len(challenges) == 0:
+            text += "No open challenges. Create one using the /create_challenge command!" if page == 0 else "-"
+        else:
+            text += "\n".join([
+                f"**{challenge.id}** {cast(playerModule.Player, playerModule.Player.getById(challenge.authorId)).getName()} - bet: {challenge.bet}, map: {challenge.map}, tribe: {challenge.tribe}, timeouts <t:{challenge.timeout}:R>"
+                for challenge in challenges
+            ])
+
+        if hidden > 0:
+            text += f"\n\n... and {hidden} more. DM me \"list open\" to see all of them."
+        return text
+
+    async def _editPage(self, page: int, text: str, view: AcceptView) -> None:
+        messageId = self.pages[page]
+        if messageId != None:
+            try:
+                with discordApiSeconds.time(call="edit_message"):
+                    await self.channel.get_partial_message(cast(int, messageId)).edit(content=text, view=view)
+                self.bot.add_view(view, message_id=messageId)
+                return
+            except discord.errors.NotFound:
+                logging.warning(f"board page {page} was deleted, creating it again")
+
+        with discordApiSeconds.time(call="send_message"):
+            message = await self.channel.send(text, view=view)
+        with discordApiSeconds.time(call="pin_message"):
+            await message.pin()
+        self.pages[page] = message.id
+        await self._savePage(page)
+
+    async def _savePage(self, page: int) -> None:
+        """
+        Remembers id of the page's message in the database, so it's reused after restart.
+        """
+        workers = getattr(self.bot, "workers", None)
+        if workers != None and self.tenant != None:
+            # database is only written by the writer worker
+            await workers.setMetaValue(cast(tenantModule.Tenant, self.tenant), f"boardPage{page}", self.pages[page])
+        else:
+            self.db.setMetaValue(f"boardPage{page}", self.pages[page])
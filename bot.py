@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-from typing import cast, Optional
+from typing import cast, Optional, Any
 
 from enum import Enum
+import asyncio
 import os
 import discord
 from discord.ext import tasks
@@ -12,43 +13,138 @@ import time
 import datetime
 
 import logging
-from db import Database
-from constants import ChallengeState, HELPMESSAGE, MAP_OPTIONS, TRIBE_OPTIONS, GUILD_ID, ACCEPT_EMOJI, ABORT_EMOJI, CHALLENGES_LIST_CHANNEL, SPAM_CHANNEL
+from constants import ChallengeState, HELPMESSAGE, MAP_OPTIONS, TRIBE_OPTIONS, ACCEPT_EMOJI, ABORT_EMOJI, SNAPSHOT_INTERVAL_MINUTES, WORKER_PROCESSES, METRICS_HOST, METRICS_PORT, MEMBER_CACHE_REFRESH_MINUTES
+from warmState import WarmState
+from workers import WorkerPool
+import metrics
+import asyncLogging
+import commandLog
+import tracing
+from admission import admission
+from dedup import events
 
 # a bit of hacking to allow circular import
 import challenge as challengeModule
 import player as playerModule
 import messenger as messengerModule
+import tenant as tenantModule
 import myTypes
+import commandEvaluator
+from commandDecorators import slashOptions
+from playerIndex import PlayerIndex
+from memberCache import MemberCache
+import slashAutocomplete
+import ratings
+import mapStats
 
 
-logging.basicConfig(filename="highroller.log", encoding="utf-8", level=logging.INFO, format='%(levelname)s:%(asctime)s:%(message)s', datefmt='%Y-%m-%d-%H-%M-%S')
-
 load_dotenv()
 intents = discord.Intents.all()
 
-db = Database('db.db')
-
 TOKEN = os.getenv('TOKEN')
 
 
 
 class MyBot(myTypes.botWithGuild):
+    # pool running commands, None if they run in this process
+    workers: Optional[WorkerPool] = None
+
+    metricsServer: Optional[asyncio.AbstractServer] = None
+
     async def on_ready(self: MyBot) -> None:
         print(f'Logged on as {self.user}!', file=sys.stderr)
         print(f'guilds: {self.guilds}', file=sys.stderr)
-        self.guild: discord.Guild = cast(discord.Guild, self.get_guild(GUILD_ID))
 
         # set everything up
-        challengeModule.Challenge.setDb(db)
-        playerModule.Player.setDb(db)
         playerModule.Player.setBot(self)
-        self.messenger: messengerModule.Messenger = await messengerModule.Messenger.create(spamChannelId=SPAM_CHANNEL, messageChannelId=CHALLENGES_LIST_CHANNEL, bot=self)
-        import commandEvaluator
-        self.commandEvaluator = commandEvaluator.CommandEvaluator(self.messenger, self)
 
-        await self.messenger.loadAllChallengesAfterRestart()
-        self.check_timeouts.start()
+        for config in tenantModule.GuildConfig.loadAll():
+            # on_ready is fired again after every reconnect, tenants built before keep their database and queue
+            if tenantModule.getByGuildId(config.guildId) != None:
+                continue
+
+            guild = self.get_guild(config.guildId)
+            if guild == None:
+                logging.error(f"Can't find guild {config.guildId}, not serving it")
+                continue
+
+            tenant = tenantModule.Tenant.create(config, cast(discord.Guild, guild))
+            with tenantModule.activate(tenant):
+                playerIds = [player.id for player in playerModule.Player.getAll()]
+                tenant.members = MemberCache(tenant.guild)
+                await tenant.members.warm(playerIds)
+                tenant.players = PlayerIndex.build(playerIds, tenant.guild, playerModule.Player.knownNames)
+                tenant.teams = {playerId: team for playerId, team in tenant.db.getPlayerTeams()}
+                if len(tenant.db.getTopRatings(1)) == 0:
+                    # first start with ratings, rate the history so far
+                    ratings.recomputeAll(tenant.db)
+                if not tenant.db.hasMapTribeStats():
+                    mapStats.rebuild(tenant.db)
+                # roles may have changed while the bot was offline
+                await self.syncTeams(tenant, [member for member in [tenant.guild.get_member(playerId) for playerId in playerIds] if member != None])
+                tenant.messenger = await messengerModule.Messenger.create(spamChannelId=config.spamChannel, messageChannelId=config.challengesListChannel, bot=self)
+                tenant.commandEvaluator = commandEvaluator.CommandEvaluator(tenant.messenger, self, tenant.guild, tenant.players, tenant.members)
+
+                # rebuild the indexes from database only if there is no up to date snapshot
+                snapshot = WarmState.load(config.snapshotFile, tenant.db)
+                if snapshot != None:
+                    cast(WarmState, snapshot).restore(tenant.messenger)
+                else:
+                    await tenant.messenger.loadAllChallengesAfterRestart()
+                await tenant.messenger.loadActiveChallenges()
+                tenant.messenger.challengesChanged()
+            tenantModule.register(tenant)
+
+        # workers and loops started before a reconnect keep running, tenants added since are handed to the workers
+        if WORKER_PROCESSES > 0 and self.workers == None:
+            self.workers = WorkerPool.start(WORKER_PROCESSES, self)
+        elif self.workers != None:
+            cast(WorkerPool, self.workers).attach(tenantModule.getAll())
+
+        if self.metricsServer == None:
+            self.metricsServer = await metrics.serve(METRICS_HOST, METRICS_PORT)
+
+        for loop in (self.check_timeouts, self.save_snapshot, self.refresh_members):
+            if not loop.is_running():
+                loop.start()
+
+    async def close(self) -> None:
+        self.saveSnapshot()
+        if self.workers != None:
+            await cast(WorkerPool, self.workers).stop()
+        await super().close()
+        asyncLogging.flushAll()
+
+    def saveSnapshot(self) -> None:
+        for tenant in tenantModule.getAll():
+            with tenantModule.activate(tenant):
+                try:
+                    WarmState.capture(tenant.messenger, tenant.db).save(tenant.config.snapshotFile)
+                except Exception as e:
+                    logging.error(f"Error saving snapshot of guild {tenant.config.guildId}")
+                    logging.error(str(e))
+
+    async def routeToTenant(self, userId: int, message: str, reply: myTypes.replyFunction) -> tuple[Optional[tenantModule.Tenant], str]:
+        """
+        Finds tenant a command sent outside of any guild (in DMs) belongs to.
+
+        If the user is a member of more guilds, the command has to start with the guild's ID, which is stripped from the returned command.
+        """
+        tenants = tenantModule.getForUser(userId)
+        if len(tenants) == 1:
+            return tenants[0], message
+
+        if len(tenants) == 0:
+            await reply("You are not a member of any guild I serve!")
+            return None, message
+
+        firstWord, _, rest = message.strip().partition(" ")
+        for tenant in tenants:
+            if firstWord == str(tenant.config.guildId):
+                return tenant, rest
+
+        await reply("You are a member of more guilds I serve. Please start your command with ID of the guild it's meant for:\n" + "\n".join([f"{tenant.config.guildId} ({tenant.guild.name})" for tenant in tenants]))
+        return None, message
 
     async def on_message(self, message: discord.Message):
         # if it's not a DM, ignore it
@@ -61,13 +157,80 @@ class MyBot(myTypes.botWithGuild):
             return
         
         logging.info("recieved a DM!")
+        await events.once("message", message.id, lambda: self.handleDM(message))
+
+    async def handleDM(self, message: discord.Message) -> None:
+        tenant, command = await self.routeToTenant(message.author.id, message.content+" "+" ".join([message.url for message in message.attachments]), message.reply)
+        if tenant == None:
+            return
+        tenant = cast(tenantModule.Tenant, tenant)
 
         # handle recieving a DM
-        await self.commandEvaluator.parseCommand(message=message.content+" "+" ".join([message.url for message in message.attachments]), rawAuthor=message.author, reply=message.reply, source="DM")
+        with tenantModule.activate(tenant):
+            async with admission.admit(tenant, message.author.id, command.strip().lstrip("/").split(" ")[0], message.reply) as admitted:
+                if admitted:
+                    await tenant.commandEvaluator.parseCommand(message=command, rawAuthor=message.author, reply=message.reply, source="DM")
+
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        tenant = tenantModule.getByGuildId(after.guild.id)
+        if tenant != None:
+            await self.membersChanged(cast(tenantModule.Tenant, tenant), [after])
+
+    async def membersChanged(self, tenant: tenantModule.Tenant, members: list[discord.Member]) -> None:
+        """
+        Updates everything derived from names and roles of given members of tenant's guild.
+        """
+        for member in members:
+            tenant.players.updateMember(member.id, member.name, member.display_name)
+            if self.workers != None:
+                cast(WorkerPool, self.workers).memberChanged(tenant, member)
+        await self.syncTeams(tenant, members)
+
+    async def syncTeams(self, tenant: tenantModule.Tenant, members: list[discord.Member]) -> None:
+        """
+        Persists teams of given members (registered players only) whose team roles have changed, in one write.
+        """
+        changes = []
+        for member in members:
+            if member.id not in tenant.teams:
+                continue
+            team = playerModule.Player.teamOf(member, tenant.config.teamRoles)
+            if tenant.teams[member.id] != team:
+                changes.append((member.id, team))
+        if len(changes) == 0:
+            return
 
+        logging.info(f"{len(changes)} players of guild {tenant.config.guildId} changed teams")
+        for playerId, team in changes:
+            tenant.teams[playerId] = team
+        if self.workers != None:
+            # database is only written by the writer worker
+            await cast(WorkerPool, self.workers).setTeams(tenant, changes)
+        else:
+            tenant.db.setPlayerTeams(changes)
+
+    async def on_member_join(self, member: discord.Member):
+        await self.on_member_update(member, member)
 
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        if payload.message_id not in self.messenger.messages or payload.event_type != "REACTION_ADD":
+        # the same reaction (redelivered or double clicked) is handled only once
+        await events.once("reaction", self.reactionKey(payload), lambda: self.handleReaction(payload))
+
+    @staticmethod
+    def reactionKey(payload: discord.RawReactionActionEvent) -> tuple[int, int, str]:
+        return (payload.message_id, payload.user_id, str(payload.emoji))
+
+    async def handleReaction(self, payload: discord.RawReactionActionEvent) -> None:
+        tenant = tenantModule.getByGuildId(payload.guild_id)
+        if tenant == None:
+            logging.debug("reaction outside of served guilds!")
+            return
+        tenant = cast(tenantModule.Tenant, tenant)
+
+        # resolved from the in-memory index, so unknown messages never reach the database
+        challenge = tenant.messenger.getChallengeByMessageId(payload.message_id)
+        if challenge == None or payload.event_type != "REACTION_ADD":
             logging.debug("reaction to an unrecognized message!")
             return
         
@@ -76,7 +239,7 @@ class MyBot(myTypes.botWithGuild):
             return
         
         # reaction is valid
-        challenge = cast(challengeModule.Challenge, challengeModule.Challenge.getByMessageId(payload.message_id))
+        challenge = cast(challengeModule.Challenge, challenge)
 
         command = None
 
@@ -85,14 +248,22 @@ class MyBot(myTypes.botWithGuild):
 
         if str(payload.emoji) == ACCEPT_EMOJI:
             logging.info("accepted reaction")
-            command = f"accept {challenge.id}"
+            command = "accept"
 
         elif str(payload.emoji) == ABORT_EMOJI:
             logging.info("aborted reaction")
-            command = f"abort {challenge.id}"
+            command = "abort"
         
         # either command wasn't set or the command isn't working
-        if not (command != None and await self.commandEvaluator.parseCommand(cast(str,command), payload.member, source="reaction")):
+        with tenantModule.activate(tenant):
+            success = False
+            if command != None:
+                async with admission.admit(tenant, payload.user_id, cast(str, command)) as admitted:
+                    success = admitted and await tenant.commandEvaluator.runCommand(cast(str,command), {"challenge": challenge.id}, payload.member, source="reaction")
+
+        if not success:
+            # the reaction is taken back, so reacting again (e.g. after getting chips) has to be handled
+            events.forget("reaction", self.reactionKey(payload))
             message = self.get_message(payload.message_id)
 
             # remove the message
@@ -103,22 +274,59 @@ class MyBot(myTypes.botWithGuild):
         
     @tasks.loop(minutes=1)
     async def check_timeouts(self):
+        with metrics.timeoutCheckSeconds.time():
+            await self.checkTimeouts()
+
+    async def checkTimeouts(self) -> None:
         logging.info("checking for timeouts!")
-        for challenge in challengeModule.Challenge.getNewTimeouts():
-            try:
-                logging.info(f"challange {challenge.id} aborted due to timeout")
-                await self.commandEvaluator.parseCommand(f"forceabort {challenge.id}", bot.user, source="timeout")
-            except ValueError as e:
-                logging.warning("error aborting challange due to timeout")
-                logging.warning(e)
+        for tenant in tenantModule.getAll():
+            if self.workers != None:
+                # database is only written by the writer worker
+                await cast(WorkerPool, self.workers).checkTimeouts(tenant)
+                continue
+
+            with tenantModule.activate(tenant):
+                # all expired challenges are aborted and refunded in one transaction
+                challenges = challengeModule.Challenge.abortAllTimeouts()
+                if len(challenges) == 0:
+                    continue
+
+                logging.info(f"{len(challenges)} challanges of guild {tenant.config.guildId} aborted due to timeout")
+                try:
+                    await tenant.messenger.abortChallengesDueTimeout(challenges)
+                except Exception as e:
+                    logging.warning("error notifying about challanges aborted due to timeout")
+                    logging.warning(e)
+
+    @tasks.loop(minutes=SNAPSHOT_INTERVAL_MINUTES)
+    async def save_snapshot(self):
+        self.saveSnapshot()
+
+    @tasks.loop(minutes=MEMBER_CACHE_REFRESH_MINUTES)
+    async def refresh_members(self):
+        for tenant in tenantModule.getAll():
+            # refreshed members don't cause member update events
+            await self.membersChanged(tenant, await tenant.members.refreshStale())
 
 
 bot = MyBot(intents=intents)
 
-async def parseCommandForAndSendSomething(ctx: discord.ApplicationContext, command:str, rawAuthor: discord.User, reply: myTypes.replyFunction) -> None:
+async def runForAndSendSomething(ctx: discord.ApplicationContext, commandName: str, values: dict[str, Any], rawAuthor: discord.User, reply: myTypes.replyFunction) -> None:
+    """
+    runs a command with typed options of a slash command, they are validated by the same argument schema as text commands
+    """
     #await ctx.defer()
-    if await bot.commandEvaluator.parseCommand(command, rawAuthor=rawAuthor, reply=reply, source="slash command"):
-        await ctx.respond("OK", ephemeral=True)
+    tenant = tenantModule.getByGuildId(ctx.guild_id)
+    if tenant == None:
+        tenant, _ = await bot.routeToTenant(rawAuthor.id, commandName, reply)
+        if tenant == None:
+            return
+    tenant = cast(tenantModule.Tenant, tenant)
+
+    with tenantModule.activate(tenant):
+        async with admission.admit(tenant, rawAuthor.id, commandName, reply) as admitted:
+            if admitted and await tenant.commandEvaluator.runCommand(commandName, values, rawAuthor=rawAuthor, reply=reply, source="slash command"):
+                await ctx.respond("OK", ephemeral=True)
 
 
 """
@@ -126,43 +334,47 @@ SLASH COMMANDS
 """
 
 @bot.command(description="Create a new challenge for the Highroller tournament!")
-@discord.option("bet", int, min_value = 1)
-@discord.option("map", str, choices = MAP_OPTIONS)
-@discord.option("tribe", str, choices = TRIBE_OPTIONS)
-@discord.option("timeout", int, required = False, min_value = 1, default = 60*12, description="Number of minutes before this challange will automatically abort. (default is 12*60)")
-@discord.option("private", bool, required = False, default = False, description="if true, this challenge won't be listed. You can still use its ID to join it.")
+@slashOptions("create")
 async def create_challenge(ctx: discord.ApplicationContext, bet, map, tribe, timeout, private):
-    await parseCommandForAndSendSomething(ctx, f"create {bet} \"{map}\" \"{tribe}\" {timeout} {private}", rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
+    await runForAndSendSomething(ctx, "create", {"bet": bet, "map": map, "tribe": tribe, "timeout": timeout, "private": private}, rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
+
+@bot.command(description="Find open challenges you can accept!")
+@slashOptions("browse")
+async def browse_challenges(ctx: discord.ApplicationContext, map, tribe, minbet, maxbet, sort, count):
+    await runForAndSendSomething(ctx, "browse", {"map": map, "tribe": tribe, "minbet": minbet, "maxbet": maxbet, "sort": sort, "count": count}, rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
 
 @bot.command(description="Register yourself into our super cool tournament!")
 async def register(ctx: discord.ApplicationContext):
-    await parseCommandForAndSendSomething(ctx, "register", rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
+    await runForAndSendSomething(ctx, "register", {}, rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
     
 
 @bot.command(description="Checkout someone's current number of chips!")
-@discord.option("user", discord.User, description = "The player who you want to check out! (default is you)", required = False, default = None)
-async def userinfo(ctx: discord.ApplicationContext, user: discord.User):
-    await parseCommandForAndSendSomething(ctx, f"userinfo {user.id if user else ''}", rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
+@slashOptions("userinfo", player=slashAutocomplete.players)
+async def userinfo(ctx: discord.ApplicationContext, player: str):
+    await runForAndSendSomething(ctx, "userinfo", {"player": player}, rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
     
 
 @bot.command(description="Give someone chips so they can keep messing around!")
-@discord.option("user", discord.User, description = "The player who you want to check out! (default is you)", required = True)
-@discord.option("amount", int, description = "How many chips to give.", required = True)
-async def add_chips(ctx: discord.ApplicationContext, user: discord.User, amount: int):
-    await parseCommandForAndSendSomething(ctx, f"addchips {user.id} {amount}", rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
+@slashOptions("addchips", player=slashAutocomplete.players)
+async def add_chips(ctx: discord.ApplicationContext, player: str, chips: int):
+    await runForAndSendSomething(ctx, "addchips", {"player": player, "chips": chips}, rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
 
 @bot.command(description="List the top 10 players")
 async def leaderboards(ctx: discord.ApplicationContext):
-    await parseCommandForAndSendSomething(ctx, f"leaderboards", rawAuthor=ctx.author, reply=lambda a: ctx.channel.send(a))
+    await runForAndSendSomething(ctx, "leaderboards", {}, rawAuthor=ctx.author, reply=lambda a: ctx.channel.send(a))
+
+@bot.command(description="List the top 10 players by rating")
+async def ratings_leaderboard(ctx: discord.ApplicationContext):
+    await runForAndSendSomething(ctx, "ratings", {}, rawAuthor=ctx.author, reply=lambda a: ctx.channel.send(a))
 
 @bot.command(description="Checkout how to use this bot!")
 async def help(ctx: discord.ApplicationContext):
-    await parseCommandForAndSendSomething(ctx, "help", rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
+    await runForAndSendSomething(ctx, "help", {}, rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
     
 @bot.command(description="Checkout game's details!")
-@discord.option("gameid", int, description = "Id of the game you're interested in.", required = True)
-async def gameinfo(ctx: discord.ApplicationContext, gameid: int):
-    await parseCommandForAndSendSomething(ctx, f"gameinfo {gameid}", rawAuthor=ctx.author, reply=lambda a: ctx.channel.send(a))
+@slashOptions("gameinfo", challenge=slashAutocomplete.challenges)
+async def gameinfo(ctx: discord.ApplicationContext, challenge: int):
+    await runForAndSendSomething(ctx, "gameinfo", {"challenge": challenge}, rawAuthor=ctx.author, reply=lambda a: ctx.channel.send(a))
 
 @bot.command(description="List all games")
 @discord.option("open", bool)
@@ -171,21 +383,30 @@ async def gameinfo(ctx: discord.ApplicationContext, gameid: int):
 @discord.option("aborted", bool)
 @discord.option("with_player", discord.User, default = None, required = False)
 async def list_games(ctx: discord.ApplicationContext, open: bool, in_progress: bool, finished: bool, aborted: bool, with_player: discord.User):
-    await parseCommandForAndSendSomething(ctx, f"list {'open ' if open else ''}{'done ' if finished else ''}{'playing ' if in_progress else ''}{f'with {with_player}' if with_player else ''}", rawAuthor=ctx.author, reply=lambda a: ctx.channel.send(a))
+    options = [option for option, selected in (("open", open), ("done", finished), ("playing", in_progress), ("aborted", aborted)) if selected]
+    if with_player:
+        options += ["with", str(with_player.id)]
+    await runForAndSendSomething(ctx, "list", {"options": options}, rawAuthor=ctx.author, reply=lambda a: ctx.channel.send(a))
 
 @bot.command(description="gives everyone 3 chips")
 async def give_midround_chips(ctx: discord.ApplicationContext):
-    await parseCommandForAndSendSomething(ctx, f"giveeveryonemidroundchips 3", rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
+    await runForAndSendSomething(ctx, "giveeveryonemidroundchips", {"chips": 3}, rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
  
 @bot.command(description="dump logs into your DMs")
 async def dump_logs(ctx: discord.ApplicationContext):
-    await parseCommandForAndSendSomething(ctx, f"dumplogs", rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
+    await runForAndSendSomething(ctx, "dumplogs", {}, rawAuthor=ctx.author, reply=lambda a: ctx.respond(a, ephemeral=True))
        
 @bot.command()
 async def shutdown(ctx: discord.ApplicationContext):
     if await bot.is_owner(ctx.user):
         await ctx.respond("Exiting")
+        bot.saveSnapshot()
         sys.exit()
     await ctx.respond("No Permissions")
 
-bot.run(TOKEN)
\ No newline at end of file
+# worker processes import this module too, they mustn't start the bot
+if __name__ == "__main__":
+    asyncLogging.setup()
+    commandLog.setup()
+    tracing.setup()
+    bot.run(TOKEN)
\ No newline at end of file
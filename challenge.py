@@ -5,8 +5,10 @@ import datetime
 
 from constants import ChallengeState
 from db import Database
+import ratings
 
 import player as playerModule
+import tenant as tenantModule
 
 
 class Challenge:
@@ -15,14 +17,15 @@ class Challenge:
 
     Should be constructed using following factory methods:
     - precreate
+    - createMatched
     - getById
     - getByMessageId
     - getAllChallengesByState
-    - getNewTimeouts
+    - abortAllTimeouts
     """
     db: Optional[Database] = None
 
-    def __init__(self, id: int, messageId: Optional[int], bet: int, authorId: int, acceptedBy: Optional[int], state: ChallengeState | int, timeout: Optional[int], map: str, tribe: str, notes: str, gameName: Optional[str], winner: Optional[int]) -> None:
+    def __init__(self, id: int, messageId: Optional[int], bet: int, authorId: int, acceptedBy: Optional[int], state: ChallengeState | int, timeout: Optional[int], map: str, tribe: str, notes: str, gameName: Optional[str], winner: Optional[int], finishedAt: Optional[int] = None, private: bool | int = False) -> None:
         self.id: int = id
         self.messageId: Optional[int] = messageId
         self.bet: int = bet
@@ -40,6 +43,9 @@ class Challenge:
         self.notes: str = notes
         self.gameName: Optional[str] = gameName
         self.winner: Optional[int] = winner
+        self.finishedAt: Optional[int] = finishedAt
+        # private challenges aren't listed anywhere, they can only be joined by their ID
+        self.private: bool = bool(private)
 
 
     """
@@ -57,6 +63,12 @@ class Challenge:
             stateMessage = f" (winner: {cast(playerModule.Player, playerModule.Player.getById(self.winner)).getName()})"
         return f"Challenge {self.id} {cast(playerModule.Player, playerModule.Player.getById(self.authorId)).getName()} vs {cast(playerModule.Player, playerModule.Player.getById(self.acceptedBy)).getName() if self.acceptedBy else 'TBD'}" + stateMessage
         
+    def toRow(self) -> list:
+        """
+        Returns the challenge as a list of values in the order of database columns, so that cls(*row) recreates it.
+        """
+        return [self.id, self.messageId, self.bet, self.authorId, self.acceptedBy, self.state.value, self.timeout, self.map, self.tribe, self.notes, self.gameName, self.winner, self.finishedAt, int(self.private)]
+
     def __str__(self):
         return f"Challenge {self.id} by {self.authorId}. State {self.state}. Bet {self.bet}. Timeout: {datetime.datetime.fromtimestamp(self.timeout)} Notes:\"{self.notes}\""
     
@@ -76,7 +88,12 @@ class Challenge:
     def getDb(cls: Type[Self]) -> Database:
         """
         return the database all Challenges are using
+
+        while handling an event for a tenant, that's the tenant's database
         """
+        tenant = tenantModule.getCurrent()
+        if tenant != None:
+            return cast(tenantModule.Tenant, tenant).db
         if cls.db != None:
             return cast(Database, cls.db)
         raise EnvironmentError(f"Database of {cls} not set!")
@@ -88,11 +105,11 @@ class Challenge:
     """
 
     @classmethod
-    def precreate(cls: Type[Self], bet: int, authorId: int, map:str, tribe: str, lastsForMinutes: int, notes: str = "") -> Self:
+    def precreate(cls: Type[Self], bet: int, authorId: int, map:str, tribe: str, lastsForMinutes: int, notes: str = "", author: Optional[playerModule.Player] = None, private: bool = False) -> Self:
         """
         Creates a challenge object with no connection to database.
 
-        To connect it to DB, call finishCreating method
+        To connect it to DB, call finishCreating method. If the author's Player is already loaded, it can be passed as author.
 
         Returns:
             The object created
@@ -100,7 +117,8 @@ class Challenge:
         Raises:
             ValueError - if author isn't registered or doesn't have enough chips
         """
-        author = playerModule.Player.getById(authorId)
+        if author == None:
+            author = playerModule.Player.getById(authorId)
         if author == None:
             raise ValueError("You are not registered!")
         
@@ -109,7 +127,31 @@ class Challenge:
             raise ValueError("You don't have enough chips")
 
         # let's use a proxy value of -1 for id
-        challenge = cls(id = cls.getDb().getNewIdForChallenge(), messageId=None, bet=bet, authorId=authorId, acceptedBy=None, state=ChallengeState.PRECREATED, timeout=int(time.time() + lastsForMinutes*60), map=map, tribe=tribe, notes=notes, gameName=None, winner=None)
+        challenge = cls(id = cls.getDb().getNewIdForChallenge(), messageId=None, bet=bet, authorId=authorId, acceptedBy=None, state=ChallengeState.PRECREATED, timeout=int(time.time() + lastsForMinutes*60), map=map, tribe=tribe, notes=notes, gameName=None, winner=None, private=private)
+        return challenge
+
+    @classmethod
+    def createMatched(cls: Type[Self], bet: int, hostId: int, opponentId: int, map: str, tribe: str, notes: str = "") -> Self:
+        """
+        Creates a challenge of two matched players which is already ACCEPTED, charging both of them.
+
+        Returns:
+            The object created
+
+        Raises:
+            ValueError - if a player isn't registered or doesn't have enough chips, or they are in the same team
+        """
+        players = [playerModule.Player.getById(playerId) for playerId in (hostId, opponentId)]
+        if None in players:
+            raise ValueError("Both players have to be registered!")
+        host, opponent = cast(list[playerModule.Player], players)
+        if host.currentChips < bet or opponent.currentChips < bet:
+            raise ValueError("You don't have enough chips")
+        if opponent.getTeam() >= 0 and opponent.getTeam() == host.getTeam():
+            raise ValueError("You can't play someone from the same team")
+
+        challenge = cls(id=cls.getDb().getNewIdForChallenge(), messageId=None, bet=bet, authorId=hostId, acceptedBy=opponentId, state=ChallengeState.ACCEPTED, timeout=int(time.time()), map=map, tribe=tribe, notes=notes, gameName=None, winner=None)
+        cls.getDb().createMatchedChallenge(challenge.id, bet, hostId, opponentId, ChallengeState.ACCEPTED, cast(int, challenge.timeout), map, tribe, notes)
         return challenge
 
     @classmethod
@@ -161,11 +203,20 @@ class Challenge:
         return [cls(*challenge) for challenge in cls.getDb().getChallengesByState(state)]
 
     @classmethod
-    def getNewTimeouts(cls: Type[Self]) -> list[Self]:
+    def abortAllTimeouts(cls: Type[Self]) -> list[Self]:
         """
-        Returns a list of all challenges which should timeout
+        Aborts all challenges which should timeout and refunds their authors, all in one transaction.
+
+        Returns:
+            List of the aborted challenges
+
+        Raises:
+            Nothing
         """
-        return [cls(*challenge) for challenge in cls.getDb().getTimeoutedChallengesByStateAndTimeoutTime(ChallengeState.CREATED, int(time.time()))]
+        challenges = [cls(*challenge) for challenge in cls.getDb().abortTimeoutedChallenges(ChallengeState.CREATED, ChallengeState.ABORTED, int(time.time()))]
+        for challenge in challenges:
+            challenge.state = ChallengeState.ABORTED
+        return challenges
 
 
     """
@@ -189,7 +240,7 @@ class Challenge:
         self.messageId = messageId
         self.state = ChallengeState.CREATED
         self.getDb().adjustPlayerChips(self.authorId, -self.bet)
-        self.getDb().createChallenge(challangeId=self.id, messageId=self.messageId, bet=self.bet, authorId=self.authorId, acceptedBy=self.acceptedBy, state=self.state, timeout=self.timeout, map=self.map, tribe=self.tribe, notes=self.notes, gameName=self.gameName, winner=self.winner)
+        self.getDb().createChallenge(challangeId=self.id, messageId=self.messageId, bet=self.bet, authorId=self.authorId, acceptedBy=self.acceptedBy, state=self.state, timeout=self.timeout, map=self.map, tribe=self.tribe, notes=self.notes, gameName=self.gameName, winner=self.winner, private=self.private)
         
     def accept(self, playerId: int) -> None:
         """
@@ -266,13 +317,13 @@ class Challenge:
         if (not force) and self.state != ChallengeState.STARTED:
             raise ValueError("The game can't be finished!")
         
-        self.getDb().setChallengeState(self.id, ChallengeState.FINISHED)
+        # state, winner, chips and map and tribe statistics change in one transaction
+        self.finishedAt = int(time.time())
+        self.getDb().finishChallenge(self.id, ChallengeState.FINISHED, winnerId, self.finishedAt, self.bet, self.authorId, self.acceptedBy, self.map, self.tribe)
         self.state = ChallengeState.FINISHED
-
-        self.getDb().setChallengeWinner(self.id, winnerId)
         self.winner = winnerId
 
-        self.getDb().adjustPlayerChips(winnerId, self.bet*2)
+        ratings.applyResult(self.getDb(), winnerId, self.acceptedBy if winnerId == self.authorId else self.authorId, self.bet)
 
     def abort(self, byPlayer: int, force: bool) -> None:
         """
@@ -315,7 +366,13 @@ class Challenge:
             # if no winner, there's nothing to do
             return
         
-        cast(playerModule.Player, playerModule.Player.getById(self.winner)).adjustChips(-2*self.bet)
+        winner = cast(playerModule.Player, playerModule.Player.getById(self.winner))
+        if winner.currentChips < 2*self.bet:
+            raise ValueError("You can't have negative chips!")
 
-        self.getDb().setChallengeState(self.id, ChallengeState.STARTED)
-        self.state = ChallengeState.STARTED
\ No newline at end of file
+        # only a finished game was counted into map and tribe statistics
+        self.getDb().unfinishChallenge(self.id, ChallengeState.STARTED, self.winner, self.bet, self.authorId, self.acceptedBy, self.map, self.tribe, counted=(self.state == ChallengeState.FINISHED))
+        self.state = ChallengeState.STARTED
+
+        # later games of both players were rated with this result in place, so everything is recomputed
+        ratings.recomputeAll(self.getDb())
@@ -0,0 +1,71 @@
+from __future__ import annotations
+from typing import Optional, Callable, Iterable, Iterator
+from bisect import bisect_left, insort
+import heapq
+import itertools
+
+
+class OpenChallengeIndex:
+    """
+    IDs of open (CREATED) challenges in buckets by (map, tribe), each kept sorted by bet, so a bet range of a bucket is found by bisection.
+
+    Queries leaving map or tribe open go through the few matching buckets (there are at most maps times tribes of them)
+    and merge them, so they never look at challenges outside the bet range.
+    """
+    def __init__(self):
+        # (map, tribe) -> sorted (bet, timeout, id) of open challenges
+        self.buckets: dict[tuple[str, str], list[tuple[int, int, int]]] = {}
+        # id -> its bucket and entry, for removal
+        self.entries: dict[int, tuple[tuple[str, str], tuple[int, int, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, challengeId: int, bet: int, timeout: Optional[int], map: str, tribe: str) -> None:
+        self.remove(challengeId)
+        key, entry = (map, tribe), (bet, timeout or 0, challengeId)
+        insort(self.buckets.setdefault(key, []), entry)
+        self.entries[challengeId] = (key, entry)
+
+    def remove(self, challengeId: int) -> None:
+        found = self.entries.pop(challengeId, None)
+        if found == None:
+            return
+        key, entry = found
+        bucket = self.buckets[key]
+        del bucket[bisect_left(bucket, entry)]
+        if len(bucket) == 0:
+            del self.buckets[key]
+
+    def search(self, map: Optional[str] = None, tribe: Optional[str] = None, minBet: int = 1, maxBet: Optional[int] = None, exclude: Optional[Callable[[int], bool]] = None, sortBy: str = "bet", limit: int = 10) -> list[int]:
+        """
+        Returns IDs of up to limit open challenges on map with tribe (None matches any) with bet between minBet and maxBet
+        (both included, None for no limit), for which exclude (if given) returns False.
+
+        They are sorted by bet from the highest, or with sortBy "time" by time left from the shortest.
+        """
+        ranges = [(bucket, self.__betRange(bucket, minBet, maxBet)) for key, bucket in self.buckets.items() if (map == None or key[0] == map) and (tribe == None or key[1] == tribe)]
+        if sortBy == "time":
+            entries = (bucket[i] for bucket, indexes in ranges for i in indexes)
+            return [challengeId for _, _, challengeId in heapq.nsmallest(limit, self.__filtered(entries, exclude), key=lambda entry: (entry[1], entry[2]))]
+        # ranges are sorted by bet already, merging them from their ends lazily yields the highest bets first
+        merged = heapq.merge(*[self.__descending(bucket, indexes) for bucket, indexes in ranges], reverse=True)
+        return [challengeId for _, _, challengeId in itertools.islice(self.__filtered(merged, exclude), limit)]
+
+    @staticmethod
+    def __betRange(bucket: list[tuple[int, int, int]], minBet: int, maxBet: Optional[int]) -> range:
+        """
+        returns indexes of entries of bucket with bet between minBet and maxBet
+        """
+        start = bisect_left(bucket, (minBet,))
+        end = bisect_left(bucket, (maxBet + 1,)) if maxBet != None else len(bucket)
+        return range(start, end)
+
+    @staticmethod
+    def __descending(bucket: list[tuple[int, int, int]], indexes: range) -> Iterator[tuple[int, int, int]]:
+        for i in reversed(indexes):
+            yield bucket[i]
+
+    @staticmethod
+    def __filtered(entries: Iterable[tuple[int, int, int]], exclude: Optional[Callable[[int], bool]]) -> Iterator[tuple[int, int, int]]:
+        return (entry for entry in entries if exclude == None or not exclude(entry[2]))
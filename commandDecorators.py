@@ -2,10 +2,11 @@ from __future__ import annotations
 import discord
 
 from typing import Any, Callable, Optional, Protocol, Awaitable, cast, Iterable
-import functools
 
-from constants import LIST_OF_ADMINS
 from player import Player
+from tenant import isAdmin
+from metrics import decoratorRejections
+from tracing import span
 from myTypes import replyFunction, botWithGuild, CommandFunction
 
 __MAX_ARGUMENTS = 256
@@ -22,9 +23,24 @@ __requiredAccessOfCommands: dict[str, str] = {}
 # names of arguments of registered commands
 __argumentNamesOfCommands: dict[str, str] = {}
 
+# names of arguments of registered commands in order, without formatting
+__rawArgumentNamesOfCommands: dict[str, list[str]] = {}
+
 # docstring of commands before they were tempered with
 __rawDocsOfCommands: dict[str, str] = {}
 
+# names of commands which never write into the database
+__readOnlyCommands: set[str] = set()
+
+# argument schemas of registered commands
+__schemasOfCommands: dict[str, ArgumentSchema] = {}
+
+# names of commands disabled while the tournament is frozen
+__frozenDisabledCommands: set[str] = set()
+
+# registered commands with all their checks compiled into one pre-check
+__compiledCommands: dict[str, CompiledCommand] = {}
+
 
 def getAllRegisteredCommands() -> dict[str, CommandFunction]:
     """
@@ -33,6 +49,35 @@ def getAllRegisteredCommands() -> dict[str, CommandFunction]:
     return __registeredCommands
 
 
+def getArgumentNames(commandName: str) -> list[str]:
+    """
+    returns names of arguments of the command in order (empty if they weren't set)
+    """
+    return __rawArgumentNamesOfCommands.get(commandName, [])
+
+def plainValues(values: dict[str, Any]) -> dict[str, Any]:
+    """
+    returns typed argument values with discord objects (users, members, ...) replaced by their IDs, so they can be logged or sent to another process
+    """
+    def plain(value: Any) -> Any:
+        if isinstance(value, list):
+            return [plain(item) for item in value]
+        return value.id if hasattr(value, "id") else value
+    return {name: plain(value) for name, value in values.items()}
+
+def getCompiledCommand(commandName: str) -> Optional[CompiledCommand]:
+    """
+    returns registered command ready to be run, or None if there is no such command
+    """
+    return __compiledCommands.get(commandName)
+
+def isReadOnly(commandName: str) -> bool:
+    """
+    returns if command with given name never writes into the database
+    """
+    return commandName in __readOnlyCommands
+
+
 def getHelpOfAllCommands() -> str:
     """
     return help message for all registered commands
@@ -77,8 +122,216 @@ def __updateDocsForFunc(func: CommandFunction) -> None:
         f"{__argumentNamesOfCommands[__getName(func)] if __getName(func) in __argumentNamesOfCommands else ''} -{__rawDocsOfCommands[__getName(func)]} " 
     
 def __updateRegisteredCommand(func: CommandFunction) -> None:
-    if __getName(func) in __registeredCommands:
-        __registeredCommands[__getName(func)] = func
+    """
+    recompiles the command if it is registered, so its pre-check reflects all decorators applied so far
+    """
+    name = __getName(func)
+    if name not in __registeredCommands:
+        return
+    __compiledCommands[name] = CompiledCommand(
+        name=name,
+        handler=__registeredCommands[name],
+        disabledIfFrozen=name in __frozenDisabledCommands,
+        access=__requiredAccessOfCommands.get(name, "everyone"),
+        schema=__schemasOfCommands.get(name),
+        numberOfArguments=__argumentsOfCommands.get(name, (0, __MAX_ARGUMENTS))
+    )
+
+
+"""
+    ARGUMENT SCHEMAS
+"""
+
+class ArgumentType:
+    """
+    Type of a command argument.
+
+    convert turns both text (from DM commands) and typed values (from slash commands) into the value the command works with.
+    It gets the CommandEvaluator running the command, so resolvers can look things up in its guild.
+    """
+    def __init__(self, name: str, convert: Callable[[Any, Any], Any], slashType: Any):
+        self.name = name
+        self.convert = convert
+        self.slashType = slashType
+
+def __convertText(evaluator: Any, value: Any) -> str:
+    return str(value)
+
+def __convertInt(evaluator: Any, value: Any) -> int:
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"'{value}' should be a number!")
+
+def __convertBool(evaluator: Any, value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() not in ("true", "false"):
+        raise ValueError(f"'{value}' should be True or False!")
+    return str(value).lower() == "true"
+
+def __convertPlayer(evaluator: Any, value: Any) -> Player:
+    # slash commands give us discord users, DM commands ID or name
+    if hasattr(value, "id"):
+        player = Player.getById(value.id)
+    else:
+        player = evaluator.parsePlayer(str(value))
+    if player == None:
+        raise ValueError(f"Player '{value}' isn't registered!")
+    return cast(Player, player)
+
+def __convertChallenge(evaluator: Any, value: Any) -> Any:
+    return evaluator.load_challenge(str(value))
+
+TEXT = ArgumentType("text", __convertText, str)
+INT = ArgumentType("number", __convertInt, int)
+BOOL = ArgumentType("bool", __convertBool, bool)
+PLAYER = ArgumentType("player", __convertPlayer, discord.User)
+CHALLENGE = ArgumentType("challenge", __convertChallenge, int)
+
+
+class Required:
+    """
+    default of arguments which have to be given
+    """
+    def __repr__(self) -> str:
+        return "REQUIRED"
+
+REQUIRED = Required()
+
+
+class Arg:
+    """
+    Declaration of one command argument.
+
+    choices are compared case insensitively (the value is lowercased). If rest is True, the argument takes all remaining arguments
+    (at least one, unless it has a default) and its value is a list. Only the last argument may be rest.
+    """
+    def __init__(self, name: str, type: ArgumentType = TEXT, default: Any = REQUIRED, choices: Optional[Iterable[str]] = None, minValue: Optional[int] = None, rest: bool = False, description: str = "", defaultText: Optional[str] = None):
+        self.name = name
+        self.type = type
+        self.default = default
+        self.choices = list(choices) if choices != None else None
+        self.minValue = minValue
+        self.rest = rest
+        self.description = description
+        self.defaultText = defaultText if defaultText != None else str(default)
+        self.convert = self.__compile()
+
+    @property
+    def required(self) -> bool:
+        return self.default is REQUIRED
+
+    def __compile(self) -> Callable[[Any, Any], Any]:
+        """
+        returns function converting and validating one value of this argument
+        """
+        name = self.name
+        convert = self.type.convert
+        choices = frozenset(self.choices) if self.choices != None else None
+        legalOptions = " ".join(self.choices) if self.choices != None else ""
+        minValue = self.minValue
+
+        if choices == None and minValue == None:
+            return convert
+
+        def convertAndValidate(evaluator: Any, value: Any) -> Any:
+            value = convert(evaluator, value)
+            if choices != None:
+                value = value.lower()
+                if value not in choices:
+                    raise ValueError(f"Not a legal {name}. I am sorry :( legal options are:\n{legalOptions}")
+            if minValue != None and value < minValue:
+                raise ValueError(f"{name} should be at least {minValue}!")
+            return value
+        return convertAndValidate
+
+
+class ArgumentSchema:
+    """
+    Arguments of a command, compiled once into validators converting raw arguments into a dictionary of values by argument name.
+    """
+    def __init__(self, args: tuple[Arg, ...], maxArguments: int):
+        if any(arg.rest for arg in args[:-1]):
+            raise ValueError("Only the last argument can take the rest of arguments")
+
+        self.args = args
+        self.names = [arg.name for arg in args]
+        self.minCount = sum(1 for arg in args if arg.required)
+        self.maxCount = maxArguments if len(args) > 0 and args[-1].rest else len(args)
+        self.__plain = [(arg.name, arg.convert, arg.default) for arg in args if not arg.rest]
+        self.__rest = args[-1] if len(args) > 0 and args[-1].rest else None
+
+        if self.minCount == self.maxCount:
+            self.countError = f"Wrong number of arguments! It should be exactly {self.minCount}."
+        elif self.maxCount == maxArguments:
+            self.countError = f"Wrong number of arguments! It should be at least {self.minCount}."
+        else:
+            self.countError = f"Wrong number of arguments! It should be between {self.minCount} and {self.maxCount}."
+
+    def fromText(self, evaluator: Any, rawArgs: list[str]) -> dict[str, Any]:
+        """
+        converts arguments of a text command (without command name)
+
+        Raises:
+            ValueError - wrong number of arguments or an invalid one
+        """
+        if not (self.minCount <= len(rawArgs) <= self.maxCount):
+            decoratorRejections.inc(reason="wrongArguments")
+            raise ValueError(self.countError)
+
+        values: dict[str, Any] = {}
+        for i, (name, convert, default) in enumerate(self.__plain):
+            values[name] = convert(evaluator, rawArgs[i]) if i < len(rawArgs) else default
+        if self.__rest != None:
+            rest = rawArgs[len(self.__plain):]
+            values[self.__rest.name] = [self.__rest.convert(evaluator, value) for value in rest] if len(rest) > 0 else self.__rest.default
+        return values
+
+    def fromValues(self, evaluator: Any, given: dict[str, Any]) -> dict[str, Any]:
+        """
+        converts already typed arguments (of a slash command) given by name, missing or None ones get their defaults
+
+        Raises:
+            ValueError - a required argument is missing or one is invalid
+        """
+        values: dict[str, Any] = {}
+        for arg in self.args:
+            value = given.get(arg.name)
+            if value == None:
+                if arg.required:
+                    decoratorRejections.inc(reason="wrongArguments")
+                    raise ValueError(f"Argument {arg.name} is required!")
+                values[arg.name] = arg.default
+            elif arg.rest:
+                values[arg.name] = [arg.convert(evaluator, item) for item in (value if isinstance(value, list) else [value])]
+            else:
+                values[arg.name] = arg.convert(evaluator, value)
+        return values
+
+    def usage(self) -> str:
+        """
+        returns description of arguments for help messages
+        """
+        return " ".join(f"[{arg.name}]" + ("..." if arg.rest else "") + (f" (default: {arg.defaultText})" if not arg.required else "") for arg in self.args)
+
+    def slashOptions(self) -> list[tuple[str, Any, dict[str, Any]]]:
+        """
+        returns (name, type, other arguments of discord.option) of each option of a slash command taking these arguments
+        """
+        options = []
+        for arg in self.args:
+            kwargs: dict[str, Any] = {"description": arg.description or arg.name, "required": arg.required}
+            if not arg.required:
+                kwargs["default"] = None if arg.rest else arg.default
+            if arg.choices != None:
+                kwargs["choices"] = arg.choices
+            if arg.minValue != None:
+                kwargs["min_value"] = arg.minValue
+            options.append((arg.name, str if arg.rest else arg.type.slashType, kwargs))
+        return options
 
 
 """
@@ -95,6 +348,7 @@ def registerCommand(func: CommandFunction) -> CommandFunction:
     if __getName(func) not in __requiredAccessOfCommands:
         __requiredAccessOfCommands[__getName(func)] = "everyone"
 
+    __updateRegisteredCommand(func)
     return func
 
 def autocompleteDocs(func: CommandFunction) -> CommandFunction:
@@ -107,135 +361,159 @@ def autocompleteDocs(func: CommandFunction) -> CommandFunction:
 
     return func
 
-def setArgumentNames(*args: str, **kwargs: str):
-    def decorator(func):
-        __argumentNamesOfCommands[__getName(func)] = " ".join([f'[{name}]' for name in args] + [f'[{name}] (default: {kwargs[name]})' for name in kwargs])
+def readOnly(func: CommandFunction) -> CommandFunction:
+    """
+    marks the command as never writing into the database, so it can be run by any worker
+    """
+    __readOnlyCommands.add(__getName(func))
+    return func
+
+def arguments(*args: Arg):
+    """
+    declares arguments of the command. They are converted and validated by the command's pre-check,
+    the command then finds them in ctx.args as a dictionary of values by argument name
+    """
+    schema = ArgumentSchema(args, __MAX_ARGUMENTS)
+
+    def decorator(func: CommandFunction) -> CommandFunction:
+        __schemasOfCommands[__getName(func)] = schema
+        __argumentNamesOfCommands[__getName(func)] = schema.usage()
+        __rawArgumentNamesOfCommands[__getName(func)] = schema.names
+        __trackNumberOfArguments(func)
+        __concatArgumentsOfCommands(func, (schema.minCount, schema.maxCount))
 
         __updateRegisteredCommand(func)
         __updateDocsForFunc(func)
         return func
-    
+
     return decorator
 
+def slashOptions(commandName: str, **autocomplete: Callable) -> Callable[[Callable], Callable]:
+    """
+    decorator adding options generated from argument schema of given command to a slash command
+
+    autocomplete maps option names to their autocomplete callbacks. Options with one are sent as text or numbers,
+    as discord only autocompletes those (converters of the argument types accept IDs).
+    """
+    def decorator(func: Callable) -> Callable:
+        schema = __schemasOfCommands[commandName]
+        # option decorators are applied bottom up
+        for name, type, kwargs in reversed(schema.slashOptions()):
+            if name in autocomplete:
+                kwargs["autocomplete"] = autocomplete[name]
+                type = type if type in (str, int, float) else str
+            func = discord.option(name, type, **kwargs)(func)
+        return func
+    return decorator
 
 """
     ENSURERS
+
+    Ensurers don't wrap the command, they only declare its requirements.
+    All of them are compiled into one pre-check of the command (see CompiledCommand).
 """
 
 def disableIfFrozen(func: CommandFunction) -> CommandFunction:
     """
     disables the command if tournament is frozen except for admins
     """
-    @functools.wraps(func)
-    def wrapper(self: Any, args: list[str], author: discord.Member, reply: replyFunction):
-        if self.frozen == True and author.id not in LIST_OF_ADMINS:
-            raise ValueError("The tournament is frozen!")
-        return func(self, args, author, reply)
-    
-    __updateRegisteredCommand(wrapper)
-    __updateDocsForFunc(wrapper)
-    return wrapper
+    __frozenDisabledCommands.add(__getName(func))
+
+    __updateRegisteredCommand(func)
+    __updateDocsForFunc(func)
+    return func
 
 def ensureRegistered(func: CommandFunction) -> CommandFunction:
     """
-    ensures "author" is registered
-    also checks if frozen is True and if it is fails
+    ensures "author" is registered, the command gets their Player as ctx.player
     """
-
-    @functools.wraps(func)
-    def wrapper(self: Any, args: list[str], author: discord.Member, reply: replyFunction):
-        if Player.getById(author.id) == None:
-            raise ValueError("You need to register using \"register\" command!")
-        return func(self, args, author, reply)
-
     __requiredAccessOfCommands[__getName(func)] = "registered"
 
-    __updateRegisteredCommand(wrapper)
-    __updateDocsForFunc(wrapper)
-    return wrapper
+    __updateRegisteredCommand(func)
+    __updateDocsForFunc(func)
+    return func
 
 def ensureAdmin(func: CommandFunction) -> CommandFunction:
     """
     ensures "author" is admin
     DOESN'T check frozen
     """
-    @functools.wraps(func)
-    def wrapper(self: Any, args: list[str], author: discord.Member, reply: replyFunction):
-        if author.id not in LIST_OF_ADMINS:
-            raise ValueError("You don't have the rights to use this command!")
-        return func(self, args, author, reply)
-        
     __requiredAccessOfCommands[__getName(func)] = "admin"
 
-    __updateRegisteredCommand(wrapper)
-    __updateDocsForFunc(wrapper)
-
-    return wrapper
-
-def ensureNumberOfArgumentsIsExactly(number: int):
-    """
-    ensures "args" has correct length
-    """
-    def decorator(func: CommandFunction) -> CommandFunction:
-        
-        @functools.wraps(func)
-        def wrapper(self: Any, args: list[str], author: discord.Member, reply: replyFunction):
-            if not (len(args) == number):
-                raise ValueError(f"Wrong number of arguments! It should be exactly {number}.")
-            return func(self, args, author, reply)
-
-        __trackNumberOfArguments(func)
-        __concatArgumentsOfCommands(func,(number, number))
+    __updateRegisteredCommand(func)
+    __updateDocsForFunc(func)
+    return func
 
-        __updateRegisteredCommand(wrapper)
-        __updateDocsForFunc(wrapper)
+"""
+    PRE-CHECK
+"""
 
-        return wrapper
-    
-            
-    return decorator
-        
-def ensureNumberOfArgumentsIsAtLeast(number: int):
+class CommandContext:
     """
-    ensures "args" has correct length
+    Everything known about one invocation of a command, filled in by its pre-check.
     """
-    def decorator(func: CommandFunction) -> CommandFunction:
-        @functools.wraps(func)
-        def wrapper(self: Any, args: list[str], author: discord.Member, reply: replyFunction):
-            if not(len(args) >= number):
-                raise ValueError(f"Wrong number of arguments! It should be at least {number}.")
-            return func(self, args, author, reply)
+    def __init__(self, author: discord.Member, player: Optional[Player], isAdmin: bool, args: Any, reply: replyFunction):
+        self.author = author
+        # Player of the author, only loaded for commands requiring registration
+        self.player = player
+        self.isAdmin = isAdmin
+        # values by argument name (or raw arguments for commands without schema)
+        self.args = args
+        self.reply = reply
 
-        __trackNumberOfArguments(func)
-        __concatArgumentsOfCommands(func,(number, __MAX_ARGUMENTS))
-
-        __updateRegisteredCommand(wrapper)
-        __updateDocsForFunc(wrapper)
 
-        return wrapper
-    
-    return decorator
-        
-def ensureNumberOfArgumentsIsAtMost(number: int):
+class CompiledCommand:
     """
-    ensures "args" has correct length
+    Registered command with all its checks (frozen, access, arguments) compiled into one flat pre-check.
     """
-    def decorator(func: CommandFunction) -> CommandFunction:
-
-        @functools.wraps(func)
-        def wrapper(self: Any, args: list[str], author: discord.Member, reply: replyFunction):
-            if not (len(args) <= number):
-                print(number)
-                print(args)
-                raise ValueError(f"Wrong number of arguments! It should be at most {number}.")
-            return func(self, args, author, reply)
-
-        __trackNumberOfArguments(func)
-        __concatArgumentsOfCommands(func,(0, number))
-
-        __updateRegisteredCommand(wrapper)
-        __updateDocsForFunc(wrapper)
-
-        return wrapper
-    
-    return decorator
\ No newline at end of file
+    def __init__(self, name: str, handler: CommandFunction, disabledIfFrozen: bool, access: str, schema: Optional[ArgumentSchema], numberOfArguments: tuple[int, int]):
+        self.name = name
+        self.handler = handler
+        self.precheck = self.__compile(disabledIfFrozen, access, schema, numberOfArguments)
+
+    @staticmethod
+    def __compile(disabledIfFrozen: bool, access: str, schema: Optional[ArgumentSchema], numberOfArguments: tuple[int, int]) -> Callable[[Any, Any, discord.Member, replyFunction], CommandContext]:
+        checkRegistered = access == "registered"
+        checkAdmin = access == "admin"
+        minCount, maxCount = numberOfArguments
+
+        if schema != None:
+            fromText = schema.fromText
+            fromValues = schema.fromValues
+        else:
+            def fromText(evaluator: Any, args: list[str]) -> list[str]:
+                if not (minCount <= len(args) <= maxCount):
+                    decoratorRejections.inc(reason="wrongArguments")
+                    raise ValueError(f"Wrong number of arguments! It should be between {minCount} and {maxCount}.")
+                return args
+            def fromValues(evaluator: Any, args: dict[str, Any]) -> dict[str, Any]:
+                return args
+
+        def precheck(evaluator: Any, args: Any, author: discord.Member, reply: replyFunction) -> CommandContext:
+            with span("precheck"):
+                admin = isAdmin(author.id)
+                if disabledIfFrozen and evaluator.frozen == True and not admin:
+                    decoratorRejections.inc(reason="frozen")
+                    raise ValueError("The tournament is frozen!")
+
+                player = None
+                if checkRegistered:
+                    player = Player.getById(author.id)
+                    if player == None:
+                        decoratorRejections.inc(reason="unregistered")
+                        raise ValueError("You need to register using \"register\" command!")
+                elif checkAdmin and not admin:
+                    decoratorRejections.inc(reason="notAdmin")
+                    raise ValueError("You don't have the rights to use this command!")
+
+                # slash commands give typed values by name, text commands a list of strings
+                values = fromValues(evaluator, args) if isinstance(args, dict) else fromText(evaluator, args)
+                return CommandContext(author, player, admin, values, reply)
+
+        return precheck
+
+    async def run(self, evaluator: Any, args: Any, author: discord.Member, reply: replyFunction) -> None:
+        """
+        runs the command after its pre-check, args are either raw text arguments or typed values by name
+        """
+        await self.handler(evaluator, self.precheck(evaluator, args, author, reply))
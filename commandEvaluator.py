@@ -1,6 +1,12 @@
 from __future__ import annotations
 from typing import Optional, cast, Callable, Any, Awaitable, Protocol
+import asyncio
+import datetime
+import functools
+import os
 import re
+import tempfile
+import time
 
 import discord
 import logging
@@ -8,18 +14,36 @@ import logging
 from messenger import Messenger
 from challenge import Challenge
 from player import Player
-from commandDecorators import ensureAdmin, ensureRegistered, replyFunction, ensureNumberOfArgumentsIsAtLeast, ensureNumberOfArgumentsIsAtMost, ensureNumberOfArgumentsIsExactly, registerCommand, autocompleteDocs, getAllRegisteredCommands, getHelpOfAllCommands, setArgumentNames, disableIfFrozen
-from constants import ChallengeState, HELPMESSAGE, TRIBE_OPTIONS, MAP_OPTIONS, TEAM_ROLES, CHALLENGES_LIST_CHANNEL
+from playerIndex import PlayerIndex
+from memberCache import MemberCache
+from commandDecorators import ensureAdmin, ensureRegistered, replyFunction, registerCommand, autocompleteDocs, getAllRegisteredCommands, getCompiledCommand, getHelpOfAllCommands, disableIfFrozen, readOnly, arguments, Arg, INT, BOOL, PLAYER, CHALLENGE, CommandContext, CompiledCommand
+from constants import ChallengeState, HELPMESSAGE, TRIBE_OPTIONS, MAP_OPTIONS, MAX_ATTACHMENT_BYTES, SEASONS_DIRECTORY
 from myTypes import replyFunction, botWithGuild
+from metrics import commandSeconds
+import commandLog
+import tracing
+import ratings
+import seasonArchive
+import mapStats
+import export
+import matchmaking
+import tenant as tenantModule
+
+# every evaluated command, written into COMMAND_LOG_FILE
+commandLogger = logging.getLogger("commands")
 
 async def emptyReply(message: str):
     pass
 
 class CommandEvaluator:
-    def __init__(self, messenger: Messenger, bot: botWithGuild):
+    def __init__(self, messenger: Messenger, bot: botWithGuild, guild: discord.Guild, players: Optional[PlayerIndex] = None, members: Optional[MemberCache] = None):
         self.messenger = messenger
         self.bot = bot
-        self.logFile = open("commandlog.log", "a")
+        # guild of the tenant this evaluator serves
+        self.guild = guild
+        # names of registered players of the guild, used to resolve players by name
+        self.players = players if players != None else PlayerIndex()
+        self.members = members if members != None else MemberCache(guild)
         
         # max length of message is 2000 chars, so we will have to do a lot of hacking to keep lines intact :D
         self.helpMessage = []
@@ -41,25 +65,58 @@ class CommandEvaluator:
         """
         parse a command and return if the command is valid
         """
+        with tracing.startTrace("command", source=source, guild=self.guild.id):
+            return await self._parseCommand(message, rawAuthor, tracing.traced("reply")(reply), source)
 
-        author: Optional[discord.Member]
+    async def runCommand(self, commandName: str, values: dict[str, Any], rawAuthor: discord.User | discord.Member | None, reply: replyFunction = emptyReply, source = None) -> bool:
+        """
+        run a command with already typed arguments given by name (e.g. options of a slash command) and return if the command is valid
+
+        Arguments go through the same validation as the ones of text commands, only they aren't parsed from text.
+        """
+        with tracing.startTrace("command", source=source, guild=self.guild.id):
+            return await self._runCommand(commandName.lower(), values, rawAuthor, tracing.traced("reply")(reply), source)
 
+    async def _parseCommand(self, message: str, rawAuthor: discord.User | discord.Member | None, reply: replyFunction, source) -> bool:
         if message[0] == "/":
             message = message[1:]
+
+        async def run(author: Optional[discord.Member]) -> None:
+            with tracing.span("parse"):
+                args = self.__spliiter.findall(message.strip())
+                args = list(filter(lambda arg: arg!= "", map(lambda arg: "".join(arg).strip(), args)))
+            commandLogger.info(message.strip(), extra={"entry": commandLog.makeEntry(
+                args, rawAuthor.id if rawAuthor != None else None, rawAuthor.name if rawAuthor != None else None, self.guild.id, source
+            )})
+            await self.evaluateCommand(args=args, author=author, reply=reply, source=source)
+
+        return await self._handleErrors(run, rawAuthor, reply, source)
+
+    async def _runCommand(self, commandName: str, values: dict[str, Any], rawAuthor: discord.User | discord.Member | None, reply: replyFunction, source) -> bool:
+        async def run(author: Optional[discord.Member]) -> None:
+            entry = commandLog.makeStructuredEntry(
+                commandName, values, rawAuthor.id if rawAuthor != None else None, rawAuthor.name if rawAuthor != None else None, self.guild.id, source
+            )
+            commandLogger.info(commandName, extra={"entry": entry})
+            await self._execute(commandName, values, author, reply)
+
+        return await self._handleErrors(run, rawAuthor, reply, source)
+
+    async def _handleErrors(self, run: Callable[[Optional[discord.Member]], Awaitable[None]], rawAuthor: discord.User | discord.Member | None, reply: replyFunction, source) -> bool:
+        """
+        resolves the author, runs the command and reports its errors back, returns if the command was valid
+        """
+        author: Optional[discord.Member]
         if rawAuthor == None:
             author = None
         else:
             rawAuthor = cast(discord.User | discord.Member, rawAuthor)
-            # fetching is potentially costly, so we don't want to fetch when not needed
-            author =  self.bot.guild.get_member(rawAuthor.id)
-            if author == None:
-                author =  await self.bot.guild.fetch_member(rawAuthor.id)
+            # members of registered players are kept warm, so fetching is rare
+            with tracing.span("fetch_member"):
+                author = await self.members.fetch(rawAuthor.id)
 
         try:
-            args = self.__spliiter.findall(message.strip())
-            print("Preparse args:", message.strip(), flush=True, file=self.logFile)
-            args = list(filter(lambda arg: arg!= "", map(lambda arg: "".join(arg).strip(), args)))
-            await self.evaluateCommand(args=args, author=author, reply=reply, source=source)
+            await run(author)
             return True
         except ValueError as e:
             logging.warning(f"Error parsing command {f'from {source}' if source != None else ''}")
@@ -76,77 +133,94 @@ class CommandEvaluator:
         """
         runs a command with given args (first arg is command name)
         """
-
-        if author == None:
-            raise ValueError("You are not a member of our guild!")
-
-        print(f"evaluating command from source: {source}; author: {cast(discord.Member, author).name}; args: {args}", file=self.logFile, flush=True)
-
-        author = cast(discord.Member, author)
-
-
         # shouldn't really happen, but just in case
         if len(args) == 0:
             logging.info("no args recieved")
             raise ValueError("invalid number of arguments!")
 
-        commandName = args[0].lower()
+        await self._execute(args[0].lower(), args[1:], author, reply)
+
+    async def _execute(self, commandName: str, arguments: list[str] | dict[str, Any], author: discord.Member | None, reply: replyFunction) -> None:
+        """
+        runs a command with raw (text) arguments or typed arguments by name
+        """
+        if author == None:
+            raise ValueError("You are not a member of our guild!")
+
+        author = cast(discord.Member, author)
 
         # match commands
-        if commandName not in getAllRegisteredCommands():
+        command = getCompiledCommand(commandName)
+        if command == None:
             raise ValueError("unknown command. Try \"help\" command.")
         
-        await (getAllRegisteredCommands()[commandName](self, args[1:], author, reply))
+        tracing.setAttribute("command", commandName)
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            await cast(CompiledCommand, command).run(self, arguments, author, reply)
+            outcome = "ok"
+        except ValueError:
+            outcome = "rejected"
+            raise
+        finally:
+            commandSeconds.observe(time.perf_counter() - start, command=commandName, outcome=outcome)
+            tracing.setAttribute("outcome", outcome)
 
     @autocompleteDocs
     @registerCommand
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_help(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @readOnly
+    @arguments()
+    async def command_help(self, ctx: CommandContext) -> None:
         """
         display help message
         """
-        await reply(HELPMESSAGE + f"""
+        await ctx.reply(HELPMESSAGE + f"""
                     
 list of all commands:
 {", ".join(getAllRegisteredCommands().keys())}""")
 
     @autocompleteDocs
     @registerCommand
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_detailedhelp(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @readOnly
+    @arguments()
+    async def command_detailedhelp(self, ctx: CommandContext) -> None:
         """
         display help message including description of all commands
         """
         for message in self.helpMessage:
-            await reply(message)
+            await ctx.reply(message)
 
     @autocompleteDocs
     @registerCommand
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_register(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments()
+    async def command_register(self, ctx: CommandContext) -> None:
         """
         register yourself to our amazing tournament!
         """
-        Player.create(author.id)
-        await self.messenger.playerRegistered(author.id)
+        Player.create(ctx.author.id, team=Player.teamOf(ctx.author, Player.getTeamRoles()))
+        self.players.setMember(ctx.author.id, ctx.author.name, ctx.author.display_name)
+        await self.messenger.playerRegistered(ctx.author.id)
 
     @autocompleteDocs
     @registerCommand
-    @ensureNumberOfArgumentsIsAtLeast(1)
-    async def command_list(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @readOnly
+    @arguments(Arg("options", rest=True))
+    async def command_list(self, ctx: CommandContext) -> None:
         """
         lists all games which satisfy arguments.
 
         argument options:
             "all", "done", "open", "playing", "mine", "aborted", "from [player]"
         """
+        options: list[str] = ctx.args["options"]
         done = open = inProgress = aborted = False
         withPlayers: list[int] = []
 
         # we will need to manipulate with i
         i = 0
-        while i < len(args):
-            arg = args[i]
+        while i < len(options):
+            arg = options[i]
 
             match arg:
                 case "all":
@@ -165,15 +239,15 @@ list of all commands:
                     aborted = True
 
                 case "mine":
-                    withPlayers.append(author.id)
+                    withPlayers.append(ctx.author.id)
 
                 case "with":
                     i += 1
-                    if i >= len(args):
+                    if i >= len(options):
                         raise ValueError("After argument 'with' there should be a player ID")
-                    player = self.parsePlayer(args[i])
+                    player = self.parsePlayer(options[i])
                     if player == None:
-                        raise ValueError(f"Player {args[i]} doesn't exist!")
+                        raise ValueError(f"Player {options[i]} doesn't exist!")
                     withPlayers.append(cast(Player, player).id)
             
                 case _:
@@ -201,7 +275,7 @@ list of all commands:
             allChallenges = {challenge for challenge in allChallenges if challenge.authorId == playerId or challenge.acceptedBy == playerId}
 
         if len(allChallenges) == 0:
-            await reply("no games match your options")
+            await ctx.reply("no games match your options")
         else:
             challengesTexts = [await challenge.toTextForMessages() for challenge in allChallenges]
 
@@ -211,28 +285,61 @@ list of all commands:
             for i in range(len(challengesTexts)):
                 length += len(challengesTexts[i])
                 if length >= 1500:
-                    await reply("\n\n".join(challengesTexts[start: i]))
+                    await ctx.reply("\n\n".join(challengesTexts[start: i]))
                     start = i
                     length = len(challengesTexts[i])
 
-            await reply("\n\n".join(challengesTexts[start:]))
+            await ctx.reply("\n\n".join(challengesTexts[start:]))
 
 
 
 
+    @autocompleteDocs
+    @registerCommand
+    @readOnly
+    @ensureRegistered
+    @arguments(
+        Arg("map", choices=["any"] + MAP_OPTIONS, default="any"),
+        Arg("tribe", choices=["any"] + TRIBE_OPTIONS, default="any"),
+        Arg("minbet", INT, default=1, minValue=1),
+        Arg("maxbet", INT, default=None, minValue=1, defaultText="any"),
+        Arg("sort", choices=["bet", "time"], default="bet", description="bet lists the highest bets first, time the challenges timing out first."),
+        Arg("count", INT, default=10, minValue=1)
+    )
+    async def command_browse(self, ctx: CommandContext) -> None:
+        """
+        lists open challenges you can accept (not of your team) on given map with given tribe and bet
+        """
+        player = cast(Player, ctx.player)
+        # authors' teams are known by role id
+        team = player.getTeam()
+        teamRole = Player.getTeamRoles()[team] if team >= 0 else None
+        challenges = await self.messenger.browseChallenges(
+            player.id, teamRole,
+            map=None if ctx.args["map"] == "any" else ctx.args["map"],
+            tribe=None if ctx.args["tribe"] == "any" else ctx.args["tribe"],
+            minBet=ctx.args["minbet"], maxBet=ctx.args["maxbet"], sortBy=ctx.args["sort"], limit=min(ctx.args["count"], 25)
+        )
+        if len(challenges) == 0:
+            await ctx.reply("No open challenges match. You can create one or join the queue!")
+            return
+        await ctx.reply("\n".join([
+            f"{challenge.id}: bet {challenge.bet}, {challenge.map}, {challenge.tribe}, by {cast(Player, Player.getById(challenge.authorId)).getName()}, times out <t:{challenge.timeout}:R>"
+            for challenge in challenges
+        ]) + "\n\nTo accept one, send me: accept [challenge]")
+
     @disableIfFrozen
     @autocompleteDocs
     @registerCommand
-    @setArgumentNames("challenge", "message")
     @ensureRegistered
-    @ensureNumberOfArgumentsIsAtLeast(2)
-    async def command_send(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("challenge", CHALLENGE), Arg("message", rest=True))
+    async def command_send(self, ctx: CommandContext) -> None:
         """
         sends all player in a game a message
         """
-        challenge: Challenge = self.load_challenge(args[0])
-        if author.id in [challenge.authorId, challenge.acceptedBy]:
-            await self.messenger._sendAll(challenge, f"message from {author.display_name}:\n{' '.join(args[1:])}")
+        challenge: Challenge = ctx.args["challenge"]
+        if ctx.author.id in [challenge.authorId, challenge.acceptedBy]:
+            await self.messenger._sendAll(challenge, f"message from {ctx.author.display_name}:\n{' '.join(ctx.args['message'])}")
         else:
             raise ValueError("You are not part of the game!")
 
@@ -240,110 +347,148 @@ list of all commands:
     @disableIfFrozen
     @autocompleteDocs
     @registerCommand
-    @setArgumentNames("bet", "map", "tribe", timeout = "60*12", private = "False")
     @ensureRegistered
-    @ensureNumberOfArgumentsIsAtLeast(3)
-    @ensureNumberOfArgumentsIsAtMost(5)
-    async def command_create(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(
+        Arg("bet", INT, minValue=1),
+        Arg("map", choices=MAP_OPTIONS),
+        Arg("tribe", choices=TRIBE_OPTIONS),
+        Arg("timeout", INT, default=60*12, minValue=1, defaultText="60*12", description="Number of minutes before this challange will automatically abort. (default is 12*60)"),
+        Arg("private", BOOL, default=False, description="if true, this challenge won't be listed. You can still use its ID to join it.")
+    )
+    async def command_create(self, ctx: CommandContext) -> None:
         """
         Creates a challenge. The challenge will be automatically abortded after [timeout] minutes. If the challenge is [private], it won't be listed in <#1170686597746917406>.
         """
-        bet = int(args[0])
-        map = args[1].lower()
-        tribe = args[2].lower()
-
-        if map not in MAP_OPTIONS:
-            raise ValueError(f"Not a legal map type. I am sorry :( legal options are:\n{' '.join(MAP_OPTIONS)}")
-        
-        if tribe not in TRIBE_OPTIONS:
-            raise ValueError(f"Not a legal tribe. I am sorry :(  legal options are:\n{' '.join(TRIBE_OPTIONS)}")
-        
-        if len(args) > 3:
-            timeout = int(args[3])
-        else:
-            timeout = 60 * 12
-        
-        if len(args) > 4:
-            if args[4].lower() not in ["true", "false"]:
-                raise ValueError("Not a legal value for private. Should be True or False")
+        challenge = Challenge.precreate(bet=ctx.args["bet"], authorId=ctx.author.id, map=ctx.args["map"], tribe=ctx.args["tribe"], lastsForMinutes=ctx.args["timeout"], author=ctx.player, private=ctx.args["private"])
+        await self.messenger.createChallengeEntry(challenge=challenge)
 
-            private = (args[4].lower() == "true")
+    @disableIfFrozen
+    @autocompleteDocs
+    @registerCommand
+    @ensureRegistered
+    @arguments(
+        Arg("minbet", INT, minValue=1, description="The lowest bet you want to play for."),
+        Arg("maxbet", INT, minValue=1, description="The highest bet you want to play for."),
+        Arg("maps", default="any", description="Maps you want to play on, separated by commas (default is any)."),
+        Arg("tribes", default="any", description="Tribes you want to play with, separated by commas (default is any).")
+    )
+    async def command_queue(self, ctx: CommandContext) -> None:
+        """
+        Waits for an opponent who accepts some of the same bets, maps and tribes. Once one is found, an accepted challenge is created for both of you. Queueing again replaces your previous choice.
+        """
+        player = cast(Player, ctx.player)
+        minBet, maxBet = ctx.args["minbet"], ctx.args["maxbet"]
+        if minBet > maxBet:
+            raise ValueError("minbet can't be higher than maxbet!")
+        if player.currentChips < minBet:
+            raise ValueError("You don't have enough chips")
+        # bets the player can't afford are never offered
+        maxBet = min(maxBet, player.currentChips)
+
+        tenant = cast(tenantModule.Tenant, tenantModule.getCurrent())
+        entry = matchmaking.QueueEntry(
+            player.id, minBet, maxBet,
+            matchmaking.parseOptions(ctx.args["maps"], MAP_OPTIONS, "map"),
+            matchmaking.parseOptions(ctx.args["tribes"], TRIBE_OPTIONS, "tribe"),
+            player.getTeam()
+        )
+        tenant.queue.remove(player.id)
+
+        while True:
+            match = tenant.queue.findMatch(entry)
+            if match == None:
+                tenant.queue.add(entry)
+                await ctx.reply(f"You are in the queue with {len(tenant.queue) - 1} other players. You'll get a DM once you are matched.")
+                return
+
+            # the opponent leaves the queue either way, if they can't play anymore (chips, team) they are told so and the next one is tried
+            opponent, bet, map, tribe = match
+            tenant.queue.remove(opponent.playerId)
+            try:
+                challenge = Challenge.createMatched(bet, hostId=opponent.playerId, opponentId=player.id, map=map, tribe=tribe)
+            except ValueError as e:
+                await self.messenger.queueDropped(opponent.playerId, str(e))
+                continue
+            await self.messenger.challengeMatched(challenge)
+            return
 
-        
-        challenge = Challenge.precreate(bet = int(bet), authorId=author.id, map=map, tribe=tribe, lastsForMinutes=timeout)
-        await self.messenger.createChallengeEntry(challenge=challenge, private=private)
+    @autocompleteDocs
+    @registerCommand
+    @ensureRegistered
+    @arguments()
+    async def command_unqueue(self, ctx: CommandContext) -> None:
+        """
+        leaves the matchmaking queue
+        """
+        tenant = cast(tenantModule.Tenant, tenantModule.getCurrent())
+        if tenant.queue.remove(ctx.author.id) == None:
+            raise ValueError("You aren't in the queue!")
+        await ctx.reply("You have left the queue.")
 
     
     @disableIfFrozen
     @autocompleteDocs
     @registerCommand
-    @setArgumentNames("challenge")
     @ensureRegistered
-    @ensureNumberOfArgumentsIsExactly(1)
-    async def command_abort(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("challenge", CHALLENGE))
+    async def command_abort(self, ctx: CommandContext) -> None:
         """
         abort challenge with given ID. Both players will be refunded their bet and the game will be canceled. Can only be used if the game hasn't been started yet. Abuse will be persecuted!
         """
-        challenge: Challenge = self.load_challenge(args[0])
-        challenge.abort(byPlayer = author.id, force=False)
+        challenge: Challenge = ctx.args["challenge"]
+        challenge.abort(byPlayer = ctx.author.id, force=False)
         await self.messenger.abortChallenge(challenge)
 
     @disableIfFrozen
     @autocompleteDocs
-    @setArgumentNames("challenge")
     @registerCommand
     @ensureRegistered
-    @ensureNumberOfArgumentsIsExactly(1)
-    async def command_accept(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("challenge", CHALLENGE))
+    async def command_accept(self, ctx: CommandContext) -> None:
         """
         accepts challenge with given ID
         """
-        challenge: Challenge = self.load_challenge(args[0])
-        challenge.accept(playerId = author.id)
+        challenge: Challenge = ctx.args["challenge"]
+        challenge.accept(playerId = ctx.author.id)
         await self.messenger.acceptChallenge(challenge)
 
     @disableIfFrozen
     @autocompleteDocs
-    @setArgumentNames("challenge")
     @registerCommand
     @ensureRegistered
-    @ensureNumberOfArgumentsIsAtLeast(2)
-    async def command_start(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("challenge", CHALLENGE), Arg("gameName", rest=True))
+    async def command_start(self, ctx: CommandContext) -> None:
         """
         starts challenge with given ID
         """
-        challenge: Challenge = self.load_challenge(args[0])
-        challenge.start(playerId = author.id, gameName=" ".join(args[1:]))
+        challenge: Challenge = ctx.args["challenge"]
+        challenge.start(playerId = ctx.author.id, gameName=" ".join(ctx.args["gameName"]))
         await self.messenger.startChallenge(challenge)
-        await reply("OK")
+        await ctx.reply("OK")
 
     @disableIfFrozen
     @autocompleteDocs
-    @setArgumentNames("challenge")
     @registerCommand
     @ensureRegistered
-    @ensureNumberOfArgumentsIsExactly(1)
-    async def command_win(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("challenge", CHALLENGE))
+    async def command_win(self, ctx: CommandContext) -> None:
         """
         claims you have won challenge with given ID
         """
-        challenge: Challenge = self.load_challenge(args[0])
-        challenge.claimVictory(winnerId = author.id, force=False)
+        challenge: Challenge = ctx.args["challenge"]
+        challenge.claimVictory(winnerId = ctx.author.id, force=False)
         await self.messenger.claimChallenge(challenge)
 
     @autocompleteDocs
-    @setArgumentNames(player = "you")
     @registerCommand
+    @readOnly
     @ensureRegistered
-    @ensureNumberOfArgumentsIsAtMost(1)
-    async def command_userinfo(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("player", PLAYER, default=None, defaultText="you", description="The player who you want to check out! (default is you)"))
+    async def command_userinfo(self, ctx: CommandContext) -> None:
         """
         gives detailed information about player
         """
-        if len(args) == 1:
-            player = self.parsePlayer(args[0])
-        else:
-            player = Player.getById(author.id)
+        player = ctx.args["player"] if ctx.args["player"] != None else ctx.player
 
         if player == None:
             raise ValueError("Selected user doesn't exist!")
@@ -354,15 +499,17 @@ list of all commands:
         logging.info(f"getting info about player {player.id}")
 
         winrate = player.getGameScore()
-        message = f"{player.getName()} has {player.currentChips} chips! ({player.totalChips} across all periods)\nWinrate is: {winrate[0]}/{winrate[1]}"
+        rating, ratedGames = player.getRating()
+        message = f"{player.getName()} has {player.currentChips} chips! ({player.totalChips} across all periods)\nWinrate is: {winrate[0]}/{winrate[1]}\nRating is: {ratings.formatRating(rating)} ({ratedGames} rated games)"
         
-        await reply(message)
+        await ctx.reply(message)
 
     @autocompleteDocs
     @registerCommand
+    @readOnly
     @ensureRegistered
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_leaderboards(self, args: list[str], author: discord.Member, reply: replyFunction):
+    @arguments()
+    async def command_leaderboards(self, ctx: CommandContext):
         """
         returns list of top 10 players this season and all time
         """
@@ -373,18 +520,98 @@ The top 10 players so far this run are:
 The top 10 players all times are:
 """ + "\n".join([f'{i+1}. {player.getName()} with {player.totalChips} chips' for i, player in enumerate(Player.getTopPlayersAllTime(10))])
         
-        await reply(message)
+        await ctx.reply(message)
     
     @autocompleteDocs
     @registerCommand
-    @setArgumentNames("challenge")
+    @readOnly
     @ensureRegistered
-    @ensureNumberOfArgumentsIsExactly(1)
-    async def command_gameinfo(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("count", INT, default=10, minValue=1))
+    async def command_ratings(self, ctx: CommandContext) -> None:
+        """
+        returns list of players with the highest Elo rating
+        """
+        top = Player.getTopRatedPlayers(min(ctx.args["count"], 25))
+        if len(top) == 0:
+            await ctx.reply("Nobody has a rating yet!")
+            return
+        await ctx.reply(f"The top {len(top)} players by rating are:\n" + "\n".join([f'{i+1}. {player.getName()} with rating {ratings.formatRating(rating)} ({games} games)' for i, (player, rating, games) in enumerate(top)]))
+
+    @autocompleteDocs
+    @registerCommand
+    @readOnly
+    @ensureRegistered
+    @arguments(
+        Arg("player", PLAYER, default=None, defaultText="you", description="The player whose wins you want to see."),
+        Arg("map", choices=MAP_OPTIONS, default=None, defaultText="any"),
+        Arg("tribe", choices=TRIBE_OPTIONS, default=None, defaultText="any")
+    )
+    async def command_stats(self, ctx: CommandContext) -> None:
+        """
+        returns on which maps and with which tribes a player wins, and how often creators win there overall
+        """
+        player: Player = ctx.args["player"] if ctx.args["player"] != None else cast(Player, ctx.player)
+        mapName, tribe = ctx.args["map"], ctx.args["tribe"]
+        db = Player.getDb()
+
+        played = db.getPlayerMapTribeStats(player.id, mapName, tribe)
+        if len(played) == 0:
+            await ctx.reply(f"{player.getName()} hasn't finished any such game yet!")
+            return
+        message = f"{player.getName()} won:\n" + "\n".join([f"{map}, {tribe}: {mapStats.formatWinrate(wins, games)}" for map, tribe, games, wins in played])
+
+        overall = db.getMapTribeStats(mapName, tribe, limit=5)
+        message += "\n\nMost played overall (wins of creators):\n" + "\n".join([f"{map}, {tribe}: {mapStats.formatWinrate(authorWins, games)}" for map, tribe, games, authorWins in overall])
+        await ctx.reply(message)
+
+    @autocompleteDocs
+    @registerCommand
+    @readOnly
+    @ensureRegistered
+    @arguments(Arg("player", PLAYER, default=None, defaultText="everyone", description="The player whose past seasons you want to see."))
+    async def command_seasons(self, ctx: CommandContext) -> None:
+        """
+        returns results of past seasons, or of one player in them
+        """
+        # past seasons are read from their archive, never from the live database
+        seasons = seasonArchive.Season.loadAll(self.seasonsDirectory())
+        if len(seasons) == 0:
+            await ctx.reply("No season has ended yet!")
+            return
+
+        player: Optional[Player] = ctx.args["player"]
+        lines = []
+        for season in seasons:
+            if player == None:
+                summary = season.summary()
+                top = "nobody"
+                if summary["topPlayer"] != None:
+                    topId, topChips = summary["topPlayer"]
+                    # the archive outlives players, who may have been deleted since
+                    topPlayer = Player.getById(topId)
+                    top = f"{topPlayer.getName() if topPlayer != None else f'<@{topId}>'} with {topChips} chips"
+                lines.append(f"Season {season.season}: {summary['finished']} games ({summary['aborted']} aborted), {summary['chipsBet']} chips bet, mostly on {summary['topMap'] or 'no map'}. Best was {top}")
+            else:
+                playerSummary = season.playerSummary(player.id)
+                if playerSummary != None:
+                    lines.append(f"Season {season.season}: {playerSummary['rank']}. of {playerSummary['players']} with {playerSummary['chips']} chips, won {playerSummary['wins']}/{playerSummary['games']}")
+
+        if len(lines) == 0:
+            await ctx.reply(f"{cast(Player, player).getName()} didn't play in any past season.")
+            return
+        title = "Past seasons" if player == None else f"Past seasons of {cast(Player, player).getName()}"
+        await ctx.reply(f"{title}:\n" + "\n".join(lines[-20:]))
+
+    @autocompleteDocs
+    @registerCommand
+    @readOnly
+    @ensureRegistered
+    @arguments(Arg("challenge", CHALLENGE, description="Id of the game you're interested in."))
+    async def command_gameinfo(self, ctx: CommandContext) -> None:
         """
         return detailed information about challenge
         """
-        challenge = self.load_challenge(args[0])
+        challenge: Challenge = ctx.args["challenge"]
         message = f"""### Challenge {challenge.id}
 by {cast(Player, Player.getById(challenge.authorId)).getName()}
 accepted by {cast(Player, Player.getById(challenge.acceptedBy)).getName() if challenge.acceptedBy != None else 'TBD'}
@@ -399,7 +626,7 @@ Winner: {cast(Player, Player.getById(challenge.winner)).getName() if challenge.w
 
 State: {challenge.state.name}
         """
-        await reply(message)
+        await ctx.reply(message)
 
         
 
@@ -409,37 +636,31 @@ State: {challenge.state.name}
     """
     @autocompleteDocs
     @registerCommand
-    @setArgumentNames("challenge")
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(1)
-    async def command_forceabort(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("challenge", CHALLENGE))
+    async def command_forceabort(self, ctx: CommandContext) -> None:
         """
         force abort challenge. This takes away winning from the winner
         """
-        challenge: Challenge = self.load_challenge(args[0])
+        challenge: Challenge = ctx.args["challenge"]
         # if someone has already won before, we need to take away his win
 
         if challenge.winner != None:
             challenge.unwin()
 
-        challenge.abort(byPlayer = author.id, force=True)
+        challenge.abort(byPlayer = ctx.author.id, force=True)
         await self.messenger.abortChallenge(challenge)
 
     @autocompleteDocs
     @registerCommand
-    @setArgumentNames("challenge", "winner")
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(2)
-    async def command_forcewin(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("challenge", CHALLENGE), Arg("winner", PLAYER))
+    async def command_forcewin(self, ctx: CommandContext) -> None:
         """
         force set winner of a challenge
         """
-        player = self.parsePlayer(args[1])
-        if player == None:
-            raise ValueError("Given player isn't registered!")
-        player = cast(Player, player)
-
-        challenge: Challenge = self.load_challenge(args[0])
+        player: Player = ctx.args["winner"]
+        challenge: Challenge = ctx.args["challenge"]
         
         # if someone has already won before, we need to take away his win
         if challenge.winner != None:
@@ -450,56 +671,64 @@ State: {challenge.state.name}
 
     @autocompleteDocs
     @registerCommand
-    @setArgumentNames("player", "chips")
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(2)
-    async def command_addchips(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("player", PLAYER, description="The player who you want to give chips to."), Arg("chips", INT, description="How many chips to give."))
+    async def command_addchips(self, ctx: CommandContext) -> None:
         """
         give a player some amount of chips (or take it away if chips is negative)
         """
-        player = self.parsePlayer(args[0])
-
-        if player == None:
-            raise ValueError("Given player isn't registered!")
-        
-        player = cast(Player, player)
-
-        amount = int(args[1])
-        player.adjustChips(amount)
+        player: Player = ctx.args["player"]
+        player.adjustChips(ctx.args["chips"])
 
     @autocompleteDocs
     @registerCommand
+    @readOnly
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_rankteams(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("period", choices=["alltime", "season"], default="alltime", description="rank by chips of all seasons or of this one"))
+    async def command_rankteams(self, ctx: CommandContext) -> None:
         """
         create leaderboards by teams
         """
-        points = {role: {"value": 0, "players": 0} for role in TEAM_ROLES}
+        # teams are synced from role events, so the sums are done by the database
+        standings = {team: (season, allTime, players) for team, season, allTime, players in Player.getTeamStandings()}
+        column = 0 if ctx.args["period"] == "season" else 1
 
-        roleList: list[discord.Guild] = [cast(discord.Guild, i) for i in [self.bot.guild.get_role(roleId) for roleId in TEAM_ROLES] if i != None]
-        for player in Player.getAll():
-            member = self.bot.guild.get_member(player.id)
-            if member == None:
-                logging.error(f"Can't find member {player.id}")
-                continue
-            for role in roleList:
-                if role in cast(discord.Member,member).roles:
-                    points[role.id]["value"] += player.totalChips
-                    points[role.id]["players"] += 1
-
-        roleList.sort(key=lambda role: points[role.id]["value"], reverse=True)
+        roleList = [role for role in [self.guild.get_role(roleId) for roleId in Player.getTeamRoles()] if role != None]
+        roleList.sort(key=lambda role: standings.get(role.id, (0, 0, 0))[column], reverse=True)
 
-        message = f"Top teams all time are:\n" + "\n".join([f'{i+1}. {team.name} --- {points[team.id]["value"]} [with {points[team.id]["players"]} players]' for i, team in enumerate(roleList)])
-        await reply(message)
+        title = "this season" if column == 0 else "all time"
+        message = f"Top teams {title} are:\n" + "\n".join([f'{i+1}. {team.name} --- {standings.get(team.id, (0, 0, 0))[column]} [with {standings.get(team.id, (0, 0, 0))[2]} players]' for i, team in enumerate(roleList)])
+        await ctx.reply(message)
 
     """
     TECHNICAL COMMANDS
     """
+    @autocompleteDocs
+    @registerCommand
+    @ensureAdmin
+    @arguments()
+    async def command_recomputeratings(self, ctx: CommandContext) -> None:
+        """
+        recomputes ratings of all players from the whole match history
+        """
+        games = ratings.recomputeAll(Player.getDb())
+        await ctx.reply(f"Ratings recomputed from {games} games.")
+
+    @autocompleteDocs
+    @registerCommand
+    @ensureAdmin
+    @arguments()
+    async def command_rebuildstats(self, ctx: CommandContext) -> None:
+        """
+        recounts map and tribe statistics from the whole match history
+        """
+        mapStats.rebuild(Player.getDb())
+        await ctx.reply("Map and tribe statistics rebuilt.")
+
     @registerCommand
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_freeze(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments()
+    async def command_freeze(self, ctx: CommandContext) -> None:
         """
         freezes "registered user" commands
         """
@@ -507,8 +736,8 @@ State: {challenge.state.name}
 
     @registerCommand
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_unfreeze(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments()
+    async def command_unfreeze(self, ctx: CommandContext) -> None:
         """
         unfreezes "registered user" commands
         """
@@ -516,38 +745,141 @@ State: {challenge.state.name}
 
     @registerCommand
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_resetchips(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments()
+    async def command_resetchips(self, ctx: CommandContext) -> None:
         """
-        reset all current season chips
+        archives the season which just ended and resets all current season chips
         """
+        season = seasonArchive.archiveCurrentSeason(Player.getDb(), self.seasonsDirectory())
         Player.resetAllPlayersCurrentChips()
+        await ctx.reply(f"Season {season.season} archived, chips reset.")
 
     @registerCommand
-    @setArgumentNames("chips")
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(1)
-    async def command_giveeveryonemidroundchips(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("chips", INT))
+    async def command_giveeveryonemidroundchips(self, ctx: CommandContext) -> None:
         """
         give all players some amount of chips (or take it away if chips is negative)
         """
-        chips = int(args[0])
+        Player.giveAllPlayersChips(ctx.args["chips"])
 
-        Player.giveAllPlayersChips(chips)
+    @registerCommand
+    @readOnly
+    @ensureAdmin
+    @arguments(Arg("filters", rest=True, default=[], defaultText="none"))
+    async def command_dumplogs(self, ctx: CommandContext) -> None:
+        """
+        sends command logs matching all given filters (gzipped JSON lines). Filters are since=[time], until=[time], user=[user], challenge=[challenge] and command=[command name], where time is either a date like 2024-05-01 or 2024-05-01T18:00, or how long ago like 6h or 2d
+        """
+        filters: dict[str, Any] = {}
+        for arg in ctx.args["filters"]:
+            key, separator, value = arg.partition("=")
+            key = key.lower()
+            if separator == "" or value == "":
+                raise ValueError(f"Filter '{arg}' should look like key=value!")
+            if key in ("since", "until"):
+                filters[key] = self.parseTime(value)
+            elif key == "user" and value.isdecimal():
+                filters[key] = self.parseId(value)
+            elif key == "user":
+                player = self.parsePlayer(value)
+                if player == None:
+                    raise ValueError(f"Unknown user '{value}'!")
+                filters[key] = cast(Player, player).id
+            elif key == "challenge":
+                filters[key] = self.parseId(value)
+            elif key == "command":
+                filters[key] = value.lower()
+            else:
+                raise ValueError(f"Unknown filter '{key}'! Use since, until, user, challenge or command.")
+
+        # make sure the latest commands are in the file, they may be buffered by the gateway
+        await self.messenger.flushLogs()
+        loop = asyncio.get_running_loop()
+
+        fd, path = tempfile.mkstemp(prefix="commandlog-", suffix=".jsonl.gz")
+        os.close(fd)
+        try:
+            count = await loop.run_in_executor(None, functools.partial(commandLog.query, path, **filters))
+            if count == 0:
+                await ctx.reply("No logged commands match given filters.")
+                return
+            if os.path.getsize(path) > MAX_ATTACHMENT_BYTES:
+                await ctx.reply(f"{count} logged commands match, which is too much to send. Please narrow the filters.")
+                return
+            await ctx.author.send(f"{count} logged commands", file=discord.File(path, filename="commandlog.jsonl.gz"))
+        finally:
+            os.remove(path)
+
+    @registerCommand
+    @readOnly
+    @ensureAdmin
+    @arguments(Arg("table", choices=export.TABLES), Arg("format", choices=export.FORMATS, default="csv"), Arg("filters", rest=True, default=[], defaultText="none"))
+    async def command_export(self, ctx: CommandContext) -> None:
+        """
+        sends rows of challenges, players or ledger (gzipped CSV or JSON lines). Challenges can be filtered by state=[states], season=[season], since=[time] and until=[time], where states are separated by commas and time is either a date like 2024-05-01 or how long ago like 6h or 2d
+        """
+        table, format = ctx.args["table"], ctx.args["format"]
+        filters: dict[str, Any] = {}
+        for arg in ctx.args["filters"]:
+            key, separator, value = arg.partition("=")
+            key = key.lower()
+            if separator == "" or value == "":
+                raise ValueError(f"Filter '{arg}' should look like key=value!")
+            if key == "state":
+                filters["states"] = export.parseStates(value)
+            elif key == "season":
+                filters[key] = self.parseId(value)
+            elif key in ("since", "until"):
+                filters[key] = self.parseTime(value)
+            else:
+                raise ValueError(f"Unknown filter '{key}'! Use state, season, since or until.")
+
+        tenant = tenantModule.getCurrent()
+        config = tenant.config if tenant != None else tenantModule.GuildConfig.default()
+
+        # the export streams through its own connection in another thread, so the event loop isn't blocked
+        fd, path = tempfile.mkstemp(prefix=f"{table}-", suffix=f".{format}.gz")
+        os.close(fd)
+        try:
+            loop = asyncio.get_running_loop()
+            count = await loop.run_in_executor(None, functools.partial(export.export, config.databaseFile, path, table, format, seasonsDirectory=config.seasonsDirectory, **filters))
+            if count == 0:
+                await ctx.reply("No rows match given filters.")
+                return
+            if os.path.getsize(path) > MAX_ATTACHMENT_BYTES:
+                await ctx.reply(f"{count} rows match, which is too much to send. Please narrow the filters or use export.py on the server.")
+                return
+            await ctx.author.send(f"{count} rows of {table}", file=discord.File(path, filename=f"{table}.{format}.gz"))
+        finally:
+            os.remove(path)
 
     @registerCommand
+    @readOnly
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_dumplogs(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments(Arg("count", INT, default=5, minValue=1))
+    async def command_slowtraces(self, ctx: CommandContext) -> None:
         """
-        dumps all command logs
+        shows the slowest recently traced commands and where they spent the time
         """
-        await author.send(file=discord.File(self.logFile.name))
+        count: int = ctx.args["count"]
+
+        # traces are logged, those of a worker are written by the gateway
+        await self.messenger.flushLogs()
+        loop = asyncio.get_running_loop()
+        traces = await loop.run_in_executor(None, functools.partial(tracing.slowestTraces, count))
+        if len(traces) == 0:
+            await ctx.reply("No traces recorded yet.")
+            return
+
+        for trace in traces:
+            await ctx.reply(tracing.formatTrace(trace)[:2000])
 
     @registerCommand
+    @readOnly
     @ensureAdmin
-    @ensureNumberOfArgumentsIsExactly(0)
-    async def command_getlistofplayerswithunfinishedgames(self, args: list[str], author: discord.Member, reply: replyFunction) -> None:
+    @arguments()
+    async def command_getlistofplayerswithunfinishedgames(self, ctx: CommandContext) -> None:
         """
         sends a message which pings everyone who has a game in progress
         """
@@ -561,7 +893,7 @@ State: {challenge.state.name}
 
 
         message = "player who have unfinished games:\n"+("\n".join([f"<@{id}>" for id in allPlayerToPing]))
-        await reply(message)
+        await ctx.reply(message)
 
         
 
@@ -580,6 +912,13 @@ State: {challenge.state.name}
         
         return cast(Challenge, challenge)
 
+    def seasonsDirectory(self) -> str:
+        """
+        returns directory with archived seasons of the current tenant
+        """
+        tenant = tenantModule.getCurrent()
+        return tenant.config.seasonsDirectory if tenant != None else SEASONS_DIRECTORY
+
     def parseId(self, id: str) -> int:
         """
         returns parsed id.
@@ -592,21 +931,43 @@ State: {challenge.state.name}
         except ValueError:
             raise ValueError(f"ID '{id}' should be a number!")
         
+    def parseTime(self, value: str) -> float:
+        """
+        returns timestamp of a date (2024-05-01, 2024-05-01T18:00) or of a time some hours or days ago (6h, 2d)
+
+        Raises:
+            ValueError - value is neither
+        """
+        units = {"h": 60 * 60, "d": 24 * 60 * 60}
+        if value[-1:].lower() in units and value[:-1].isdecimal():
+            return time.time() - int(value[:-1]) * units[value[-1:].lower()]
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            raise ValueError(f"Time '{value}' should be a date like 2024-05-01 or 2024-05-01T18:00, or how long ago like 6h or 2d!")
+
     def parsePlayer(self, idOrName: str) -> Optional[Player]:
         """
         returns user from discord.
 
-        idOrName can either represend ID of the user, or their name in bot's guild
+        idOrName can either represend ID of the user, or their name or nick in bot's guild (case-insensitive, small typos are forgiven)
         """
         
         # it's number
         if idOrName.isdecimal():
-            player = Player.getById(self.parseId(idOrName))
+            return Player.getById(self.parseId(idOrName))
         
-        # it's player name
-        else:
-            member = self.bot.guild.get_member_named(idOrName)
-            print(member)
-            player = Player.getById(cast(discord.Member, member).id) if member != None else None
-
+        # it's player name, registered players are indexed
+        playerId = self.players.resolve(idOrName)
+        if playerId != None:
+            return Player.getById(playerId)
+
+        # the index may miss players registered by another process, discord knows them
+        member = self.guild.get_member_named(idOrName)
+        if member == None:
+            return None
+        member = cast(discord.Member, member)
+        player = Player.getById(member.id)
+        if player != None:
+            self.players.setMember(member.id, member.name, member.display_name)
         return player
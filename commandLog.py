@@ -0,0 +1,264 @@
+from __future__ import annotations
+from typing import Optional, Any, Iterator
+from bisect import bisect_left, bisect_right
+import gzip
+import json
+import logging
+import os
+import time
+
+from constants import COMMAND_LOG_FILE
+from commandDecorators import getArgumentNames, plainValues
+import asyncLogging
+
+
+"""
+Structured command log.
+
+Every evaluated command is one JSON line in COMMAND_LOG_FILE. Next to each log file (current and rotated ones) lies
+a sidecar index (log path + ".idx") with one line per record - its byte offset, time, user, command and challenge IDs -
+so slices of the log can be found without parsing the log itself.
+"""
+
+INDEX_SUFFIX = ".idx"
+
+
+def makeEntry(args: list[str], userId: Optional[int], userName: Optional[str], guildId: int, source: Any) -> dict[str, Any]:
+    """
+    returns log entry of a command with given (already split) args
+    """
+    commandName = args[0].lower() if len(args) > 0 else ""
+    challenges = []
+    for name, value in zip(getArgumentNames(commandName), args[1:]):
+        if name == "challenge" and value.isdecimal():
+            challenges.append(int(value))
+
+    return {
+        "time": round(time.time(), 3),
+        "guild": guildId,
+        "source": source,
+        "user": userId,
+        "userName": userName,
+        "command": commandName,
+        "challenges": challenges,
+        "args": args,
+    }
+
+def makeStructuredEntry(commandName: str, values: dict[str, Any], userId: Optional[int], userName: Optional[str], guildId: int, source: Any) -> dict[str, Any]:
+    """
+    returns log entry of a command run with typed arguments by name (e.g. a slash command)
+    """
+    values = plainValues(values)
+    challenge = values.get("challenge")
+    challenges = [int(challenge)] if challenge != None and str(challenge).isdecimal() else []
+
+    return {
+        "time": round(time.time(), 3),
+        "guild": guildId,
+        "source": source,
+        "user": userId,
+        "userName": userName,
+        "command": commandName,
+        "challenges": challenges,
+        "args": [commandName],
+        "values": values,
+    }
+
+
+class CommandLogHandler(asyncLogging.RotatingBatchFileHandler):
+    """
+    Writes records carrying an "entry" as JSON lines and keeps their sidecar index. Should only be used by LogWriter.
+    """
+    def _open(self) -> None:
+        self.stream = open(self.path, "ab")
+        self.index = open(self.path + INDEX_SUFFIX, "ab")
+        self.openedAt = time.time()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            entry = getattr(record, "entry", None)
+            if entry == None:
+                entry = {"time": round(record.created, 3), "message": record.getMessage()}
+
+            line = (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+            offset = self.stream.tell()
+            self.stream.write(line)
+            self.index.write(_formatIndexLine(offset, entry).encode("utf-8"))
+            self.pendingBytes += len(line)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        super().flush()
+        self.index.flush()
+
+    def rotated(self, backupPath: str) -> None:
+        self.index.close()
+        os.replace(self.path + INDEX_SUFFIX, backupPath + INDEX_SUFFIX)
+
+    def removeBackup(self, backupPath: str) -> None:
+        super().removeBackup(backupPath)
+        if os.path.exists(backupPath + INDEX_SUFFIX):
+            os.remove(backupPath + INDEX_SUFFIX)
+
+    def close(self) -> None:
+        self.index.close()
+        super().close()
+
+
+def _formatIndexLine(offset: int, entry: dict[str, Any]) -> str:
+    user = entry.get("user")
+    challenges = ",".join(str(challenge) for challenge in entry.get("challenges", []))
+    return f"{offset}\t{entry.get('time', 0)}\t{user if user != None else ''}\t{entry.get('command', '')}\t{challenges}\n"
+
+
+class CommandLogIndex:
+    """
+    Parsed sidecar index of one log file. It is extended incrementally as the log grows, so repeated queries only read new lines.
+    """
+    def __init__(self, indexPath: str):
+        self.indexPath = indexPath
+        self.clear()
+
+    def clear(self) -> None:
+        self.inode: Optional[int] = None
+        self.readUpTo = 0
+        # columns, one item per record, ordered by time
+        self.offsets: list[int] = []
+        self.times: list[float] = []
+        self.users: list[Optional[int]] = []
+        self.commands: list[str] = []
+        # positions of records of each user / challenge / command
+        self.byUser: dict[int, list[int]] = {}
+        self.byChallenge: dict[int, list[int]] = {}
+        self.byCommand: dict[str, list[int]] = {}
+
+    def refresh(self) -> None:
+        """
+        Reads lines added to the index since the last refresh (or all of them if the file has been replaced).
+        """
+        try:
+            stat = os.stat(self.indexPath)
+        except FileNotFoundError:
+            self.clear()
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.readUpTo:
+            self.clear()
+            self.inode = stat.st_ino
+        if stat.st_size == self.readUpTo:
+            return
+
+        with open(self.indexPath, "rb") as file:
+            file.seek(self.readUpTo)
+            data = file.read()
+        # the writer may be in the middle of a line
+        data = data[:data.rfind(b"\n") + 1]
+        self.readUpTo += len(data)
+
+        for line in data.decode("utf-8").splitlines():
+            offset, recordTime, user, command, challenges = line.split("\t")
+            position = len(self.offsets)
+            self.offsets.append(int(offset))
+            self.times.append(float(recordTime))
+            self.users.append(int(user) if user != "" else None)
+            self.commands.append(command)
+            if user != "":
+                self.byUser.setdefault(int(user), []).append(position)
+            self.byCommand.setdefault(command, []).append(position)
+            for challenge in challenges.split(","):
+                if challenge != "":
+                    self.byChallenge.setdefault(int(challenge), []).append(position)
+
+    def find(self, since: Optional[float] = None, until: Optional[float] = None, user: Optional[int] = None, challenge: Optional[int] = None, command: Optional[str] = None) -> list[int]:
+        """
+        returns byte offsets of records matching all given filters, in order
+        """
+        first = bisect_left(self.times, since) if since != None else 0
+        last = bisect_right(self.times, until) if until != None else len(self.times)
+        if first >= last:
+            return []
+
+        # start from the most selective posting list, the rest is checked directly
+        candidates: list[list[int]] = []
+        if user != None:
+            candidates.append(self.byUser.get(user, []))
+        if challenge != None:
+            candidates.append(self.byChallenge.get(challenge, []))
+        if command != None:
+            candidates.append(self.byCommand.get(command, []))
+
+        if len(candidates) == 0:
+            return self.offsets[first:last]
+
+        positions = min(candidates, key=len)
+        positions = positions[bisect_left(positions, first):bisect_left(positions, last)]
+        inChallenge = set(self.byChallenge.get(challenge, [])) if challenge != None else None
+        return [
+            self.offsets[position] for position in positions
+            if (user == None or self.users[position] == user)
+            and (command == None or self.commands[position] == command)
+            and (inChallenge == None or position in inChallenge)
+        ]
+
+
+# indexes loaded by this process, by path of the index
+_indexes: dict[str, CommandLogIndex] = {}
+
+def _getIndex(logPath: str) -> CommandLogIndex:
+    indexPath = logPath + INDEX_SUFFIX
+    if indexPath not in _indexes:
+        _indexes[indexPath] = CommandLogIndex(indexPath)
+    index = _indexes[indexPath]
+    index.refresh()
+    return index
+
+def _getLogFiles(path: str) -> list[str]:
+    """
+    returns rotated (gzipped) logs of path, oldest first, followed by path itself
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    prefix = os.path.basename(path) + "."
+    backups = [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(prefix) and name.endswith(".gz")]
+    return sorted(backups, key=os.path.getmtime) + [path]
+
+def _readLines(logPath: str, offsets: list[int]) -> Iterator[bytes]:
+    opener = gzip.open if logPath.endswith(".gz") else open
+    with opener(logPath, "rb") as file:
+        for offset in offsets:
+            # offsets are increasing, so gzip only ever decompresses forward
+            file.seek(offset)
+            yield file.readline()
+
+
+def query(outputPath: str, since: Optional[float] = None, until: Optional[float] = None, user: Optional[int] = None, challenge: Optional[int] = None, command: Optional[str] = None, path: str = COMMAND_LOG_FILE) -> int:
+    """
+    Writes records of the command log matching all given filters into outputPath as gzipped JSON lines.
+
+    Returns:
+        number of written records
+    """
+    logFiles = _getLogFiles(path)
+    # forget indexes of backups which have been removed since
+    for indexPath in list(_indexes):
+        if indexPath[:-len(INDEX_SUFFIX)] not in logFiles:
+            del _indexes[indexPath]
+
+    count = 0
+    with gzip.open(outputPath, "wb") as output:
+        for logPath in logFiles:
+            if not os.path.exists(logPath):
+                continue
+            offsets = _getIndex(logPath).find(since=since, until=until, user=user, challenge=challenge, command=command)
+            for line in _readLines(logPath, offsets):
+                output.write(line)
+                count += 1
+    return count
+
+
+def setup(path: str = COMMAND_LOG_FILE) -> None:
+    """
+    Sends "commands" logger into the structured log at path. asyncLogging.setup has to be called first.
+    """
+    commands = logging.getLogger("commands")
+    commands.propagate = False
+    asyncLogging.attach(commands, CommandLogHandler(path))
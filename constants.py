@@ -39,6 +39,78 @@ SPAM_CHANNEL = 1178449202691448942
 CHALLENGES_LIST_CHANNEL = 1170686597746917406
 RULES_CHANNEL = 1178445726062235649
 
+# if True, open challenges are listed on a few pinned messages edited in place instead of one message per challenge
+BOARD_MODE = False
+BOARD_PAGES = 4
+BOARD_CHALLENGES_PER_PAGE = 25 # discord allows at most 25 options in a select
+BOARD_EDIT_DEBOUNCE_SECONDS = 5
+
+SNAPSHOT_FILE = "warmstate.json"
+
+# number of worker processes running commands, 0 runs them in the gateway process
+# worker 0 is the only one writing into the database, the others only run read only commands
+WORKER_PROCESSES = 0
+
+# metrics in Prometheus text format are served on http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+
+# optional JSON list of configs of additional guilds, see tenant.GuildConfig.fromDict
+# if it doesn't exist, only the guild configured above is served
+GUILDS_FILE = "guilds.json"
+SNAPSHOT_INTERVAL_MINUTES = 5
+
+HIGHROLLER_LOG_FILE = "highroller.log"
+COMMAND_LOG_FILE = "commandlog.log"
+# logs are written by a background thread, flushed when this much is buffered or this often
+LOG_FLUSH_BYTES = 64 * 1024
+LOG_FLUSH_INTERVAL_SECONDS = 2
+# log files are rotated (and gzipped) when they get bigger or older than this, only LOG_BACKUP_COUNT newest are kept
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+LOG_BACKUP_COUNT = 20
+
+# finished traces of commands are exported into TRACES_FILE if sampled, or always when they took at least TRACE_ALWAYS_KEEP_SECONDS
+TRACES_FILE = "traces.jsonl"
+TRACE_SAMPLE_RATE = 0.1
+TRACE_ALWAYS_KEEP_SECONDS = 1
+# spans over this limit aren't recorded, so a runaway command can't eat memory
+TRACE_MAX_SPANS = 500
+
+# token buckets limiting commands of each user, as (tokens per second, burst): one for all their commands and one for each command class
+USER_RATE_LIMIT = (1.0, 8)
+COMMAND_CLASS_RATE_LIMITS = {"read": (0.5, 5), "write": (0.5, 5)}
+# at most this many commands run at once, read only commands are turned away once SHED_READ_ONLY_AT are running
+MAX_CONCURRENT_COMMANDS = 32
+SHED_READ_ONLY_AT = 24
+
+# redelivered or repeated events (DMs by message ID, reactions by message, user and emoji) are handled only once within this window
+DEDUP_WINDOW_SECONDS = 15
+DEDUP_MAX_ENTRIES = 10000
+
+# members of registered players are requested (in chunks of MEMBER_QUERY_CHUNK, at most 100) at startup and again once older than MEMBER_CACHE_TTL_SECONDS
+MEMBER_CACHE_TTL_SECONDS = 6 * 60 * 60
+MEMBER_CACHE_REFRESH_MINUTES = 15
+MEMBER_QUERY_CHUNK = 100
+
+# Elo ratings: everybody starts at RATING_START, K of a game is RATING_BASE_K times square root of its bet (at most RATING_MAX_BET_WEIGHT times)
+RATING_START = 1500.0
+RATING_BASE_K = 16
+RATING_MAX_BET_WEIGHT = 4
+RATING_SCALE = 400
+
+# completed seasons are archived here (as column files, one directory per season) when chips are reset
+SEASONS_DIRECTORY = "seasons"
+
+# exports read this many rows from the database at once
+EXPORT_CHUNK_ROWS = 500
+
+# players waiting in the matchmaking queue are dropped after this long
+QUEUE_TIMEOUT_MINUTES = 60
+
+# largest file the bot sends as an attachment
+MAX_ATTACHMENT_BYTES = 25 * 1024 * 1024
+
 ACCEPT_EMOJI = "⚔"
 ABORT_EMOJI = "❌"
 HELPMESSAGE = f"""
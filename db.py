@@ -4,13 +4,28 @@ import sys
 import time
 import os
 
-from typing import Optional, Any, cast
+from typing import Optional, Any, Iterator, cast
 
 import logging
 
+from metrics import timedMethods, databaseCallSeconds, TimedConnection
+from tracing import tracedMethods
+
+@tracedMethods("db")
+@timedMethods(databaseCallSeconds)
 class Database:
-    def __init__(self, name):
-        self.con = sqlite3.connect(name)
+    def __init__(self, name, readOnly: bool = False):
+        """
+        Opens the database and creates all tables.
+
+        A readOnly database refuses all writes and expects the tables to already exist.
+        """
+        if readOnly:
+            self.con = TimedConnection(sqlite3.connect(name))
+            self.con.execute("PRAGMA query_only = 1")
+            return
+
+        self.con = TimedConnection(sqlite3.connect(name))
         self.con.execute("PRAGMA foreign_keys = 1")
 
         self.con.executescript("""
@@ -29,6 +44,8 @@ class Database:
             [notes] TEXT,
             [gameName] TEXT,
             [winner] INTEGER,
+            [finishedAt] INTEGER,
+            [private] INTEGER NOT NULL DEFAULT 0,
             FOREIGN KEY(authorId) REFERENCES players(playerId),
             FOREIGN KEY(acceptedBy) REFERENCES players(playerId),
             FOREIGN KEY(winner) REFERENCES players(playerId)
@@ -40,15 +57,83 @@ class Database:
             [playerId] INTEGER PRIMARY KEY NOT NULL,
             [currentChips] INTEGER check (currentChips >= 0),
             [totalChips] INTEGER check (totalChips >= 0),
-            [abortedGamesTotal] INTEGER
+            [abortedGamesTotal] INTEGER,
+            [team] INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS "ratings"
+        (
+            [playerId] INTEGER PRIMARY KEY NOT NULL,
+            [rating] REAL NOT NULL,
+            [games] INTEGER NOT NULL,
+            FOREIGN KEY(playerId) REFERENCES players(playerId)
+        );
+        CREATE INDEX IF NOT EXISTS [ratingsByRatingIndex] ON "ratings" ([rating]);
+
+        CREATE TABLE IF NOT EXISTS "mapTribeStats"
+        (
+            [map] TEXT NOT NULL,
+            [tribe] TEXT NOT NULL,
+            [games] INTEGER NOT NULL,
+            [authorWins] INTEGER NOT NULL,
+            PRIMARY KEY(map, tribe)
+        );
+        CREATE TABLE IF NOT EXISTS "playerMapTribeStats"
+        (
+            [playerId] INTEGER NOT NULL,
+            [map] TEXT NOT NULL,
+            [tribe] TEXT NOT NULL,
+            [games] INTEGER NOT NULL,
+            [wins] INTEGER NOT NULL,
+            PRIMARY KEY(playerId, map, tribe)
         );
+
+        CREATE TABLE IF NOT EXISTS "meta"
+        (
+            [key] TEXT PRIMARY KEY NOT NULL,
+            [value] INTEGER
+        );
+        INSERT OR IGNORE INTO meta VALUES ('changeCounter', 0);
+
+        CREATE TRIGGER IF NOT EXISTS [countChallengeInserts] AFTER INSERT ON challenges BEGIN UPDATE meta SET value = value + 1 WHERE key = 'changeCounter'; END;
+        CREATE TRIGGER IF NOT EXISTS [countChallengeUpdates] AFTER UPDATE ON challenges BEGIN UPDATE meta SET value = value + 1 WHERE key = 'changeCounter'; END;
+        CREATE TRIGGER IF NOT EXISTS [countChallengeDeletes] AFTER DELETE ON challenges BEGIN UPDATE meta SET value = value + 1 WHERE key = 'changeCounter'; END;
+        CREATE TRIGGER IF NOT EXISTS [countPlayerInserts] AFTER INSERT ON players BEGIN UPDATE meta SET value = value + 1 WHERE key = 'changeCounter'; END;
+        CREATE TRIGGER IF NOT EXISTS [countPlayerUpdates] AFTER UPDATE ON players BEGIN UPDATE meta SET value = value + 1 WHERE key = 'changeCounter'; END;
+        CREATE TRIGGER IF NOT EXISTS [countPlayerDeletes] AFTER DELETE ON players BEGIN UPDATE meta SET value = value + 1 WHERE key = 'changeCounter'; END;
         COMMIT;
         """)
-
-    def createChallenge(self, challangeId: int, messageId: Optional[int], bet: int, authorId: int, acceptedBy: Optional[int], state: Enum, timeout: Optional[int], map: str, tribe: str, notes: str, gameName: Optional[str], winner: Optional[int]) -> None:
-        logging.info(f"creating challenge with params: {challangeId}, {messageId}, {bet}, {authorId}, {acceptedBy}, {state}, {timeout}, {notes}, {gameName}, {winner}")
+        self.addMissingColumns()
+        self.con.execute("CREATE INDEX IF NOT EXISTS [playersByTeamIndex] ON players ([team])")
+        self.con.commit()
+
+    def addMissingColumns(self) -> None:
+        """
+        migrates databases created before a column was added
+        """
+        # table, column, its type
+        added = [
+            # id of the player's team role, NULL if they aren't in a team
+            ("players", "team", "INTEGER"),
+            # unix time the challenge was won, NULL for challenges finished before it was recorded
+            ("challenges", "finishedAt", "INTEGER"),
+            # 1 if the challenge isn't listed anywhere, only joined by its ID
+            ("challenges", "private", "INTEGER NOT NULL DEFAULT 0"),
+        ]
+        for table, column, columnType in added:
+            columns = [row[1] for row in self.con.execute(f"PRAGMA table_info({table})").fetchall()]
+            if column not in columns:
+                logging.info(f"adding {column} column to {table}")
+                self.con.execute(f"ALTER TABLE {table} ADD COLUMN [{column}] {columnType}")
+                if (table, column) == ("challenges", "private"):
+                    # private challenges used to be the open ones without a listing message, hiding a public one of the board is the safer mistake
+                    self.con.execute("UPDATE challenges SET private = 1 WHERE messageId IS NULL AND state = 1") # CREATED
+                self.con.commit()
+
+    def createChallenge(self, challangeId: int, messageId: Optional[int], bet: int, authorId: int, acceptedBy: Optional[int], state: Enum, timeout: Optional[int], map: str, tribe: str, notes: str, gameName: Optional[str], winner: Optional[int], private: bool = False) -> None:
+        logging.info(f"creating challenge with params: {challangeId}, {messageId}, {bet}, {authorId}, {acceptedBy}, {state}, {timeout}, {notes}, {gameName}, {winner}, {private}")
         try:
-            self.con.execute('INSERT INTO challenges VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);', (challangeId, messageId, bet, authorId, acceptedBy, state.value, timeout, map, tribe, notes, gameName, winner))
+            self.con.execute('INSERT INTO challenges (id, messageId, bet, authorId, acceptedBy, state, timeout, map, tribe, notes, gameName, winner, private) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);', (challangeId, messageId, bet, authorId, acceptedBy, state.value, timeout, map, tribe, notes, gameName, winner, int(private)))
             self.con.commit()
 
         except Exception as e:
@@ -56,6 +141,20 @@ class Database:
             logging.error(str(e))
             self.con.rollback()
 
+    def createMatchedChallenge(self, challengeId: int, bet: int, authorId: int, acceptedBy: int, state: Enum, timeout: int, map: str, tribe: str, notes: str) -> None:
+        """
+        creates an already accepted challenge and charges both players in a single transaction
+        """
+        try:
+            self.con.execute('UPDATE players SET currentChips = currentChips - ?, totalChips = totalChips - ? WHERE playerId IN (?, ?)', (bet, bet, authorId, acceptedBy))
+            self.con.execute('INSERT INTO challenges (id, messageId, bet, authorId, acceptedBy, state, timeout, map, tribe, notes, gameName, winner) VALUES (?, NULL, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL);', (challengeId, bet, authorId, acceptedBy, state.value, timeout, map, tribe, notes))
+            self.con.commit()
+        except Exception as e:
+            logging.error(f"Error creating matched challange {challengeId}")
+            logging.error(str(e))
+            self.con.rollback()
+            raise ValueError("The match couldn't be created!")
+
     def getChallengeById(self, challengeId) -> list[Any]:
         return self.con.execute('SELECT * FROM challenges WHERE id = ?;', (challengeId,)).fetchone()
     
@@ -99,6 +198,97 @@ class Database:
             logging.error(str(e))
             self.con.rollback()
 
+    def finishChallenge(self, challengeId: int, finishedState: Enum, winnerId: int, finishedAt: int, bet: int, authorId: int, acceptedBy: Optional[int], map: str, tribe: str) -> None:
+        """
+        marks challenge as won, pays the winner and counts the game into map and tribe statistics in a single transaction
+        """
+        try:
+            self.con.execute('UPDATE challenges SET state = ?, winner = ?, finishedAt = ? WHERE id = ?', (finishedState.value, winnerId, finishedAt, challengeId))
+            self.con.execute('UPDATE players SET currentChips = currentChips + ?, totalChips = totalChips + ? WHERE playerId = ?', (2 * bet, 2 * bet, winnerId))
+            self._countGame(authorId, acceptedBy, winnerId, map, tribe, 1)
+            self.con.commit()
+        except Exception as e:
+            logging.error(f"Error finishing a challange {challengeId}")
+            logging.error(str(e))
+            self.con.rollback()
+
+    def unfinishChallenge(self, challengeId: int, startedState: Enum, winnerId: int, bet: int, authorId: int, acceptedBy: Optional[int], map: str, tribe: str, counted: bool) -> None:
+        """
+        moves won challenge back to startedState, takes the win from the winner and (if the game was counted) removes it from map and tribe statistics in a single transaction
+        """
+        try:
+            self.con.execute('UPDATE challenges SET state = ? WHERE id = ?', (startedState.value, challengeId))
+            self.con.execute('UPDATE players SET currentChips = currentChips - ?, totalChips = totalChips - ? WHERE playerId = ?', (2 * bet, 2 * bet, winnerId))
+            if counted:
+                self._countGame(authorId, acceptedBy, winnerId, map, tribe, -1)
+            self.con.commit()
+        except Exception as e:
+            logging.error(f"Error revoking win of a challange {challengeId}")
+            logging.error(str(e))
+            self.con.rollback()
+
+    def _countGame(self, authorId: int, acceptedBy: Optional[int], winnerId: int, map: str, tribe: str, change: int) -> None:
+        """
+        adds (or with negative change removes) one game to map and tribe statistics, without committing
+        """
+        self.con.execute('''
+            INSERT INTO mapTribeStats VALUES (?, ?, ?, ?)
+            ON CONFLICT(map, tribe) DO UPDATE SET games = games + excluded.games, authorWins = authorWins + excluded.authorWins
+            ''', (map, tribe, change, change if winnerId == authorId else 0))
+        self.con.executemany('''
+            INSERT INTO playerMapTribeStats VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(playerId, map, tribe) DO UPDATE SET games = games + excluded.games, wins = wins + excluded.wins
+            ''', [(playerId, map, tribe, change, change if playerId == winnerId else 0) for playerId in (authorId, acceptedBy) if playerId != None])
+
+    def rebuildMapTribeStats(self, finishedState: Enum) -> None:
+        """
+        recounts map and tribe statistics from all won challenges in a single transaction
+        """
+        try:
+            self.con.execute('DELETE FROM mapTribeStats')
+            self.con.execute('DELETE FROM playerMapTribeStats')
+            self.con.execute('''
+                INSERT INTO mapTribeStats
+                SELECT map, tribe, COUNT(*), SUM(winner = authorId) FROM challenges
+                WHERE state = ? AND winner IS NOT NULL GROUP BY map, tribe
+                ''', (finishedState.value,))
+            self.con.execute('''
+                INSERT INTO playerMapTribeStats
+                SELECT playerId, map, tribe, COUNT(*), SUM(winner = playerId) FROM (
+                    SELECT authorId AS playerId, map, tribe, winner FROM challenges WHERE state = ? AND winner IS NOT NULL
+                    UNION ALL
+                    SELECT acceptedBy, map, tribe, winner FROM challenges WHERE state = ? AND winner IS NOT NULL AND acceptedBy IS NOT NULL
+                ) GROUP BY playerId, map, tribe
+                ''', (finishedState.value, finishedState.value))
+            self.con.commit()
+        except Exception as e:
+            logging.error(f"Error rebuilding map and tribe statistics")
+            logging.error(str(e))
+            self.con.rollback()
+
+    def getMapTribeStats(self, map: Optional[str] = None, tribe: Optional[str] = None, limit=10) -> list[list[Any]]:
+        """
+        returns (map, tribe, games, wins of authors) of the most played combinations matching given map and tribe (None matches any)
+        """
+        return self.con.execute('''
+            SELECT map, tribe, games, authorWins FROM mapTribeStats
+            WHERE (?1 IS NULL OR map = ?1) AND (?2 IS NULL OR tribe = ?2) AND games > 0
+            ORDER BY games DESC LIMIT ?3
+            ''', (map, tribe, limit)).fetchall()
+
+    def getPlayerMapTribeStats(self, playerId: int, map: Optional[str] = None, tribe: Optional[str] = None, limit=10) -> list[list[Any]]:
+        """
+        returns (map, tribe, games, wins) of combinations the player played most, matching given map and tribe (None matches any)
+        """
+        return self.con.execute('''
+            SELECT map, tribe, games, wins FROM playerMapTribeStats
+            WHERE playerId = ?1 AND (?2 IS NULL OR map = ?2) AND (?3 IS NULL OR tribe = ?3) AND games > 0
+            ORDER BY games DESC LIMIT ?4
+            ''', (playerId, map, tribe, limit)).fetchall()
+
+    def hasMapTribeStats(self) -> bool:
+        return self.con.execute('SELECT 1 FROM mapTribeStats LIMIT 1').fetchone() != None
+
     def getNewIdForChallenge(self) -> int:
         while True:
             newId = int.from_bytes(os.urandom(4))
@@ -110,17 +300,41 @@ class Database:
     def getChallengesByState(self, state: Enum) -> list[list[Any]]:
         return self.con.execute('SELECT * FROM challenges WHERE state = ?', (state.value, )).fetchall()
 
-    def getTimeoutedChallengesByStateAndTimeoutTime(self, state: Enum, timeoutTime: int) -> list[list[Any]]:
-        return self.con.execute('SELECT * FROM challenges WHERE state = ? AND timeout <= ?', (state.value, timeoutTime)).fetchall()
 
 
 
 
 
+    def abortTimeoutedChallenges(self, createdState: Enum, abortedState: Enum, timeoutTime: int) -> list[list[Any]]:
+        """
+        aborts all challenges in createdState which timeout before timeoutTime and refunds their authors in a single transaction
 
-    def createPlayer(self, playerId, currentChips, totalChips, abortedGames) -> None:
+        returns the aborted challenges (as they were before aborting)
+        """
         try:
-            self.con.execute('INSERT INTO players VALUES (?, ?, ?, ?);', (playerId, currentChips, totalChips, abortedGames))
+            challenges = self.con.execute('SELECT * FROM challenges WHERE state = ? AND timeout <= ?', (createdState.value, timeoutTime)).fetchall()
+            if len(challenges) == 0:
+                return []
+
+            self.con.execute('''
+                UPDATE players SET
+                    currentChips = currentChips + (SELECT SUM(bet) FROM challenges WHERE authorId = players.playerId AND state = ? AND timeout <= ?),
+                    totalChips = totalChips + (SELECT SUM(bet) FROM challenges WHERE authorId = players.playerId AND state = ? AND timeout <= ?)
+                WHERE playerId IN (SELECT authorId FROM challenges WHERE state = ? AND timeout <= ?)
+                ''', (createdState.value, timeoutTime) * 3)
+            self.con.execute('UPDATE challenges SET state = ? WHERE state = ? AND timeout <= ?', (abortedState.value, createdState.value, timeoutTime))
+            self.con.commit()
+            return challenges
+
+        except Exception as e:
+            logging.error(f"Error aborting timeouted challenges")
+            logging.error(str(e))
+            self.con.rollback()
+            return []
+
+    def createPlayer(self, playerId, currentChips, totalChips, abortedGames, team: Optional[int] = None) -> None:
+        try:
+            self.con.execute('INSERT INTO players (playerId, currentChips, totalChips, abortedGamesTotal, team) VALUES (?, ?, ?, ?, ?);', (playerId, currentChips, totalChips, abortedGames, team))
             self.con.commit()
 
         except Exception as e:
@@ -182,6 +396,154 @@ class Database:
     def getAllPlayers(self) -> list[list[Any]]:
         return self.con.execute('SELECT * FROM players').fetchall()
 
+    def getPlayerTeams(self) -> list[list[Any]]:
+        return self.con.execute('SELECT playerId, team FROM players').fetchall()
+
+    def setPlayerTeams(self, teams: list[tuple[int, Optional[int]]]) -> None:
+        """
+        sets team (role id or None) of each given player in a single transaction
+        """
+        try:
+            self.con.executemany('UPDATE players SET team = ? WHERE playerId = ?', [(team, playerId) for playerId, team in teams])
+            self.con.commit()
+        except Exception as e:
+            logging.error(f"Error setting teams of {len(teams)} players")
+            logging.error(str(e))
+            self.con.rollback()
+
+    def getTeamStandings(self) -> list[list[Any]]:
+        """
+        returns (team, chips this season, chips all time, number of players) of every team with a player
+        """
+        return self.con.execute('SELECT team, SUM(currentChips), SUM(totalChips), COUNT(*) FROM players WHERE team IS NOT NULL GROUP BY team').fetchall()
+
+    def getFinishedGames(self, finishedState: Enum) -> list[tuple[int, int, int]]:
+        """
+        returns (winner, loser, bet) of all won challenges in the order they finished (challenges without finish time by their timeout)
+        """
+        return self.con.execute('''
+            SELECT winner, CASE WHEN winner = authorId THEN acceptedBy ELSE authorId END, bet FROM challenges
+            WHERE state = ? AND winner IS NOT NULL AND acceptedBy IS NOT NULL
+            ORDER BY COALESCE(finishedAt, timeout), id
+            ''', (finishedState.value,)).fetchall()
+
+    def getEndedChallenges(self, states: list[Enum], since: Optional[int], until: int) -> list[list[Any]]:
+        """
+        returns (id, bet, authorId, acceptedBy, state, map, tribe, winner, finish time) of challenges in given states which ended
+        since (None for no limit) and before until, challenges without finish time ended at their timeout
+        """
+        return self.con.execute(f'''
+            SELECT id, bet, authorId, acceptedBy, state, map, tribe, winner, COALESCE(finishedAt, timeout) AS endedAt FROM challenges
+            WHERE state IN ({", ".join("?" * len(states))}) AND endedAt >= ? AND endedAt < ?
+            ORDER BY endedAt, id
+            ''', (*[state.value for state in states], since if since != None else 0, until)).fetchall()
+
+    def getStandings(self) -> list[list[Any]]:
+        """
+        returns (playerId, currentChips, totalChips, team) of all players
+        """
+        return self.con.execute('SELECT playerId, currentChips, totalChips, team FROM players').fetchall()
+
+    def streamChallenges(self, states: Optional[list[Enum]] = None, since: Optional[int] = None, until: Optional[int] = None, chunkSize: int = 500) -> tuple[list[str], Iterator[Any]]:
+        """
+        returns column names and an iterator over challenges in given states (None for any) which ended (finished, or timeouted
+        if not finished) since and before until, read in chunks of chunkSize rows
+        """
+        conditions, params = [], []
+        if states != None:
+            conditions.append(f'state IN ({", ".join("?" * len(states))})')
+            params += [state.value for state in states]
+        if since != None:
+            conditions.append('COALESCE(finishedAt, timeout) >= ?')
+            params.append(since)
+        if until != None:
+            conditions.append('COALESCE(finishedAt, timeout) < ?')
+            params.append(until)
+        where = f'WHERE {" AND ".join(conditions)}' if len(conditions) > 0 else ''
+        return self._stream(f'SELECT * FROM challenges {where} ORDER BY id', params, chunkSize)
+
+    def streamTable(self, table: str, chunkSize: int = 500) -> tuple[list[str], Iterator[Any]]:
+        """
+        returns column names and an iterator over all rows of a table, read in chunks of chunkSize rows
+        """
+        if not self.hasTable(table):
+            raise ValueError(f"There is no {table} table!")
+        return self._stream(f'SELECT * FROM [{table}]', [], chunkSize)
+
+    def hasTable(self, table: str) -> bool:
+        return self.con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() != None
+
+    def _stream(self, query: str, params: list[Any], chunkSize: int) -> tuple[list[str], Iterator[Any]]:
+        cursor = self.con.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+
+        def rows() -> Iterator[Any]:
+            while True:
+                chunk = cursor.fetchmany(chunkSize)
+                if len(chunk) == 0:
+                    return
+                yield from chunk
+        return columns, rows()
+
+    def getRating(self, playerId: int) -> Optional[tuple[float, int]]:
+        return self.con.execute('SELECT rating, games FROM ratings WHERE playerId = ?', (playerId,)).fetchone()
+
+    def getTopRatings(self, limit=10) -> list[list[Any]]:
+        return self.con.execute('SELECT playerId, rating, games FROM ratings ORDER BY rating DESC LIMIT ?', (limit,)).fetchall()
+
+    def setRatings(self, ratings: list[tuple[int, float, int]]) -> None:
+        try:
+            self.con.executemany('INSERT OR REPLACE INTO ratings VALUES (?, ?, ?)', ratings)
+            self.con.commit()
+        except Exception as e:
+            logging.error(f"Error setting ratings of {len(ratings)} players")
+            logging.error(str(e))
+            self.con.rollback()
+
+    def replaceRatings(self, ratings: list[tuple[int, float, int]]) -> None:
+        """
+        replaces ratings of all players in a single transaction
+        """
+        try:
+            self.con.execute('DELETE FROM ratings')
+            self.con.executemany('INSERT INTO ratings VALUES (?, ?, ?)', ratings)
+            self.con.commit()
+        except Exception as e:
+            logging.error(f"Error replacing ratings")
+            logging.error(str(e))
+            self.con.rollback()
+
+    def getMetaValue(self, key: str) -> Optional[int]:
+        row = self.con.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row == None else cast(int, row[0])
+
+    def setMetaValue(self, key: str, value: Optional[int]) -> None:
+        try:
+            self.con.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+            self.con.commit()
+        except Exception as e:
+            logging.error(f"Error setting meta value {key}")
+            logging.error(str(e))
+            self.con.rollback()
+
+    def setMetaValues(self, values: dict[str, Optional[int]]) -> None:
+        """
+        sets several meta values in a single transaction
+        """
+        try:
+            self.con.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', list(values.items()))
+            self.con.commit()
+        except Exception as e:
+            logging.error(f"Error setting meta values {', '.join(values)}")
+            logging.error(str(e))
+            self.con.rollback()
+
+    def getChangeCounter(self) -> int:
+        """
+        returns number of row changes ever made to challenges and players, used to detect stale snapshots
+        """
+        return cast(int, self.con.execute("SELECT value FROM meta WHERE key = 'changeCounter'").fetchone()[0])
+
 
             
 
@@ -0,0 +1,73 @@
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Hashable
+from collections import OrderedDict
+import asyncio
+import logging
+import time
+
+from constants import DEDUP_WINDOW_SECONDS, DEDUP_MAX_ENTRIES
+from metrics import duplicateEvents
+
+
+"""
+Idempotent handling of gateway events.
+
+Discord can deliver one event more than once and users double click reactions. Events are handled through a cache keyed
+on what identifies them (message ID of a DM, (message ID, user, emoji) of a reaction), which remembers their outcome for
+DEDUP_WINDOW_SECONDS. A duplicate gets the outcome of the first handling (waiting for it if it's still running) and
+never touches the database or Discord again.
+"""
+
+
+class DedupCache:
+    def __init__(self, windowSeconds: float = DEDUP_WINDOW_SECONDS, maxEntries: int = DEDUP_MAX_ENTRIES):
+        self.windowSeconds = windowSeconds
+        self.maxEntries = maxEntries
+        # key -> (time the event was first seen, its outcome), oldest first
+        self.entries: OrderedDict[Hashable, tuple[float, asyncio.Future]] = OrderedDict()
+
+    def evict(self, now: float) -> None:
+        while len(self.entries) > 0:
+            key, (seenAt, _) = next(iter(self.entries.items()))
+            if now - seenAt < self.windowSeconds and len(self.entries) < self.maxEntries:
+                break
+            del self.entries[key]
+
+    async def once(self, kind: str, key: Hashable, handler: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Runs handler unless an event with the same key was handled within the window, returns its outcome.
+
+        If the handler fails, the event is forgotten, so its redelivery is handled again.
+        """
+        now = time.monotonic()
+        self.evict(now)
+
+        entry = self.entries.get((kind, key))
+        if entry != None:
+            duplicateEvents.inc(event=kind)
+            logging.info(f"duplicate {kind} event {key}, answering with its outcome")
+            return await asyncio.shield(entry[1])
+
+        outcome = asyncio.get_running_loop().create_future()
+        self.entries[(kind, key)] = (now, outcome)
+        try:
+            result = await handler()
+        except BaseException:
+            # the handler may have forgotten the event already and a newer one may be running under the key
+            if self.entries.get((kind, key), (0, None))[1] is outcome:
+                del self.entries[(kind, key)]
+            outcome.set_result(None)
+            raise
+        outcome.set_result(result)
+        return result
+
+    def forget(self, kind: str, key: Hashable) -> None:
+        """
+        Lets the next event with the key be handled again, e.g. because the handler undid what the user did.
+        Duplicates already waiting still get the outcome of the first handling.
+        """
+        self.entries.pop((kind, key), None)
+
+
+# events handled by this (gateway) process
+events = DedupCache()
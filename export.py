@@ -0,0 +1,153 @@
+from __future__ import annotations
+from typing import Optional, Any, Iterator, TextIO
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+
+from constants import ChallengeState, EXPORT_CHUNK_ROWS, SEASONS_DIRECTORY
+from db import Database
+import seasonArchive
+
+
+"""
+Streaming export of challenges, players and (if the database has one) the ledger as CSV or JSON lines.
+
+Rows are read from the database in chunks of EXPORT_CHUNK_ROWS and written straight into the (optionally gzipped)
+output, so memory stays flat however long the history is. Exports are run by the export command, or by running this
+module:
+
+    python export.py db.db challenges --format jsonl --state finished --season 3 -o challenges.jsonl.gz
+"""
+
+TABLES = ["challenges", "players", "ledger"]
+FORMATS = ["csv", "jsonl"]
+
+
+def seasonBounds(db: Database, season: int, seasonsDirectory: str = SEASONS_DIRECTORY) -> tuple[Optional[int], Optional[int]]:
+    """
+    Returns start and end (None if open) of a season, ended seasons are looked up in their archive.
+
+    Raises:
+        ValueError - if the season hasn't started or its archive is missing
+    """
+    current = db.getMetaValue("season") or 1
+    if season == current:
+        return db.getMetaValue("seasonStartedAt"), None
+    directory = seasonArchive.seasonDirectory(seasonsDirectory, season)
+    if season > current or not os.path.exists(directory):
+        raise ValueError(f"Season {season} isn't archived!")
+    archived = seasonArchive.Season.load(directory)
+    return archived.startedAt, archived.endedAt
+
+
+def parseStates(value: str) -> list[ChallengeState]:
+    """
+    returns challenge states given by comma separated names (e.g. finished,aborted)
+
+    Raises:
+        ValueError - if a name isn't a state
+    """
+    states = []
+    for name in value.split(","):
+        if name.strip().upper() not in ChallengeState.__members__:
+            raise ValueError(f"Unknown state '{name}'! Use {', '.join(state.name.lower() for state in ChallengeState)}.")
+        states.append(ChallengeState[name.strip().upper()])
+    return states
+
+
+def selectRows(db: Database, table: str, states: Optional[list[ChallengeState]] = None, season: Optional[int] = None, since: Optional[float] = None, until: Optional[float] = None, seasonsDirectory: str = SEASONS_DIRECTORY) -> tuple[list[str], Iterator[Any]]:
+    """
+    returns column names and an iterator over exported rows of table, filters only apply to challenges
+
+    Raises:
+        ValueError - if the table doesn't exist or can't be filtered, or the season isn't known
+    """
+    if table != "challenges":
+        if states != None or season != None or since != None or until != None:
+            raise ValueError(f"Only challenges can be filtered, not {table}!")
+        return db.streamTable(table, EXPORT_CHUNK_ROWS)
+
+    if season != None:
+        seasonStart, seasonEnd = seasonBounds(db, season, seasonsDirectory)
+        since = max([bound for bound in (since, seasonStart) if bound != None], default=None)
+        until = min([bound for bound in (until, seasonEnd) if bound != None], default=None)
+    return db.streamChallenges(states, int(since) if since != None else None, int(until) if until != None else None, EXPORT_CHUNK_ROWS)
+
+
+def writeRows(output: TextIO, format: str, columns: list[str], rows: Iterator[Any]) -> int:
+    """
+    Writes rows into output as CSV (with a header) or JSON lines.
+
+    Returns:
+        number of written rows
+    """
+    count = 0
+    if format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            output.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def export(databaseFile: str, outputPath: str, table: str, format: str, states: Optional[list[ChallengeState]] = None, season: Optional[int] = None, since: Optional[float] = None, until: Optional[float] = None, seasonsDirectory: str = SEASONS_DIRECTORY) -> int:
+    """
+    Exports rows of a table matching all given filters into outputPath, which is gzipped if it ends with .gz.
+
+    Opens its own read only connection, so it can run in any thread.
+
+    Returns:
+        number of exported rows
+    """
+    db = Database(databaseFile, readOnly=True)
+    try:
+        columns, rows = selectRows(db, table, states, season, since, until, seasonsDirectory)
+        opener = gzip.open if outputPath.endswith(".gz") else open
+        with opener(outputPath, "wt", encoding="utf-8", newline="") as output:
+            return writeRows(output, format, columns, rows)
+    finally:
+        db.con.close()
+
+
+def parseDate(value: str) -> float:
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' should be a date like 2024-05-01 or 2024-05-01T18:00")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streams challenges, players or the ledger out of a database as CSV or JSON lines.")
+    parser.add_argument("database", help="database file")
+    parser.add_argument("table", choices=TABLES)
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--state", type=parseStates, help="comma separated states of exported challenges, e.g. finished,aborted")
+    parser.add_argument("--season", type=int, help="export only challenges which ended in this season")
+    parser.add_argument("--seasons-directory", default=SEASONS_DIRECTORY, help="where ended seasons are archived")
+    parser.add_argument("--since", type=parseDate, help="export only challenges which ended since this date")
+    parser.add_argument("--until", type=parseDate, help="export only challenges which ended before this date")
+    parser.add_argument("-o", "--output", help="output file, gzipped if it ends with .gz (default is standard output)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        startedAt = time.monotonic()
+        if args.output != None:
+            count = export(args.database, args.output, args.table, args.format, args.state, args.season, args.since, args.until, args.seasons_directory)
+        else:
+            columns, rows = selectRows(Database(args.database, readOnly=True), args.table, args.state, args.season, args.since, args.until, args.seasons_directory)
+            count = writeRows(sys.stdout, args.format, columns, rows)
+        print(f"exported {count} rows in {time.monotonic() - startedAt:.1f}s", file=sys.stderr)
+    except ValueError as e:
+        parser.error(str(e))
@@ -0,0 +1,37 @@
+from __future__ import annotations
+import argparse
+import logging
+
+from constants import ChallengeState
+from db import Database
+
+
+"""
+Wins of players by map and tribe, kept in rollup tables updated in the same transaction as each win and revoked win
+(see Database.finishChallenge and Database.unfinishChallenge), so reading them never scans the match history.
+
+Rollups of databases which existed before them are rebuilt from the history, either on startup when they are empty,
+by the rebuildstats command or offline by running this module:
+
+    python mapStats.py db.db
+"""
+
+
+def rebuild(db: Database) -> None:
+    """
+    recounts all rollups from the won challenges
+    """
+    db.rebuildMapTribeStats(ChallengeState.FINISHED)
+    logging.info("rebuilt map and tribe statistics")
+
+
+def formatWinrate(wins: int, games: int) -> str:
+    return f"{wins}/{games} ({round(100 * wins / games)}%)"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds map and tribe statistics of databases from their match history.")
+    parser.add_argument("databases", nargs="+", help="database files")
+    logging.basicConfig(level=logging.INFO)
+    for path in parser.parse_args().databases:
+        rebuild(Database(path))
@@ -0,0 +1,131 @@
+from __future__ import annotations
+from typing import Optional
+from bisect import bisect_right, insort
+import itertools
+import time
+
+from constants import QUEUE_TIMEOUT_MINUTES
+
+
+"""
+Matchmaking queue of players waiting for an opponent.
+
+Each queued player is indexed in a bucket of every (map, tribe) combination they accept. A bucket is a list sorted
+by the lowest accepted bet, so candidates who accept the newcomer's highest bet are found by bisection, the rest of the
+bucket is never looked at.
+
+The queue lives in memory of the process writing into the database (matches create challenges), so it is emptied by
+a restart.
+"""
+
+
+class QueueEntry:
+    """
+    A player waiting in the queue with the bets, maps and tribes they accept.
+    """
+    def __init__(self, playerId: int, minBet: int, maxBet: int, maps: list[str], tribes: list[str], team: int, queuedAt: Optional[float] = None):
+        self.playerId = playerId
+        self.minBet = minBet
+        self.maxBet = maxBet
+        self.maps = maps
+        self.tribes = tribes
+        # index of the team as returned by Player.getTeam, negative if the player isn't in a team
+        self.team = team
+        self.queuedAt = queuedAt if queuedAt != None else time.time()
+
+    def isExpired(self, now: float) -> bool:
+        return now - self.queuedAt >= QUEUE_TIMEOUT_MINUTES * 60
+
+    def canPlay(self, other: QueueEntry) -> bool:
+        """
+        returns if the two players can be matched, regardless of map and tribe
+        """
+        if other.playerId == self.playerId:
+            return False
+        if self.team >= 0 and self.team == other.team:
+            return False
+        return self.minBet <= other.maxBet and other.minBet <= self.maxBet
+
+
+class MatchQueue:
+    """
+    Players waiting for an opponent, indexed by every (map, tribe) they accept.
+    """
+    def __init__(self):
+        self.entries: dict[int, QueueEntry] = {}
+        # (map, tribe) -> (minBet, queuedAt, playerId) of entries accepting it, sorted
+        self.buckets: dict[tuple[str, str], list[tuple[int, float, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, entry: QueueEntry) -> None:
+        """
+        queues a player, replacing their previous entry
+        """
+        self.remove(entry.playerId)
+        self.entries[entry.playerId] = entry
+        for key in itertools.product(entry.maps, entry.tribes):
+            insort(self.buckets.setdefault(key, []), (entry.minBet, entry.queuedAt, entry.playerId))
+
+    def remove(self, playerId: int) -> Optional[QueueEntry]:
+        """
+        removes player from the queue, returns their entry or None if they weren't queued
+        """
+        entry = self.entries.pop(playerId, None)
+        if entry == None:
+            return None
+        item = (entry.minBet, entry.queuedAt, entry.playerId)
+        for key in itertools.product(entry.maps, entry.tribes):
+            bucket = self.buckets[key]
+            del bucket[bisect_right(bucket, item) - 1]
+            if len(bucket) == 0:
+                del self.buckets[key]
+        return entry
+
+    def findMatch(self, entry: QueueEntry) -> Optional[tuple[QueueEntry, int, str, str]]:
+        """
+        Returns (opponent, bet, map, tribe) of the best match of a (not queued) player, or None if nobody fits.
+
+        The opponent is the one waiting the longest of all who fit, the bet is the highest one both accept. Expired entries
+        met on the way are removed.
+        """
+        now = time.time()
+        best: Optional[tuple[QueueEntry, int, str, str]] = None
+        expired: list[int] = []
+        for map, tribe in itertools.product(entry.maps, entry.tribes):
+            bucket = self.buckets.get((map, tribe))
+            if bucket == None:
+                continue
+            # only entries whose lowest bet the newcomer accepts
+            for _, queuedAt, playerId in bucket[:bisect_right(bucket, (entry.maxBet, float("inf"), 0))]:
+                if best != None and queuedAt >= best[0].queuedAt:
+                    continue
+                candidate = self.entries[playerId]
+                if candidate.isExpired(now):
+                    expired.append(playerId)
+                elif entry.canPlay(candidate):
+                    best = (candidate, min(entry.maxBet, candidate.maxBet), map, tribe)
+
+        for playerId in set(expired):
+            self.remove(playerId)
+        return best
+
+
+def parseOptions(value: str, options: list[str], name: str) -> list[str]:
+    """
+    returns options given as "any" or separated by commas
+
+    Raises:
+        ValueError - if one of them isn't a legal option
+    """
+    if value.strip().lower() == "any":
+        return list(options)
+    chosen = []
+    for option in value.split(","):
+        option = option.strip().lower()
+        if option not in options:
+            raise ValueError(f"'{option}' is not a legal {name}. I am sorry :( legal options are:\n{' '.join(options)}")
+        if option not in chosen:
+            chosen.append(option)
+    return chosen
@@ -0,0 +1,99 @@
+from __future__ import annotations
+from typing import Optional, Any, cast
+import asyncio
+import logging
+import time
+
+import discord
+
+from constants import MEMBER_CACHE_TTL_SECONDS, MEMBER_QUERY_CHUNK
+from metrics import memberCacheLookups, discordApiSeconds
+
+
+"""
+Keeps guild members of registered players in the gateway's member cache, so commands don't have to fetch them.
+
+Members of all registered players are requested at startup over the gateway in chunks of MEMBER_QUERY_CHUNK
+(a websocket request, which is much cheaper than one HTTP fetch per member) and requested again once they are older
+than MEMBER_CACHE_TTL_SECONDS. Members which still had to be fetched over HTTP are kept here for the same time.
+"""
+
+
+class MemberCache:
+    """
+    Member lookups of one tenant's guild, counted as hits and misses.
+    """
+    def __init__(self, guild: discord.Guild, ttlSeconds: float = MEMBER_CACHE_TTL_SECONDS):
+        self.guild = guild
+        self.ttlSeconds = ttlSeconds
+        # when members of tracked users (registered players) were last requested, 0 if never
+        self.refreshedAt: dict[int, float] = {}
+        # members fetched over HTTP (these don't get into the guild's cache) with the time they were fetched
+        self.fetched: dict[int, tuple[Any, float]] = {}
+
+    def track(self, userId: int) -> None:
+        """
+        keeps the member of given user warm from now on
+        """
+        self.refreshedAt.setdefault(userId, 0)
+
+    def get(self, userId: int) -> Optional[discord.Member]:
+        """
+        returns the member if it's cached, never calls Discord
+        """
+        member = self.guild.get_member(userId)
+        if member == None and userId in self.fetched:
+            fetchedMember, fetchedAt = self.fetched[userId]
+            if time.monotonic() - fetchedAt < self.ttlSeconds:
+                member = fetchedMember
+            else:
+                del self.fetched[userId]
+        memberCacheLookups.inc(result="hit" if member != None else "miss")
+        return member
+
+    async def fetch(self, userId: int) -> discord.Member:
+        """
+        returns the member, fetching it over HTTP only if it isn't cached
+        """
+        member = self.get(userId)
+        if member != None:
+            return cast(discord.Member, member)
+        with discordApiSeconds.time(call="fetch_member"):
+            member = await self.guild.fetch_member(userId)
+        self.fetched[userId] = (member, time.monotonic())
+        return cast(discord.Member, member)
+
+    async def warm(self, userIds: list[int]) -> list[discord.Member]:
+        """
+        Tracks given users and requests their members in chunks. Returns the members received.
+        """
+        received: list[discord.Member] = []
+        for i in range(0, len(userIds), MEMBER_QUERY_CHUNK):
+            chunk = userIds[i:i + MEMBER_QUERY_CHUNK]
+            try:
+                with discordApiSeconds.time(call="query_members"):
+                    members = await self.guild.query_members(user_ids=chunk, limit=len(chunk), cache=True)
+            except (asyncio.TimeoutError, discord.DiscordException) as e:
+                logging.warning(f"requesting {len(chunk)} members of guild {self.guild.id} failed")
+                logging.warning(str(e))
+                continue
+
+            now = time.monotonic()
+            for userId in chunk:
+                # users who left the guild aren't returned, they aren't requested again before the TTL either
+                self.refreshedAt[userId] = now
+            for member in members:
+                self.fetched.pop(member.id, None)
+            received += members
+        return received
+
+    async def refreshStale(self) -> list[discord.Member]:
+        """
+        Requests members of tracked users which haven't been requested for the TTL. Returns the members received.
+        """
+        now = time.monotonic()
+        stale = [userId for userId, refreshedAt in self.refreshedAt.items() if now - refreshedAt >= self.ttlSeconds]
+        if len(stale) == 0:
+            return []
+        logging.info(f"refreshing {len(stale)} members of guild {self.guild.id}")
+        return await self.warm(stale)
@@ -1,17 +1,27 @@
 from __future__ import annotations
 from typing import Optional, cast
+import asyncio
+import datetime
 import logging
 
 import discord
 
-from constants import ChallengeState, ABORT_EMOJI, ACCEPT_EMOJI
+from constants import ChallengeState, ABORT_EMOJI, ACCEPT_EMOJI, BOARD_MODE
+from board import ChallengeBoard
+from metrics import discordApiSeconds
+from tracing import tracedMethods
+from prefixIndex import PrefixIndex
+from challengeIndex import OpenChallengeIndex
+import asyncLogging
 
 import challenge as challengeModule
 #import Challenge
 import player as playerModule
 #import Player
+import tenant as tenantModule
 
 
+@tracedMethods("messenger")
 class Messenger:
     """
     Object to make sending messages easier.
@@ -20,7 +30,24 @@ class Messenger:
     """
     messageChannel: discord.TextChannel
     spamChannel: discord.TextChannel
-    messages: set[int]
+
+    # messageId of a listing message -> id of the challenge it lists
+    messages: dict[int, int]
+
+    # snapshots of all open (CREATED) challenges by their id, except private ones, which aren't listed anywhere
+    openChallenges: dict[int, challengeModule.Challenge]
+
+    # ids of open challenges, for autocomplete
+    openChallengeIds: PrefixIndex
+
+    # ids of open challenges by map, tribe and bet, for browsing
+    openChallengeIndex: OpenChallengeIndex
+
+    # snapshots of accepted and started challenges by id, by id of each of their players
+    activeChallenges: dict[int, dict[int, challengeModule.Challenge]]
+
+    # pinned messages listing all open challenges, None if not in board mode
+    board: Optional[ChallengeBoard]
 
     @staticmethod
     async def create(messageChannelId: int, spamChannelId: int, bot: discord.Bot) -> Messenger:
@@ -32,7 +59,12 @@ class Messenger:
         messenger.spamChannel: discord.TextChannel = await bot.fetch_channel(spamChannelId) # type: ignore
         messenger.messageChannel: discord.TextChannel = await bot.fetch_channel(messageChannelId) # type: ignore
 
-        messenger.messages =  set()
+        messenger.messages = {}
+        messenger.openChallenges = {}
+        messenger.openChallengeIds = PrefixIndex()
+        messenger.openChallengeIndex = OpenChallengeIndex()
+        messenger.activeChallenges = {}
+        messenger.board = await ChallengeBoard.create(messenger.messageChannel, bot, messenger, challengeModule.Challenge.getDb()) if BOARD_MODE else None
         logging.debug(f"message channel: {messenger.messageChannel} (server: {messenger.messageChannel.guild})")
         return messenger
 
@@ -61,31 +93,198 @@ class Messenger:
         await self._DM(player=playerModule.Player.getById(challenge.acceptedBy), message=message)
 
     async def _deleteChallengeMessage(self, challenge: challengeModule.Challenge) -> None:
+        self._forgetChallenge(challenge)
+        self.challengesChanged()
         if challenge.messageId:
-            message = await self.messageChannel.fetch_message(cast(int, challenge.messageId))
-            self.messages.discard(challenge.messageId)
-            await message.delete()
+            # no need to fetch the message just to delete it
+            with discordApiSeconds.time(call="delete_message"):
+                await self.messageChannel.get_partial_message(cast(int, challenge.messageId)).delete()
+
+    async def _DMBatch(self, messages: list[tuple[int, str]]) -> None:
+        """
+        Sends a batch of DMs given as (playerId, message) pairs.
+
+        Messages for the same player are joined into as few DMs as possible and different players are messaged concurrently.
+        """
+        byPlayer: dict[int, list[str]] = {}
+        for playerId, message in messages:
+            byPlayer.setdefault(playerId, []).append(message)
+
+        async def sendPlayer(playerId: int, playerMessages: list[str]) -> None:
+            # max length of message is 2000 chars
+            chunk = ""
+            for message in playerMessages:
+                if chunk != "" and len(chunk) + len(message) + 2 > 2000:
+                    await self._DM(playerModule.Player.getById(playerId), chunk)
+                    chunk = ""
+                chunk = message if chunk == "" else chunk + "\n\n" + message
+            await self._DM(playerModule.Player.getById(playerId), chunk)
+
+        results = await asyncio.gather(*[sendPlayer(playerId, playerMessages) for playerId, playerMessages in byPlayer.items()], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.warning("Error sending a batched DM")
+                logging.warning(str(result))
+
+    async def _deleteChallengeMessages(self, challenges: list[challengeModule.Challenge]) -> None:
+        """
+        Deletes listing messages of all given challenges, using bulk delete where discord allows it.
+        """
+        for challenge in challenges:
+            self._forgetChallenge(challenge)
+        self.challengesChanged()
+
+        # bulk delete only works for up to 100 messages younger than 14 days
+        bulkLimit = discord.utils.utcnow() - datetime.timedelta(days=14) + datetime.timedelta(minutes=5)
+        messageIds = [cast(int, challenge.messageId) for challenge in challenges if challenge.messageId]
+        recent = [messageId for messageId in messageIds if discord.utils.snowflake_time(messageId) > bulkLimit]
+        old = [messageId for messageId in messageIds if discord.utils.snowflake_time(messageId) <= bulkLimit]
+
+        for i in range(0, len(recent), 100):
+            try:
+                with discordApiSeconds.time(call="delete_messages"):
+                    await self.messageChannel.delete_messages([discord.Object(messageId) for messageId in recent[i: i+100]])
+            except discord.errors.HTTPException as e:
+                logging.warning("Error bulk deleting challenge messages, deleting them one by one")
+                logging.warning(str(e))
+                old += recent[i: i+100]
+
+        for messageId in old:
+            try:
+                with discordApiSeconds.time(call="delete_message"):
+                    await self.messageChannel.get_partial_message(messageId).delete()
+            except discord.errors.NotFound:
+                pass
+
+    def challengesChanged(self) -> None:
+        """
+        Lets the board know the set of open challenges has changed.
+        """
+        if self.board != None:
+            cast(ChallengeBoard, self.board).scheduleUpdate()
+
+    def _rememberChallenge(self, challenge: challengeModule.Challenge) -> None:
+        """
+        Adds a snapshot of an open challenge to the in-memory indexes, unless it's private.
+        """
+        if challenge.private:
+            return
+        self.openChallenges[challenge.id] = challenge
+        self.openChallengeIds.add(str(challenge.id), challenge.id)
+        self.openChallengeIndex.add(challenge.id, challenge.bet, challenge.timeout, challenge.map, challenge.tribe)
+        if challenge.messageId != None:
+            self.messages[cast(int, challenge.messageId)] = challenge.id
+
+    def _forgetChallenge(self, challenge: challengeModule.Challenge) -> None:
+        """
+        Removes a challenge which is no longer open from the in-memory indexes.
+        """
+        self.openChallenges.pop(challenge.id, None)
+        self.openChallengeIds.remove(str(challenge.id), challenge.id)
+        self.openChallengeIndex.remove(challenge.id)
+        if challenge.messageId != None:
+            self.messages.pop(cast(int, challenge.messageId), None)
+
+    def _rememberActive(self, challenge: challengeModule.Challenge) -> None:
+        """
+        Adds a snapshot of an accepted (or started) challenge to the index of active challenges of its players.
+        """
+        for playerId in (challenge.authorId, challenge.acceptedBy):
+            if playerId != None:
+                self.activeChallenges.setdefault(cast(int, playerId), {})[challenge.id] = challenge
+
+    def _forgetActive(self, challenge: challengeModule.Challenge) -> None:
+        for playerId in (challenge.authorId, challenge.acceptedBy):
+            challenges = self.activeChallenges.get(cast(int, playerId))
+            if challenges != None:
+                challenges.pop(challenge.id, None)
+                if len(challenges) == 0:
+                    del self.activeChallenges[cast(int, playerId)]
+
+    def suggestChallenges(self, prefix: str, userId: int, limit: int = 25) -> list[tuple[str, int]]:
+        """
+        Returns up to limit (description, id) pairs of challenges whose id starts with prefix, active challenges of the user first, then open ones.
+
+        Doesn't touch the database.
+        """
+        prefix = prefix.strip()
+        suggestions = [
+            (f"{challenge.id}: your {challenge.state.name.lower()} game, bet {challenge.bet}, {challenge.map}", challenge.id)
+            for challenge in sorted(self.activeChallenges.get(userId, {}).values(), key=lambda challenge: challenge.id)
+            if str(challenge.id).startswith(prefix)
+        ][:limit]
+        for _, challengeId in self.openChallengeIds.search(prefix, limit - len(suggestions)):
+            challenge = self.openChallenges[challengeId]
+            suggestions.append((f"{challenge.id}: open, bet {challenge.bet}, {challenge.map}, {challenge.tribe}", challenge.id))
+        return suggestions
+
+    async def browseChallenges(self, userId: int, teamRole: Optional[int], map: Optional[str] = None, tribe: Optional[str] = None, minBet: int = 1, maxBet: Optional[int] = None, sortBy: str = "bet", limit: int = 10) -> list[challengeModule.Challenge]:
+        """
+        Returns snapshots of up to limit open challenges the user could accept (not their own nor of their team, given by its role id or None)
+        on map with tribe (None matches any) with bet between minBet and maxBet, sorted by bet or by time left.
+
+        Doesn't touch the database.
+        """
+        tenant = tenantModule.getCurrent()
+        teams = cast(tenantModule.Tenant, tenant).teams if tenant != None else {}
+
+        def exclude(challengeId: int) -> bool:
+            authorId = self.openChallenges[challengeId].authorId
+            return authorId == userId or (teamRole != None and teams.get(authorId) == teamRole)
+
+        return [self.openChallenges[challengeId] for challengeId in self.openChallengeIndex.search(map, tribe, minBet, maxBet, exclude, sortBy, limit)]
+
+    def getChallengeByMessageId(self, messageId: int) -> Optional[challengeModule.Challenge]:
+        """
+        Returns snapshot of the open challenge listed in message with given id, or None if the message doesn't list any.
+
+        Doesn't touch the database.
+        """
+        challengeId = self.messages.get(messageId)
+        if challengeId == None:
+            return None
+        return self.openChallenges.get(challengeId)
 
     async def loadAllChallengesAfterRestart(self) -> None:
         for challange in challengeModule.Challenge.getAllChallengesByState(state=ChallengeState.CREATED):
-            if challange.messageId != None:
-                self.messages.add(cast(int,challange.messageId))
+            self._rememberChallenge(challange)
             logging.info("Loaded a challenge after restart!")
 
+    async def loadActiveChallenges(self) -> None:
+        """
+        Indexes all accepted and started challenges (they aren't part of the warm state snapshot).
+        """
+        self.activeChallenges = {}
+        for state in (ChallengeState.ACCEPTED, ChallengeState.STARTED):
+            for challenge in challengeModule.Challenge.getAllChallengesByState(state=state):
+                self._rememberActive(challenge)
+
 
     """
     STORY METHODS
     """
 
-    async def createChallengeEntry(self, challenge: challengeModule.Challenge, private: bool) -> None:
+    async def createChallengeEntry(self, challenge: challengeModule.Challenge) -> None:
         """
         Creates the message entry for given challange. Then finishes creating the challange.
 
-        if private is true, no message will be generated.
+        if the challenge is private, no message will be generated.
+        """
+        messageId = await self.postChallengeListing(challenge)
+        challenge.finishCreating(messageId)
+        await self.challengeCreated(challenge)
+
+    async def postChallengeListing(self, challenge: challengeModule.Challenge) -> Optional[int]:
         """
-        logging.info(f"Created challenge: {str(challenge)} (private: {private})")
-        if not private:
-            name = cast(playerModule.Player, playerModule.Player.getById(challenge.authorId)).getName()
+        Sends the message listing given (still PRECREATED) challenge.
+
+        Returns id of the message or None if no message was sent, because the challenge is private or the board is used.
+        """
+        if challenge.private or self.board != None:
+            return None
+
+        name = cast(playerModule.Player, playerModule.Player.getById(challenge.authorId)).getName()
+        with discordApiSeconds.time(call="send_message"):
             message = await self.messageChannel.send(
 f"""
 ## ⚔️ {name} challanges you! ⚔️
@@ -97,19 +296,31 @@ timelimit: 24 hours
 challange timeouts in <t:{challenge.timeout}:t>
 """
             )
+        return message.id
+
+    async def challengeCreated(self, challenge: challengeModule.Challenge) -> None:
+        """
+        Indexes a challenge which has just been written into the database and lets its host know.
+        """
+        logging.info(f"Created challenge: {str(challenge)} (private: {challenge.private})")
+        self._rememberChallenge(challenge)
+        if not challenge.private:
+            self.challengesChanged()
             await self._sendHost(challenge, f"{await challenge.toTextForMessages()} has been created")
-            self.messages.add(cast(int, message.id))
-            await message.add_reaction(ABORT_EMOJI)
-            await message.add_reaction(ACCEPT_EMOJI)
-            challenge.finishCreating(message.id)
+            if challenge.messageId != None:
+                message = self.messageChannel.get_partial_message(cast(int, challenge.messageId))
+                with discordApiSeconds.time(call="add_reaction"):
+                    await message.add_reaction(ABORT_EMOJI)
+                with discordApiSeconds.time(call="add_reaction"):
+                    await message.add_reaction(ACCEPT_EMOJI)
         else:
             await self._sendHost(challenge, f"{await challenge.toTextForMessages()} has been created.\n"\
                 "The challange is private, so it won't show up in listings."\
                 "If you want someone to connect, they have to DM me the following command:\n"\
                 f"accept {challenge.id}")
-            challenge.finishCreating(None)
     
     async def abortChallenge(self, challenge: challengeModule.Challenge) -> None:
+        self._forgetActive(challenge)
         await self._sendAll(challenge, f"{await challenge.toTextForMessages()} has been aborted.\n"\
             "If you wish to create another one, use the /create_challenge command!")
 
@@ -117,15 +328,21 @@ challange timeouts in <t:{challenge.timeout}:t>
 
         logging.info(f"challenge aborted {challenge.id}")
 
-    async def abortChallengeDueTimeout(self, challenge: challengeModule.Challenge) -> None:
-        await self._sendAll(challenge, f"{await challenge.toTextForMessages()} has been aborted due timeout.\n"\
-            "If you wish to create another one, use the /create_challenge command!")
-
-        await self._deleteChallengeMessage(challenge)
+    async def abortChallengesDueTimeout(self, challenges: list[challengeModule.Challenge]) -> None:
+        """
+        Lets players of challenges which have already been aborted together due timeout know.
+        """
+        await self._deleteChallengeMessages(challenges)
 
-        logging.info(f"challenge aborted due timeout {challenge.id}")
+        messages: list[tuple[int, str]] = []
+        for challenge in challenges:
+            messages.append((challenge.authorId, f"{await challenge.toTextForMessages()} has been aborted due timeout.\n"\
+                "If you wish to create another one, use the /create_challenge command!"))
+            logging.info(f"challenge aborted due timeout {challenge.id}")
+        await self._DMBatch(messages)
 
     async def acceptChallenge(self, challenge: challengeModule.Challenge) -> None:
+        self._rememberActive(challenge)
         await self._deleteChallengeMessage(challenge)
         await self._sendAway(challenge, f"{await challenge.toTextForMessages()} has been accepted.\n"\
             "Waiting for host to start the game")
@@ -134,16 +351,56 @@ challange timeouts in <t:{challenge.timeout}:t>
 
         logging.info(f"challenge accepted {challenge.id}")
 
+    async def challengeMatched(self, challenge: challengeModule.Challenge) -> None:
+        """
+        Indexes a challenge created (already accepted) by matchmaking and lets both players know.
+        """
+        self._rememberActive(challenge)
+        await self._sendAway(challenge, f"{await challenge.toTextForMessages()} has been matched for you: bet {challenge.bet}, {challenge.map}, {challenge.tribe}.\n"\
+            "Waiting for host to start the game")
+        await self._sendHost(challenge, f"{await challenge.toTextForMessages()} has been matched for you: bet {challenge.bet}, {challenge.map}, {challenge.tribe}.\n"\
+            f"Please start the game by sending me the following command:\nstart {challenge.id} [gamename]")
+
+        logging.info(f"challenge matched {challenge.id}")
+
+    async def queueDropped(self, playerId: int, reason: str) -> None:
+        """
+        Lets a player know they were taken out of the matchmaking queue, because a match with them couldn't be created.
+        """
+        await self._DM(playerModule.Player.getById(playerId), f"You have been removed from the matchmaking queue, because a match with you couldn't be created: {reason}\n"\
+            "Use the queue command to join it again.")
+        logging.info(f"dropped {playerId} from the queue: {reason}")
+
     async def startChallenge(self, challenge: challengeModule.Challenge) -> None:
+        # refreshes the snapshot with the new state
+        self._rememberActive(challenge)
         await self._sendAll(challenge, f"{await challenge.toTextForMessages()} has been started! \nThe game name is {challenge.gameName}\n\nGLHF!"\
             f"Once the game is over, the winner should send me the following command:\nwin {challenge.id} ")
         logging.info(f"started {challenge.id}")
 
     async def claimChallenge(self, challenge: challengeModule.Challenge) -> None:
+        self._forgetActive(challenge)
         await self._sendAll(challenge, f"{await challenge.toTextForMessages()} has been claimed by {cast(playerModule.Player, playerModule.Player.getById(challenge.winner)).getName()}! \nIf you want to dispute the claim, contact the mods!")
         logging.info(f"claimed {challenge.id}")
 
 
+    async def flushLogs(self) -> None:
+        """
+        Waits until everything logged so far is on disk, without blocking the event loop.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, asyncLogging.flushAll)
+
     async def playerRegistered(self, playerId: int) -> None:
+        tenant = tenantModule.getCurrent()
+        if tenant != None:
+            tenant = cast(tenantModule.Tenant, tenant)
+            tenant.members.track(playerId)
+            member = tenant.members.get(playerId)
+            if member != None:
+                member = cast(discord.Member, member)
+                tenant.players.setMember(playerId, member.name, member.display_name)
+                # the team was stored when registering, later changes are synced from role events
+                tenant.teams[playerId] = playerModule.Player.teamOf(member, tenant.config.teamRoles)
         await self._DM(playerModule.Player.getById(playerId), "You have registered to Highroller tournament! Good luck have fun :D")
-        await self.spamChannel.send(f"<@{playerId}> you have registered! Please check your DMs, you should have one from me :D")
+        with discordApiSeconds.time(call="send_message"):
+            await self.spamChannel.send(f"<@{playerId}> you have registered! Please check your DMs, you should have one from me :D")
@@ -0,0 +1,240 @@
+from __future__ import annotations
+from typing import Any, Iterator, Callable, Optional
+from contextlib import contextmanager
+import asyncio
+import functools
+import logging
+import re
+import time
+
+
+"""
+Minimal in-process metrics served in Prometheus text format.
+
+Worker processes don't serve metrics, they send what they observed to the gateway, which merges it into its own.
+"""
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# label values of a sample, in order of metric's label names
+Labels = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _formatLabels(names: tuple[str, ...], values: Labels, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """
+    Monotonically increasing count, one per combination of label values.
+    """
+    def __init__(self, name: str, help: str, labelNames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values: dict[Labels, float] = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = tuple(str(labels[name]) for name in self.labelNames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, values: dict[Labels, float]) -> None:
+        for key, value in values.items():
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_formatLabels(self.labelNames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of observed values (usually durations in seconds), one per combination of label values.
+    """
+    def __init__(self, name: str, help: str, labelNames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        # label values -> [counts of each bucket, sum, count]
+        self.values: dict[Labels, list[Any]] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels[name]) for name in self.labelNames)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        sample = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                sample[0][i] += 1
+        sample[1] += value
+        sample[2] += 1
+
+    def merge(self, values: dict[Labels, list[Any]]) -> None:
+        for key, (counts, total, count) in values.items():
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            sample = self.values[key]
+            sample[0] = [mine + theirs for mine, theirs in zip(sample[0], counts)]
+            sample[1] += total
+            sample[2] += count
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        """
+        observes how long the with block took
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucketCount in zip(self.buckets, counts):
+                labels = _formatLabels(self.labelNames, key, 'le="' + str(bound) + '"')
+                lines.append(f"{self.name}_bucket{labels} {bucketCount}")
+            labels = _formatLabels(self.labelNames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_formatLabels(self.labelNames, key)} {total}")
+            lines.append(f"{self.name}_count{_formatLabels(self.labelNames, key)} {count}")
+        return lines
+
+
+_registry: list[Counter | Histogram] = []
+
+
+def render() -> str:
+    """
+    returns all metrics in Prometheus text format
+    """
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+def takeChanges() -> dict[str, dict[Labels, Any]]:
+    """
+    returns values of all metrics observed since the last call by metric name and resets them, so they can be merged into another process
+    """
+    changes = {}
+    for metric in _registry:
+        if len(metric.values) > 0:
+            changes[metric.name] = metric.values
+            metric.values = {}
+    return changes
+
+def merge(changes: dict[str, dict[Labels, Any]]) -> None:
+    """
+    adds values taken by takeChanges (in another process) to metrics of this process
+    """
+    byName = {metric.name: metric for metric in _registry}
+    for name, values in changes.items():
+        byName[name].merge(values)
+
+
+"""
+METRICS
+"""
+
+commandSeconds = Histogram("highroller_command_seconds", "Time spent evaluating a command.", ("command", "outcome"))
+databaseCallSeconds = Histogram("highroller_database_call_seconds", "Time spent in a Database method.", ("method",))
+databaseQuerySeconds = Histogram("highroller_database_query_seconds", "Time spent executing a SQL statement.", ("query",))
+discordApiSeconds = Histogram("highroller_discord_api_seconds", "Time spent in a Discord API call.", ("call",))
+decoratorRejections = Counter("highroller_decorator_rejections_total", "Commands rejected by command decorators.", ("reason",))
+admissionRejections = Counter("highroller_admission_rejections_total", "Commands turned away by admission control.", ("reason", "commandClass"))
+duplicateEvents = Counter("highroller_duplicate_events_total", "Gateway events answered from the dedup cache.", ("event",))
+memberCacheLookups = Counter("highroller_member_cache_lookups_total", "Lookups of guild members in the cache.", ("result",))
+timeoutCheckSeconds = Histogram("highroller_timeout_check_seconds", "Time spent checking challenges for timeouts.")
+
+
+"""
+INSTRUMENTATION HELPERS
+"""
+
+def timedMethods(histogram: Histogram) -> Callable[[type], type]:
+    """
+    class decorator observing duration of all public methods of the class in histogram, labeled by method name
+    """
+    def decorator(cls: type) -> type:
+        for name, method in list(vars(cls).items()):
+            if name.startswith("_") or not callable(method):
+                continue
+            setattr(cls, name, _timedMethod(histogram, name, method))
+        return cls
+    return decorator
+
+def _timedMethod(histogram: Histogram, name: str, method: Callable) -> Callable:
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with histogram.time(method=name):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+_whitespace = re.compile(r"\s+")
+
+class TimedConnection:
+    """
+    Wraps sqlite3 connection, observing duration of every executed statement.
+    """
+    def __init__(self, con: Any):
+        self.con = con
+
+    def execute(self, sql: str, *args: Any) -> Any:
+        with databaseQuerySeconds.time(query=_whitespace.sub(" ", sql).strip()):
+            return self.con.execute(sql, *args)
+
+    def executescript(self, sql: str) -> Any:
+        with databaseQuerySeconds.time(query="script"):
+            return self.con.executescript(sql)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.con, name)
+
+
+"""
+ENDPOINT
+"""
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        requestLine = (await reader.readline()).decode("latin-1").split(" ")
+        # we don't care about headers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        if len(requestLine) >= 2 and requestLine[0] == "GET" and requestLine[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except Exception as e:
+        logging.warning("Error serving metrics")
+        logging.warning(str(e))
+    finally:
+        writer.close()
+
+async def serve(host: str, port: int) -> Optional[asyncio.AbstractServer]:
+    """
+    starts serving metrics on http://host:port/metrics
+    """
+    try:
+        server = await asyncio.start_server(_handle, host, port)
+    except OSError as e:
+        logging.error(f"Can't serve metrics on {host}:{port}")
+        logging.error(str(e))
+        return None
+    logging.info(f"serving metrics on {host}:{port}")
+    return server
@@ -6,4 +6,5 @@ class botWithGuild(discord.Bot): guild: discord.Guild
 
 
 replyFunction = Callable[[str], Awaitable[Any]]
-CommandFunction = Callable[[Any, list[str], discord.Member, replyFunction], Awaitable[None]]
+# command handler gets its CommandEvaluator and CommandContext of the invocation
+CommandFunction = Callable[[Any, Any], Awaitable[None]]
@@ -3,9 +3,11 @@ from typing import Optional, cast, Type, Self
 
 import discord
 
-from constants import ChallengeState, STARTING_CHIPS, TEAM_ROLES
+from constants import ChallengeState, STARTING_CHIPS, TEAM_ROLES, RATING_START
 from db import Database
 import myTypes
+import tenant as tenantModule
+from metrics import discordApiSeconds
 
 class Player:
     """
@@ -21,11 +23,17 @@ class Player:
     bot: Optional[myTypes.botWithGuild] = None
     db: Optional[Database] = None
 
-    def __init__(self, playerId: int, currentChips: int, totalChips: int, abortedGames: int):
+    # last known names and teams (by guild id) of players, used when the member isn't in the guild cache (yet)
+    knownNames: dict[int, str] = {}
+    knownTeams: dict[int, dict[int, int]] = {}
+
+    def __init__(self, playerId: int, currentChips: int, totalChips: int, abortedGames: int, team: Optional[int] = None):
         self.id = playerId
         self.currentChips = currentChips
         self.totalChips = totalChips
         self.abortedGames = abortedGames
+        # id of the team role, as last synced from discord
+        self.team = team
         self.dmChannel = None
 
 
@@ -45,7 +53,12 @@ class Player:
     def getDb(cls: Type[Self]) -> Database:
         """
         return the database all Challenges are using
+
+        while handling an event for a tenant, that's the tenant's database
         """
+        tenant = tenantModule.getCurrent()
+        if tenant != None:
+            return cast(tenantModule.Tenant, tenant).db
         if cls.db != None:
             return cast(Database, cls.db)
         raise EnvironmentError(f"Database of {cls} not set!")
@@ -72,6 +85,57 @@ class Player:
             return cast(myTypes.botWithGuild, cls.bot)
         raise EnvironmentError(f"Bot of {cls} not set!")
 
+    @classmethod
+    def getGuild(cls: Type[Self]) -> discord.Guild:
+        """
+        return the guild of the current tenant
+
+        Raises:
+            EnvironmentError - if no tenant is active
+        """
+        tenant = tenantModule.getCurrent()
+        if tenant == None:
+            raise EnvironmentError(f"Guild of {cls} is only known while a tenant is active!")
+        return cast(tenantModule.Tenant, tenant).guild
+
+    @classmethod
+    def getMember(cls: Type[Self], id: int) -> Optional[discord.Member]:
+        """
+        return cached member of the current tenant's guild (through its member cache), None if it isn't cached
+        """
+        tenant = tenantModule.getCurrent()
+        if tenant != None and hasattr(tenant, "members"):
+            return cast(tenantModule.Tenant, tenant).members.get(id)
+        return cls.getGuild().get_member(id)
+
+    @classmethod
+    def getTeamRoles(cls: Type[Self]) -> list[int]:
+        """
+        return ids of team roles of the current tenant (or the ones from constants if no tenant is active)
+        """
+        tenant = tenantModule.getCurrent()
+        if tenant != None:
+            return cast(tenantModule.Tenant, tenant).config.teamRoles
+        return TEAM_ROLES
+
+
+    @staticmethod
+    def teamOf(member: discord.Member, teamRoles: list[int]) -> Optional[int]:
+        """
+        return id of the first of teamRoles the member has, None if they aren't in a team
+        """
+        roleIds = {role.id for role in member.roles}
+        for role in teamRoles:
+            if role in roleIds:
+                return role
+        return None
+
+    @classmethod
+    def getTeamStandings(cls: Type[Self]) -> list[tuple[int, int, int, int]]:
+        """
+        Returns (team role id, chips this season, chips all time, number of players) of each team, summed by the database.
+        """
+        return [cast(tuple[int, int, int, int], tuple(row)) for row in cls.getDb().getTeamStandings()]
 
     @classmethod
     def giveAllPlayersChips(cls: Type[Self], amount: int) -> None:
@@ -87,9 +151,9 @@ class Player:
     """
 
     @classmethod
-    def create(cls: Type[Self], playerId: int) -> Self:
+    def create(cls: Type[Self], playerId: int, team: Optional[int] = None) -> Self:
         """
-        Register a new player to the game. If player with same id already exists, ValueError is raised.
+        Register a new player (in team with given role id) to the game. If player with same id already exists, ValueError is raised.
 
         Returns:
             object created
@@ -100,8 +164,8 @@ class Player:
         if cls.getById(playerId) != None:
             raise ValueError("You are already registered!")
 
-        player = cls(playerId, STARTING_CHIPS, STARTING_CHIPS, 0)
-        cls.getDb().createPlayer(player.id, player.currentChips, player.totalChips, player.abortedGames)
+        player = cls(playerId, STARTING_CHIPS, STARTING_CHIPS, 0, team)
+        cls.getDb().createPlayer(player.id, player.currentChips, player.totalChips, player.abortedGames, player.team)
         return player
 
     @classmethod
@@ -144,6 +208,21 @@ class Player:
         """
         return [cls(*playerData) for playerData in cls.getDb().getTopPlayersThisEpoch(count)]
     
+    @classmethod
+    def getTopRatedPlayers(cls: Type[Self], count: int) -> list[tuple[Self, float, int]]:
+        """
+        Returns a list of [count] players with the highest rating in descending order, with their rating and number of rated games.
+
+        Raises:
+            Nothing
+        """
+        top = []
+        for playerId, rating, games in cls.getDb().getTopRatings(count):
+            player = cls.getById(playerId)
+            if player != None:
+                top.append((player, rating, games))
+        return top
+
     @classmethod
     def getTopPlayersAllTime(cls: Type[Self], count: int) -> list[Self]:
         """
@@ -173,32 +252,42 @@ class Player:
         Raises:
             Nothing
         """
-        member = await self.getBot().fetch_user(self.id)
+        with discordApiSeconds.time(call="fetch_user"):
+            member = await self.getBot().fetch_user(self.id)
         try:
-            await member.send(message)
+            with discordApiSeconds.time(call="send_dm"):
+                await member.send(message)
         except discord.errors.Forbidden:
             return False
         return True
     
     def getName(self) -> str:
-        member = self.getBot().guild.get_member(self.id)
+        member = self.getMember(self.id)
         if member == None:
-            return "N/A"
+            return self.knownNames.get(self.id, "N/A")
         member = cast(discord.Member, member)
+        self.knownNames[self.id] = member.name
         return member.name
         
     def getTeam(self) -> int:
         """
         return number coresponding to the index of team who's role this user has, returns -1 if not in a team, -2 if user doesn't exist
         """
-        member = self.getBot().guild.get_member(self.id)
+        guild = self.getGuild()
+        knownTeams = self.knownTeams.setdefault(guild.id, {})
+        member = self.getMember(self.id)
         if member == None:
-            return -2
+            if self.id not in knownTeams and self.team in self.getTeamRoles():
+                return self.getTeamRoles().index(cast(int, self.team))
+            return knownTeams.get(self.id, -2)
         member = cast(discord.Member, member)
-        for i, role in enumerate(TEAM_ROLES):
+        team = -1
+        for i, role in enumerate(self.getTeamRoles()):
             if role in [role.id for role in member.roles]:
-                return i
-        return -1
+                team = i
+                break
+        knownTeams[self.id] = team
+        return team
 
     def adjustChips(self, number: int) -> None:
         """
@@ -216,6 +305,13 @@ class Player:
         self.currentChips += number
         self.totalChips += number
         
+    def getRating(self) -> tuple[float, int]:
+        """
+        return rating of the player and number of their rated games
+        """
+        rating = self.getDb().getRating(self.id)
+        return (rating[0], rating[1]) if rating != None else (RATING_START, 0)
+
     def getGameScore(self) -> list[int]:
         wr = self.getDb().getPlayersWinrate(self.id)
         return [wr[0], wr[1]]
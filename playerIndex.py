@@ -0,0 +1,105 @@
+from __future__ import annotations
+from typing import Optional
+import difflib
+import unicodedata
+
+import discord
+
+from prefixIndex import PrefixIndex
+
+
+# how similar (0 to 1) a name has to be to match a misspelled one
+FUZZY_CUTOFF = 0.8
+
+
+class PlayerIndex:
+    """
+    Names and nicks of registered players of one tenant, resolvable and searchable without touching the database or Discord.
+
+    Names are matched case-insensitively (and after unicode normalization), misspelled ones fuzzily.
+
+    Should be created using build factory method and then kept up to date with setMember.
+    """
+    def __init__(self):
+        # current name and nick of each indexed player
+        self.names: dict[int, str] = {}
+        self.nicks: dict[int, str] = {}
+        self.byName = PrefixIndex()
+        # normalized name or nick -> IDs of players having it
+        self.exact: dict[str, set[int]] = {}
+
+    @classmethod
+    def build(cls, playerIds: list[int], guild: discord.Guild, knownNames: Optional[dict[int, str]] = None) -> PlayerIndex:
+        """
+        Indexes given (registered) players by their names and nicks in guild, or by their last known names if they aren't cached.
+        """
+        index = cls()
+        for playerId in playerIds:
+            member = guild.get_member(playerId)
+            if member != None:
+                index.setMember(playerId, member.name, member.display_name)
+            elif knownNames != None and playerId in knownNames:
+                index.setMember(playerId, knownNames[playerId])
+        return index
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return unicodedata.normalize("NFKC", name).strip().lstrip("@").casefold()
+
+    def setMember(self, playerId: int, name: str, nick: Optional[str] = None) -> None:
+        """
+        indexes (or re-indexes) a registered player under given name and nick
+        """
+        self.remove(playerId)
+        self.names[playerId] = name
+        self.byName.add(name, playerId)
+        self.exact.setdefault(self.normalize(name), set()).add(playerId)
+        if nick != None and nick != name:
+            self.nicks[playerId] = nick
+            self.exact.setdefault(self.normalize(nick), set()).add(playerId)
+
+    def updateMember(self, playerId: int, name: str, nick: Optional[str] = None) -> None:
+        """
+        updates name and nick of a player after a member update, if the player is indexed (registered)
+        """
+        if playerId not in self.names:
+            return
+        if self.names[playerId] != name or self.nicks.get(playerId) != (nick if nick != name else None):
+            self.setMember(playerId, name, nick)
+
+    def remove(self, playerId: int) -> None:
+        name = self.names.pop(playerId, None)
+        if name != None:
+            self.byName.remove(name, playerId)
+        for old in (name, self.nicks.pop(playerId, None)):
+            if old == None:
+                continue
+            ids = self.exact.get(self.normalize(old))
+            if ids != None:
+                ids.discard(playerId)
+                if len(ids) == 0:
+                    del self.exact[self.normalize(old)]
+
+    def getName(self, playerId: int) -> Optional[str]:
+        return self.names.get(playerId)
+
+    def resolve(self, name: str) -> Optional[int]:
+        """
+        Returns ID of the registered player with given name or nick, or None if there isn't exactly one.
+
+        Exact (case-insensitive) matches are tried first, then the closest misspelled one.
+        """
+        key = self.normalize(name)
+        ids = self.exact.get(key)
+        if ids == None:
+            close = difflib.get_close_matches(key, self.exact.keys(), n=1, cutoff=FUZZY_CUTOFF)
+            ids = self.exact[close[0]] if len(close) > 0 else None
+        if ids == None or len(ids) != 1:
+            return None
+        return next(iter(ids))
+
+    def suggest(self, prefix: str, limit: int = 25) -> list[tuple[str, int]]:
+        """
+        returns up to limit (name, player ID) pairs of players whose name starts with prefix
+        """
+        return [(self.names[playerId], playerId) for _, playerId in self.byName.search(prefix, limit)]
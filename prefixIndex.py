@@ -0,0 +1,43 @@
+from __future__ import annotations
+from bisect import bisect_left, insort
+
+
+class PrefixIndex:
+    """
+    Keys (normalized to lower case) with an ID each, kept sorted so all keys starting with a prefix form one range found by bisection.
+
+    Adding and removing keeps the order, so the index is updated incrementally instead of being rebuilt.
+    """
+    def __init__(self):
+        self.entries: list[tuple[str, int]] = []
+
+    @staticmethod
+    def normalize(key: str) -> str:
+        return key.strip().casefold()
+
+    def add(self, key: str, value: int) -> None:
+        entry = (self.normalize(key), value)
+        i = bisect_left(self.entries, entry)
+        if i == len(self.entries) or self.entries[i] != entry:
+            insort(self.entries, entry)
+
+    def remove(self, key: str, value: int) -> None:
+        entry = (self.normalize(key), value)
+        i = bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del self.entries[i]
+
+    def search(self, prefix: str, limit: int = 25) -> list[tuple[str, int]]:
+        """
+        returns up to limit (key, ID) pairs whose key starts with prefix, in order of keys
+        """
+        prefix = self.normalize(prefix)
+        result = []
+        for i in range(bisect_left(self.entries, (prefix, -1)), len(self.entries)):
+            if len(result) >= limit or not self.entries[i][0].startswith(prefix):
+                break
+            result.append(self.entries[i])
+        return result
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,90 @@
+from __future__ import annotations
+from typing import Optional
+import logging
+import math
+
+import numpy as np
+
+from constants import ChallengeState, RATING_START, RATING_BASE_K, RATING_MAX_BET_WEIGHT, RATING_SCALE
+from db import Database
+
+
+"""
+Elo ratings of players computed from FINISHED challenges in the order they finished.
+
+K of a game grows with the square root of its bet (up to RATING_MAX_BET_WEIGHT times RATING_BASE_K), so games
+with more at stake move ratings more. A finished game updates ratings of its two players right away. Revoking a win
+recomputes everything, as every later game of those players depended on it.
+"""
+
+
+def kFactor(bet: np.ndarray | int) -> np.ndarray | float:
+    return RATING_BASE_K * np.minimum(np.sqrt(np.maximum(bet, 1)), RATING_MAX_BET_WEIGHT)
+
+def expectedScore(rating: np.ndarray | float, opponentRating: np.ndarray | float) -> np.ndarray | float:
+    return 1 / (1 + 10 ** ((opponentRating - rating) / RATING_SCALE))
+
+
+def computeRatings(games: list[tuple[int, int, int]]) -> dict[int, tuple[float, int]]:
+    """
+    Returns (rating, number of rated games) of every player of given (winner, loser, bet) games, which are in chronological order.
+
+    Games are split into rounds in which no player plays twice, each game in the round right after the last round
+    of both its players. Ratings of a round are then updated at once with array operations, which gives the same
+    result as going through the games one by one.
+    """
+    if len(games) == 0:
+        return {}
+
+    players = sorted({player for winner, loser, _ in games for player in (winner, loser)})
+    indexOf = {player: i for i, player in enumerate(players)}
+    winners = np.array([indexOf[winner] for winner, _, _ in games])
+    losers = np.array([indexOf[loser] for _, loser, _ in games])
+    bets = np.array([bet for _, _, bet in games])
+
+    lastRound = [-1] * len(players)
+    rounds = np.empty(len(games), dtype=np.int64)
+    for i in range(len(games)):
+        winner, loser = winners[i], losers[i]
+        rounds[i] = max(lastRound[winner], lastRound[loser]) + 1
+        lastRound[winner] = lastRound[loser] = int(rounds[i])
+
+    ratings = np.full(len(players), RATING_START, dtype=np.float64)
+    order = np.argsort(rounds, kind="stable")
+    boundaries = np.flatnonzero(np.diff(rounds[order])) + 1
+    for batch in np.split(order, boundaries):
+        roundWinners, roundLosers = winners[batch], losers[batch]
+        change = kFactor(bets[batch]) * (1 - expectedScore(ratings[roundWinners], ratings[roundLosers]))
+        # nobody plays twice in a round, so plain (not accumulating) indexing is enough
+        ratings[roundWinners] += change
+        ratings[roundLosers] -= change
+
+    counts = np.bincount(np.concatenate([winners, losers]), minlength=len(players))
+    return {player: (float(ratings[i]), int(counts[i])) for i, player in enumerate(players)}
+
+
+def recomputeAll(db: Database) -> int:
+    """
+    Recomputes ratings of all players from the whole match history. Returns the number of rated games.
+    """
+    games = db.getFinishedGames(ChallengeState.FINISHED)
+    ratings = computeRatings(games)
+    db.replaceRatings([(player, rating, count) for player, (rating, count) in ratings.items()])
+    logging.info(f"recomputed ratings of {len(ratings)} players from {len(games)} games")
+    return len(games)
+
+
+def applyResult(db: Database, winnerId: int, loserId: Optional[int], bet: int) -> None:
+    """
+    Updates ratings of both players of one just finished game.
+    """
+    if loserId == None or loserId == winnerId:
+        return
+    winnerRating, winnerGames = db.getRating(winnerId) or (RATING_START, 0)
+    loserRating, loserGames = db.getRating(loserId) or (RATING_START, 0)
+    change = float(kFactor(bet) * (1 - expectedScore(winnerRating, loserRating)))
+    db.setRatings([(winnerId, winnerRating + change, winnerGames + 1), (loserId, loserRating - change, loserGames + 1)])
+
+
+def formatRating(rating: float) -> str:
+    return str(int(math.floor(rating + 0.5)))
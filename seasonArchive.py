@@ -0,0 +1,194 @@
+from __future__ import annotations
+from typing import Optional, Any
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+from constants import ChallengeState
+from db import Database
+
+
+"""
+Completed seasons archived as column files, so analytics over past seasons never touch the live database.
+
+Each season is a directory with one .npy file per column of its challenges and of its final standings, and season.json
+with the season's bounds and the dictionaries of dictionary-encoded columns (map and tribe are stored as indexes into
+them). Columns are memory-mapped when read, so a query only loads the columns it touches.
+"""
+
+# column name -> dtype, missing players (acceptedBy, winner, team) are stored as 0
+CHALLENGE_COLUMNS = {"id": np.int64, "bet": np.int32, "authorId": np.int64, "acceptedBy": np.int64, "state": np.int8, "map": np.int16, "tribe": np.int16, "winner": np.int64, "finishedAt": np.int64}
+STANDING_COLUMNS = {"playerId": np.int64, "currentChips": np.int32, "totalChips": np.int32, "team": np.int64}
+ENCODED_COLUMNS = ("map", "tribe")
+
+# challenges of these states are over, so they belong to the season they ended in
+ARCHIVED_STATES = [ChallengeState.FINISHED, ChallengeState.ABORTED]
+
+
+class Season:
+    """
+    One archived season, its columns are memory-mapped on first use.
+
+    Should be created using following factory methods:
+    - load
+    - loadAll
+    """
+    def __init__(self, directory: str, season: int, startedAt: Optional[int], endedAt: int, dictionaries: dict[str, list[str]]):
+        self.directory = directory
+        self.season = season
+        self.startedAt = startedAt
+        self.endedAt = endedAt
+        self.dictionaries = dictionaries
+        self.columns: dict[str, np.ndarray] = {}
+
+
+    """
+    FACTORY METHODS
+    """
+
+    @classmethod
+    def load(cls, directory: str) -> Season:
+        with open(os.path.join(directory, "season.json"), "r", encoding="utf-8") as file:
+            data = json.load(file)
+        return cls(directory, data["season"], data["startedAt"], data["endedAt"], data["dictionaries"])
+
+    @classmethod
+    def loadAll(cls, root: str) -> list[Season]:
+        """
+        Returns all seasons archived in root, oldest first.
+        """
+        if not os.path.isdir(root):
+            return []
+        seasons = []
+        for name in os.listdir(root):
+            if name.startswith("season-") and os.path.exists(os.path.join(root, name, "season.json")):
+                seasons.append(cls.load(os.path.join(root, name)))
+        seasons.sort(key=lambda season: season.season)
+        return seasons
+
+
+    """
+    COLUMNS
+    """
+
+    def challenges(self, column: str) -> np.ndarray:
+        return self.__column("challenges", column)
+
+    def standings(self, column: str) -> np.ndarray:
+        return self.__column("standings", column)
+
+    def decode(self, column: str, codes: np.ndarray) -> list[str]:
+        dictionary = self.dictionaries[column]
+        return [dictionary[code] for code in codes]
+
+    def __column(self, table: str, column: str) -> np.ndarray:
+        key = f"{table}.{column}"
+        if key not in self.columns:
+            self.columns[key] = np.load(os.path.join(self.directory, f"{key}.npy"), mmap_mode="r")
+        return self.columns[key]
+
+
+    """
+    ANALYTICS
+    """
+
+    def summary(self) -> dict[str, Any]:
+        """
+        returns number of finished and aborted games, chips bet in finished games, the most played map and the player with the most chips
+        """
+        state = self.challenges("state")
+        finished = state == ChallengeState.FINISHED.value
+        maps = np.bincount(self.challenges("map")[finished], minlength=len(self.dictionaries["map"]))
+        chips = self.standings("currentChips")
+        best = int(np.argmax(chips)) if len(chips) > 0 else None
+        return {
+            "finished": int(np.count_nonzero(finished)),
+            "aborted": int(np.count_nonzero(state == ChallengeState.ABORTED.value)),
+            "chipsBet": int(self.challenges("bet")[finished].sum()),
+            "topMap": self.dictionaries["map"][int(np.argmax(maps))] if maps.sum() > 0 else None,
+            "topPlayer": (int(self.standings("playerId")[best]), int(chips[best])) if best != None else None,
+        }
+
+    def playerSummary(self, playerId: int) -> Optional[dict[str, Any]]:
+        """
+        returns final chips and rank, wins and finished games of a player, or None if they didn't play this season
+        """
+        players = self.standings("playerId")
+        found = np.flatnonzero(players == playerId)
+        finished = self.challenges("state") == ChallengeState.FINISHED.value
+        played = finished & ((self.challenges("authorId") == playerId) | (self.challenges("acceptedBy") == playerId))
+        if len(found) == 0 or not played.any():
+            return None
+        chips = self.standings("currentChips")
+        playerChips = int(chips[found[0]])
+        return {
+            "chips": playerChips,
+            "rank": int(np.count_nonzero(chips > playerChips)) + 1,
+            "players": len(players),
+            "wins": int(np.count_nonzero(finished & (self.challenges("winner") == playerId))),
+            "games": int(np.count_nonzero(played)),
+        }
+
+
+def seasonDirectory(root: str, season: int) -> str:
+    return os.path.join(root, f"season-{season:04d}")
+
+
+def writeSeason(root: str, season: int, startedAt: Optional[int], endedAt: int, challenges: list[list[Any]], standings: list[list[Any]]) -> Season:
+    """
+    Writes columns of a season into its directory in root. The directory appears only once it's complete.
+
+    challenges and standings are rows with the columns of CHALLENGE_COLUMNS and STANDING_COLUMNS in the same order.
+
+    Raises:
+        ValueError - if the season is already archived
+    """
+    directory = seasonDirectory(root, season)
+    if os.path.exists(directory):
+        raise ValueError(f"Season {season} is already archived!")
+
+    temporary = directory + ".tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+
+    dictionaries: dict[str, list[str]] = {}
+    for table, columns, rows in (("challenges", CHALLENGE_COLUMNS, challenges), ("standings", STANDING_COLUMNS, standings)):
+        for i, (column, dtype) in enumerate(columns.items()):
+            values = [row[i] for row in rows]
+            if column in ENCODED_COLUMNS:
+                dictionary, values = np.unique(np.array(values, dtype=str), return_inverse=True)
+                dictionaries[column] = dictionary.tolist()
+            array = np.array([0 if value == None else value for value in values], dtype=dtype)
+            np.save(os.path.join(temporary, f"{table}.{column}.npy"), array)
+
+    with open(os.path.join(temporary, "season.json"), "w", encoding="utf-8") as file:
+        json.dump({"season": season, "startedAt": startedAt, "endedAt": endedAt, "dictionaries": dictionaries}, file)
+    os.replace(temporary, directory)
+
+    logging.info(f"archived season {season} with {len(challenges)} challenges and {len(standings)} players into {directory}")
+    return Season(directory, season, startedAt, endedAt, dictionaries)
+
+
+def archiveCurrentSeason(db: Database, root: str) -> Season:
+    """
+    Archives challenges which ended during the current season and the current standings, then starts the next season.
+
+    Should be called right before chips are reset. If the season's archive is already complete (the season wasn't
+    started after archiving it, e.g. due to a crash), only the next season is started.
+    """
+    season = db.getMetaValue("season") or 1
+    directory = seasonDirectory(root, season)
+    if os.path.exists(os.path.join(directory, "season.json")):
+        archived = Season.load(directory)
+        logging.warning(f"season {season} is already archived, only starting the next one")
+    else:
+        startedAt = db.getMetaValue("seasonStartedAt")
+        endedAt = int(time.time())
+        archived = writeSeason(root, season, startedAt, endedAt, db.getEndedChallenges(ARCHIVED_STATES, startedAt, endedAt), db.getStandings())
+
+    db.setMetaValues({"season": season + 1, "seasonStartedAt": archived.endedAt})
+    return archived
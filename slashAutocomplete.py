@@ -0,0 +1,47 @@
+from __future__ import annotations
+from typing import Optional, cast
+
+import discord
+
+import tenant as tenantModule
+
+
+"""
+Autocomplete callbacks of slash command options.
+
+They are answered on every keystroke, so they only read the in-memory indexes of the gateway (open and active
+challenges in Messenger, names of registered players in the tenant's PlayerIndex) and never the database.
+"""
+
+# discord shows at most 25 suggestions
+MAX_SUGGESTIONS = 25
+
+
+def _getTenant(ctx: discord.AutocompleteContext) -> Optional[tenantModule.Tenant]:
+    tenant = tenantModule.getByGuildId(ctx.interaction.guild_id)
+    if tenant != None:
+        return tenant
+    # in DMs, suggest from the first guild of the user
+    tenants = tenantModule.getForUser(cast(discord.User, ctx.interaction.user).id)
+    return tenants[0] if len(tenants) > 0 else None
+
+
+async def challenges(ctx: discord.AutocompleteContext) -> list[discord.OptionChoice]:
+    """
+    suggests IDs of active challenges of the user and of open challenges
+    """
+    tenant = _getTenant(ctx)
+    if tenant == None or ctx.interaction.user == None:
+        return []
+    suggestions = tenant.messenger.suggestChallenges(str(ctx.value or ""), cast(discord.User, ctx.interaction.user).id, MAX_SUGGESTIONS)
+    return [discord.OptionChoice(name=description[:100], value=challengeId) for description, challengeId in suggestions]
+
+
+async def players(ctx: discord.AutocompleteContext) -> list[discord.OptionChoice]:
+    """
+    suggests registered players by name, their ID is the value
+    """
+    tenant = _getTenant(ctx)
+    if tenant == None:
+        return []
+    return [discord.OptionChoice(name=name[:100], value=str(playerId)) for name, playerId in tenant.players.suggest(str(ctx.value or ""), MAX_SUGGESTIONS)]
@@ -0,0 +1,173 @@
+from __future__ import annotations
+from typing import Optional, Any, Iterator, cast
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import os
+
+import discord
+
+from constants import GUILD_ID, CHALLENGES_LIST_CHANNEL, SPAM_CHANNEL, TEAM_ROLES, LIST_OF_ADMINS, GUILDS_FILE, SNAPSHOT_FILE, SEASONS_DIRECTORY
+from db import Database
+from playerIndex import PlayerIndex
+from memberCache import MemberCache
+from matchmaking import MatchQueue
+
+
+class GuildConfig:
+    """
+    Configuration of one guild (tenant) served by the bot.
+
+    Should be created using following factory methods:
+    - default
+    - loadAll
+    """
+
+    def __init__(self, guildId: int, challengesListChannel: int, spamChannel: int, teamRoles: list[int], admins: list[int], databaseFile: str, snapshotFile: str, seasonsDirectory: str = SEASONS_DIRECTORY):
+        self.guildId = guildId
+        self.challengesListChannel = challengesListChannel
+        self.spamChannel = spamChannel
+        self.teamRoles = teamRoles
+        self.admins = admins
+        self.databaseFile = databaseFile
+        self.snapshotFile = snapshotFile
+        # archived seasons, see seasonArchive
+        self.seasonsDirectory = seasonsDirectory
+
+
+    """
+    FACTORY METHODS
+    """
+
+    @classmethod
+    def default(cls) -> GuildConfig:
+        """
+        Returns config of the guild set up in constants, which keeps using the original files.
+        """
+        return cls(guildId=GUILD_ID, challengesListChannel=CHALLENGES_LIST_CHANNEL, spamChannel=SPAM_CHANNEL, teamRoles=TEAM_ROLES, admins=LIST_OF_ADMINS, databaseFile="db.db", snapshotFile=SNAPSHOT_FILE)
+
+    @classmethod
+    def fromDict(cls, data: dict[str, Any]) -> GuildConfig:
+        """
+        Returns config described by a dictionary (one entry of GUILDS_FILE).
+
+        Raises:
+            KeyError - if a required key is missing
+        """
+        guildId = int(data["guildId"])
+        return cls(
+            guildId=guildId,
+            challengesListChannel=int(data["challengesListChannel"]),
+            spamChannel=int(data["spamChannel"]),
+            teamRoles=[int(role) for role in data.get("teamRoles", [])],
+            admins=[int(admin) for admin in data.get("admins", [])],
+            databaseFile=data.get("databaseFile", f"db-{guildId}.db"),
+            snapshotFile=data.get("snapshotFile", f"warmstate-{guildId}.json"),
+            seasonsDirectory=data.get("seasonsDirectory", f"seasons-{guildId}")
+        )
+
+    @classmethod
+    def loadAll(cls, path: str = GUILDS_FILE) -> list[GuildConfig]:
+        """
+        Returns configs of all guilds the bot should serve.
+
+        These are read from GUILDS_FILE (a JSON list of guild configs). If the file doesn't exist, only the guild from constants is served.
+        """
+        if not os.path.exists(path):
+            return [cls.default()]
+
+        with open(path, "r", encoding="utf-8") as file:
+            return [cls.fromDict(data) for data in json.load(file)]
+
+
+class Tenant:
+    """
+    Everything the bot keeps for one guild. State of different tenants is never shared.
+
+    Should be created using create factory method, filled in by the bot and then registered.
+    """
+    config: GuildConfig
+    db: Database
+    guild: discord.Guild
+    messenger: Any
+    commandEvaluator: Any
+    # names of registered players, each process keeps its own
+    players: PlayerIndex
+    members: MemberCache
+    # persisted team (role id or None) of each registered player, only kept in the gateway
+    teams: dict[int, Optional[int]]
+    # players waiting for an opponent, only used by the process writing into the database
+    queue: MatchQueue
+
+    @classmethod
+    def create(cls, config: GuildConfig, guild: discord.Guild, readOnly: bool = False) -> Tenant:
+        """
+        Creates the tenant and opens its database. It isn't served until it's registered.
+        """
+        tenant = cls()
+        tenant.config = config
+        tenant.guild = guild
+        tenant.db = Database(config.databaseFile, readOnly=readOnly)
+        tenant.queue = MatchQueue()
+        return tenant
+
+    def isAdmin(self, userId: int) -> bool:
+        return userId in self.config.admins
+
+
+"""
+REGISTRY
+"""
+
+# all tenants by their guild id
+_tenants: dict[int, Tenant] = {}
+
+# tenant the current event is being handled for
+_currentTenant: ContextVar[Optional[Tenant]] = ContextVar("currentTenant", default=None)
+
+
+def register(tenant: Tenant) -> None:
+    """
+    adds a fully built tenant to the registry, from now on events of its guild are routed to it
+    """
+    _tenants[tenant.config.guildId] = tenant
+    logging.info(f"serving guild {tenant.guild.name} ({tenant.config.guildId}) with database {tenant.config.databaseFile}")
+
+def getAll() -> list[Tenant]:
+    return list(_tenants.values())
+
+def getByGuildId(guildId: Optional[int]) -> Optional[Tenant]:
+    return _tenants.get(cast(int, guildId)) if guildId != None else None
+
+def getForUser(userId: int) -> list[Tenant]:
+    """
+    returns all tenants whose guild the user is a (cached) member of
+    """
+    return [tenant for tenant in _tenants.values() if tenant.guild.get_member(userId) != None]
+
+def getCurrent() -> Optional[Tenant]:
+    """
+    returns tenant the current event is being handled for, or None if no tenant is active
+    """
+    return _currentTenant.get()
+
+@contextmanager
+def activate(tenant: Tenant) -> Iterator[Tenant]:
+    """
+    makes given tenant current for the duration of the with block (and all tasks created in it)
+    """
+    token = _currentTenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _currentTenant.reset(token)
+
+def isAdmin(userId: int) -> bool:
+    """
+    returns if user is admin of the current tenant (or of the guild from constants if no tenant is active)
+    """
+    tenant = getCurrent()
+    if tenant == None:
+        return userId in LIST_OF_ADMINS
+    return cast(Tenant, tenant).isAdmin(userId)
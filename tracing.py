@@ -0,0 +1,196 @@
+from __future__ import annotations
+from typing import Optional, Any, Iterator, Callable
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import time
+
+from constants import TRACES_FILE, TRACE_SAMPLE_RATE, TRACE_ALWAYS_KEEP_SECONDS, TRACE_MAX_SPANS
+import asyncLogging
+
+
+"""
+Lightweight span tracing of commands.
+
+A trace is started for each command in parseCommand and spans are opened inside it (command pre-checks, Database and
+Messenger methods, calls to the gateway). The current trace and span live in context variables, so they follow the command
+into every coroutine and task it runs. Spans are kept only in memory while the command runs; finished traces are exported
+as JSON lines into TRACES_FILE if they are sampled (TRACE_SAMPLE_RATE) or slower than TRACE_ALWAYS_KEEP_SECONDS.
+"""
+
+
+class Trace:
+    """
+    One traced command with all its spans.
+    """
+    def __init__(self, name: str, attributes: dict[str, Any]):
+        self.id = f"{random.getrandbits(64):016x}"
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.startCounter = time.perf_counter()
+        self.duration = 0.0
+        # [name, index of parent span (-1 for trace itself), start since trace start, duration, attributes]
+        self.spans: list[list[Any]] = []
+
+    def toDict(self) -> dict[str, Any]:
+        return {
+            "trace": self.id,
+            "name": self.name,
+            "time": round(self.start, 3),
+            "duration": round(self.duration, 6),
+            "attributes": self.attributes,
+            "spans": [
+                {"name": name, "parent": parent, "start": round(start, 6), "duration": round(duration, 6), "attributes": attributes}
+                for name, parent, start, duration, attributes in self.spans
+            ],
+        }
+
+
+_currentTrace: ContextVar[Optional[Trace]] = ContextVar("currentTrace", default=None)
+_currentSpan: ContextVar[int] = ContextVar("currentSpan", default=-1)
+
+_tracesLogger = logging.getLogger("traces")
+
+
+@contextmanager
+def startTrace(name: str, **attributes: Any) -> Iterator[Trace]:
+    """
+    traces the with block as a new trace, which is exported once the block ends
+    """
+    trace = Trace(name, attributes)
+    traceToken = _currentTrace.set(trace)
+    spanToken = _currentSpan.set(-1)
+    try:
+        yield trace
+    finally:
+        trace.duration = time.perf_counter() - trace.startCounter
+        _currentSpan.reset(spanToken)
+        _currentTrace.reset(traceToken)
+        if trace.duration >= TRACE_ALWAYS_KEEP_SECONDS or random.random() < TRACE_SAMPLE_RATE:
+            _tracesLogger.info(name, extra={"entry": trace.toDict()})
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[None]:
+    """
+    traces the with block as a span of the current trace. Does nothing if no trace is active
+    """
+    trace = _currentTrace.get()
+    if trace == None or len(trace.spans) >= TRACE_MAX_SPANS:
+        yield
+        return
+
+    start = time.perf_counter()
+    record = [name, _currentSpan.get(), start - trace.startCounter, 0.0, attributes]
+    trace.spans.append(record)
+    token = _currentSpan.set(len(trace.spans) - 1)
+    try:
+        yield
+    finally:
+        _currentSpan.reset(token)
+        record[3] = time.perf_counter() - start
+
+def setAttribute(key: str, value: Any) -> None:
+    """
+    sets attribute of the current trace, if there is one
+    """
+    trace = _currentTrace.get()
+    if trace != None:
+        trace.attributes[key] = value
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+    """
+    decorator tracing every call of the function (or coroutine function) as a span
+    """
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def asyncWrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return asyncWrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def tracedMethods(prefix: str) -> Callable[[type], type]:
+    """
+    class decorator tracing all methods of the class (except dunder ones) as spans named prefix.method
+    """
+    def decorator(cls: type) -> type:
+        for name, method in list(vars(cls).items()):
+            if name.startswith("__") or not inspect.isfunction(method):
+                continue
+            setattr(cls, name, traced(f"{prefix}.{name}")(method))
+        return cls
+    return decorator
+
+
+"""
+EXPORT
+"""
+
+class EntryFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(getattr(record, "entry", {"message": record.getMessage()}), separators=(",", ":"))
+
+def setup(path: str = TRACES_FILE) -> None:
+    """
+    Exports traces into path through the background log writer. asyncLogging.setup has to be called first.
+    """
+    target = asyncLogging.RotatingBatchFileHandler(path)
+    target.setFormatter(EntryFormatter())
+    _tracesLogger.propagate = False
+    asyncLogging.attach(_tracesLogger, target)
+
+def slowestTraces(count: int, path: str = TRACES_FILE, maxBytes: int = 1024 * 1024) -> list[dict[str, Any]]:
+    """
+    returns count slowest traces among the recent ones (in last maxBytes of the export file)
+    """
+    try:
+        with open(path, "rb") as file:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            file.seek(max(0, size - maxBytes))
+            data = file.read()
+    except FileNotFoundError:
+        return []
+
+    lines = data.split(b"\n")
+    if size > maxBytes:
+        # first line is most likely cut
+        lines = lines[1:]
+    traces = []
+    for line in lines:
+        try:
+            traces.append(json.loads(line))
+        except ValueError:
+            continue
+    return sorted(traces, key=lambda trace: trace["duration"], reverse=True)[:count]
+
+def formatTrace(trace: dict[str, Any], maxSpans: int = 8) -> str:
+    """
+    returns short text description of an exported trace with its slowest spans
+    """
+    attributes = " ".join(f"{key}={value}" for key, value in trace["attributes"].items())
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace["time"]))
+    lines = [f"**{trace['duration'] * 1000:.1f} ms** {trace['name']} {attributes} ({started})"]
+    depths: list[int] = []
+    for spanData in trace["spans"]:
+        depths.append(depths[spanData["parent"]] + 1 if spanData["parent"] >= 0 else 1)
+
+    slowest = sorted(range(len(trace["spans"])), key=lambda i: trace["spans"][i]["duration"], reverse=True)[:maxSpans]
+    for i in sorted(slowest):
+        spanData = trace["spans"][i]
+        lines.append(f"{'  ' * depths[i]}+{spanData['start'] * 1000:.1f} ms {spanData['name']}: {spanData['duration'] * 1000:.1f} ms")
+    return "\n".join(lines)
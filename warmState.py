@@ -0,0 +1,127 @@
+from __future__ import annotations
+from typing import Optional, Any
+import json
+import logging
+import os
+import time
+
+from db import Database
+
+import challenge as challengeModule
+import player as playerModule
+import messenger as messengerModule
+
+
+class WarmState:
+    """
+    Compact snapshot of bot's in-memory indexes, so restarts don't have to start cold.
+
+    Snapshot holds all open challenges (and with them listing message IDs and pending timeouts) and known names and teams of players.
+    Each tenant has its own snapshot, which is captured and restored while the tenant is active.
+    It is only valid while database's change counter matches the one it was taken at.
+
+    Should be created using following factory methods:
+    - capture
+    - load
+    """
+    # 2 added private flag to challenges, older snapshots would list private challenges
+    VERSION = 2
+
+    def __init__(self, changeCounter: int, savedAt: int, challenges: list[list[Any]], names: dict[int, str], teams: dict[int, int]):
+        self.changeCounter = changeCounter
+        self.savedAt = savedAt
+        self.challenges = challenges
+        self.names = names
+        self.teams = teams
+
+
+    """
+    FACTORY METHODS
+    """
+
+    @classmethod
+    def capture(cls, messenger: messengerModule.Messenger, db: Database) -> WarmState:
+        """
+        Takes snapshot of current in-memory state.
+        """
+        return cls(
+            changeCounter=db.getChangeCounter(),
+            savedAt=int(time.time()),
+            challenges=[challenge.toRow() for challenge in messenger.openChallenges.values()],
+            names=dict(playerModule.Player.knownNames),
+            teams=dict(playerModule.Player.knownTeams.get(playerModule.Player.getGuild().id, {}))
+        )
+
+    @classmethod
+    def load(cls, path: str, db: Database) -> Optional[WarmState]:
+        """
+        Loads snapshot from given file.
+
+        Returns:
+            the snapshot, or None if it doesn't exist, is corrupted or is stale
+
+        Raises:
+            Nothing
+        """
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+
+            if data["version"] != cls.VERSION:
+                logging.info(f"snapshot {path} has unsupported version {data['version']}")
+                return None
+
+            state = cls(
+                changeCounter=int(data["changeCounter"]),
+                savedAt=int(data["savedAt"]),
+                challenges=data["challenges"],
+                # json keys are always strings
+                names={int(key): value for key, value in data["names"].items()},
+                teams={int(key): int(value) for key, value in data["teams"].items()}
+            )
+        except FileNotFoundError:
+            logging.info(f"no snapshot found at {path}")
+            return None
+        except Exception as e:
+            logging.warning(f"Error loading snapshot {path}")
+            logging.warning(str(e))
+            return None
+
+        if state.changeCounter != db.getChangeCounter():
+            logging.info(f"snapshot {path} is stale (taken at change {state.changeCounter}, database is at {db.getChangeCounter()})")
+            return None
+
+        return state
+
+
+    """
+    STORY METHODS
+    """
+
+    def save(self, path: str) -> None:
+        """
+        Writes the snapshot into given file. The file is replaced atomically, so a crash never leaves half written snapshot behind.
+        """
+        data = {
+            "version": self.VERSION,
+            "changeCounter": self.changeCounter,
+            "savedAt": self.savedAt,
+            "challenges": self.challenges,
+            "names": self.names,
+            "teams": self.teams,
+        }
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "w", encoding="utf-8") as file:
+            json.dump(data, file, separators=(",", ":"))
+        os.replace(tmpPath, path)
+        logging.info(f"saved snapshot with {len(self.challenges)} open challenges at change {self.changeCounter}")
+
+    def restore(self, messenger: messengerModule.Messenger) -> None:
+        """
+        Fills in-memory indexes from the snapshot.
+        """
+        for row in self.challenges:
+            messenger._rememberChallenge(challengeModule.Challenge(*row))
+        playerModule.Player.knownNames.update(self.names)
+        playerModule.Player.knownTeams.setdefault(playerModule.Player.getGuild().id, {}).update(self.teams)
+        logging.info(f"restored {len(self.challenges)} open challenges from snapshot")
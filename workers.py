@@ -0,0 +1,471 @@
+from __future__ import annotations
+from typing import Optional, Any, Iterator, cast
+from contextvars import ContextVar
+import asyncio
+import functools
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
+
+import discord
+
+from commandDecorators import isReadOnly, plainValues
+
+import challenge as challengeModule
+import tenant as tenantModule
+from playerIndex import PlayerIndex
+from memberCache import MemberCache
+import asyncLogging
+import metrics
+import tracing
+
+
+"""
+Commands can be run by a pool of worker processes instead of the gateway process.
+
+The gateway resolves the author, forwards a normalized request over a multiprocessing queue and waits for it to finish.
+Workers run CommandEvaluator against their own database connection. Every reply and Messenger call they make is
+sent back to the gateway as a call, which the gateway executes and answers before the worker continues,
+so side effects of one request happen in order.
+
+Worker 0 is the only process writing into the database. It runs all commands which aren't read only (and timeouts),
+one at a time, which also keeps all changes of a challenge ordered. Other workers open the database read only and
+run read only commands, picked by author so the requests of one user stay ordered.
+"""
+
+# (id, name, display name, role ids) of a guild member
+MemberData = tuple[int, str, str, list[int]]
+
+def memberData(member: discord.Member) -> MemberData:
+    return (member.id, member.name, member.display_name, [role.id for role in member.roles])
+
+def guildData(guild: discord.Guild) -> tuple[int, str, list[tuple[int, str]], list[MemberData]]:
+    return (guild.id, guild.name, [(role.id, role.name) for role in guild.roles], [memberData(member) for member in guild.members])
+
+
+"""
+WORKER SIDE
+"""
+
+# request the worker is currently handling
+_currentRequest: ContextVar[int] = ContextVar("currentRequest", default=-1)
+
+
+class WorkerRole:
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+
+
+class WorkerMember:
+    """
+    Copy of a guild member sent from the gateway. Sending it DMs is forwarded to the gateway.
+    """
+    def __init__(self, worker: Worker, guild: WorkerGuild, data: MemberData):
+        self.worker = worker
+        self.id, self.name, self.display_name, roleIds = data
+        self.roles = [guild.roles[roleId] for roleId in roleIds if roleId in guild.roles]
+
+    async def send(self, content: Optional[str] = None, file: Optional[discord.File] = None) -> None:
+        path = getattr(file.fp, "name", None) if file != None else None
+        await self.worker.call("send", self.id, content, path)
+
+
+class WorkerGuild:
+    """
+    Copy of a guild with its members and roles kept up to date by the gateway.
+    """
+    def __init__(self, worker: Worker, data: tuple[int, str, list[tuple[int, str]], list[MemberData]]):
+        self.worker = worker
+        self.id, self.name, roles, members = data
+        self.roles = {roleId: WorkerRole(roleId, name) for roleId, name in roles}
+        self.members: dict[int, WorkerMember] = {}
+        for member in members:
+            self.updateMember(member)
+
+    def updateMember(self, data: MemberData) -> None:
+        self.members[data[0]] = WorkerMember(self.worker, self, data)
+
+    def get_member(self, id: int) -> Optional[WorkerMember]:
+        return self.members.get(id)
+
+    async def fetch_member(self, id: int) -> WorkerMember:
+        member = self.members.get(id)
+        if member == None:
+            raise ValueError("You are not a member of our guild!")
+        return cast(WorkerMember, member)
+
+    def get_member_named(self, name: str) -> Optional[WorkerMember]:
+        for member in self.members.values():
+            if member.name == name:
+                return member
+        return None
+
+    def get_role(self, id: int) -> Optional[WorkerRole]:
+        return self.roles.get(id)
+
+
+class RemoteMessenger:
+    """
+    Stands in for Messenger in a worker. Every method call is executed by the real Messenger in the gateway.
+    """
+    def __init__(self, worker: Worker):
+        self.worker = worker
+
+    def __getattr__(self, name: str):
+        async def remoteCall(*args, **kwargs) -> Any:
+            return await self.worker.call("messenger", name, args, kwargs)
+        return remoteCall
+
+    async def createChallengeEntry(self, challenge: challengeModule.Challenge) -> None:
+        # finishing the challenge writes into the database, so it has to happen here
+        messageId = await self.worker.call("messenger", "postChallengeListing", (challenge,), {})
+        challenge.finishCreating(messageId)
+        await self.worker.call("messenger", "challengeCreated", (challenge,), {})
+
+    async def flushLogs(self) -> None:
+        # records of this worker are written by the gateway
+        await self.worker.call("flush")
+
+
+class Worker:
+    """
+    Process running commands sent by the gateway.
+    """
+    def __init__(self, index: int, configs: list[dict[str, Any]], guilds: list[Any], inQueue: Any, outQueue: Any):
+        import commandEvaluator
+
+        self.index = index
+        self.inQueue = inQueue
+        self.outQueue = outQueue
+        self.calls: dict[int, asyncio.Future] = {}
+        self.callIds = itertools.count()
+        self.requests: asyncio.Queue = asyncio.Queue()
+        self.guilds: dict[int, WorkerGuild] = {}
+
+        for config, data in zip(configs, guilds):
+            guild = WorkerGuild(self, data)
+            self.guilds[guild.id] = guild
+            tenant = tenantModule.Tenant.create(tenantModule.GuildConfig(**config), cast(discord.Guild, guild), readOnly=(index != 0))
+            tenant.messenger = RemoteMessenger(self)
+            # first column of players is their ID
+            tenant.players = PlayerIndex.build([row[0] for row in tenant.db.getAllPlayers()], tenant.guild)
+            tenant.members = MemberCache(tenant.guild)
+            tenant.commandEvaluator = commandEvaluator.CommandEvaluator(tenant.messenger, cast(Any, None), tenant.guild, tenant.players, tenant.members)
+            tenantModule.register(tenant)
+
+    async def run(self) -> None:
+        asyncio.create_task(self.handleRequests())
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, self.inQueue.get)
+            match message[0]:
+                case "request":
+                    self.requests.put_nowait(message[1:])
+                case "result":
+                    _, callId, value, error = message
+                    future = self.calls.pop(callId)
+                    if error != None:
+                        future.set_exception(ValueError(error))
+                    else:
+                        future.set_result(value)
+                case "member":
+                    _, guildId, data = message
+                    self.guilds[guildId].updateMember(data)
+                    cast(tenantModule.Tenant, tenantModule.getByGuildId(guildId)).players.updateMember(data[0], data[1], data[2])
+                case "stop":
+                    return
+
+    async def handleRequests(self) -> None:
+        # requests are handled one at a time, so their effects are ordered
+        while True:
+            requestId, guildId, kind, payload = await self.requests.get()
+            _currentRequest.set(requestId)
+            tenant = cast(tenantModule.Tenant, tenantModule.getByGuildId(guildId))
+            success = False
+            try:
+                with tenantModule.activate(tenant):
+                    success = await self.handleRequest(tenant, kind, payload)
+            except Exception as e:
+                logging.error(f"worker {self.index} failed handling request {requestId}")
+                logging.error(str(e))
+            # metrics are served by the gateway
+            changes = metrics.takeChanges()
+            if len(changes) > 0:
+                self.outQueue.put(("metrics", changes))
+            self.outQueue.put(("done", requestId, success))
+
+    async def handleRequest(self, tenant: tenantModule.Tenant, kind: str, payload: Any) -> bool:
+        if kind == "command":
+            command, author, source = payload
+            guild = self.guilds[tenant.config.guildId]
+            if author != None:
+                guild.updateMember(author)
+            return await tenant.commandEvaluator.parseCommand(command, guild.get_member(author[0]) if author != None else None, reply=self.reply, source=source)
+
+        if kind == "structured":
+            commandName, values, author, source = payload
+            guild = self.guilds[tenant.config.guildId]
+            if author != None:
+                guild.updateMember(author)
+            return await tenant.commandEvaluator.runCommand(commandName, values, guild.get_member(author[0]) if author != None else None, reply=self.reply, source=source)
+
+        if kind == "teams":
+            tenant.db.setPlayerTeams(payload)
+            return True
+
+        if kind == "meta":
+            key, value = payload
+            tenant.db.setMetaValue(key, value)
+            return True
+
+        if kind == "timeouts":
+            challenges = challengeModule.Challenge.abortAllTimeouts()
+            if len(challenges) > 0:
+                logging.info(f"{len(challenges)} challanges of guild {tenant.config.guildId} aborted due to timeout")
+                await tenant.messenger.abortChallengesDueTimeout(challenges)
+            return True
+
+        raise ValueError(f"unknown request kind {kind}")
+
+    async def reply(self, message: str) -> None:
+        await self.call("reply", message)
+
+    async def call(self, target: str, *args: Any) -> Any:
+        """
+        Asks the gateway to do something on behalf of current request and waits for the result.
+        """
+        callId = next(self.callIds)
+        future = asyncio.get_running_loop().create_future()
+        self.calls[callId] = future
+        with tracing.span(f"gateway.{target}.{args[0]}" if target == "messenger" else f"gateway.{target}"):
+            self.outQueue.put(("call", self.index, _currentRequest.get(), callId, target, args))
+            return await future
+
+
+class ForwardingLogHandler(logging.handlers.QueueHandler):
+    """
+    Sends log records to the gateway, which writes them into its (rotated) log files.
+    """
+    def __init__(self, index: int, outQueue: Any):
+        super().__init__(outQueue)
+        self.index = index
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        # structured records (command log, traces) are written as they are
+        if not hasattr(record, "entry"):
+            record.msg = f"worker {self.index}:{record.msg}"
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.queue.put(("log", record))
+
+
+def workerMain(index: int, configs: list[dict[str, Any]], guilds: list[Any], inQueue: Any, outQueue: Any) -> None:
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(ForwardingLogHandler(index, outQueue))
+
+    async def main() -> None:
+        await Worker(index, configs, guilds, inQueue, outQueue).run()
+    asyncio.run(main())
+
+
+"""
+GATEWAY SIDE
+"""
+
+class RemoteCommandEvaluator:
+    """
+    Stands in for CommandEvaluator of a tenant in the gateway, forwarding commands to the worker pool.
+    """
+    def __init__(self, pool: WorkerPool, tenant: tenantModule.Tenant):
+        self.pool = pool
+        self.tenant = tenant
+
+    async def parseCommand(self, message: str, rawAuthor: discord.User | discord.Member | None, reply: Any = None, source = None) -> bool:
+        """
+        parse a command (in a worker) and return if the command is valid
+        """
+        author = await self.resolveAuthor(rawAuthor)
+        commandName = message.strip().lstrip("/").split(" ")[0].lower()
+        return await self.pool.submit(self.workerFor(commandName, author), self.tenant, "command", (message, memberData(author) if author != None else None, source), reply)
+
+    async def runCommand(self, commandName: str, values: dict[str, Any], rawAuthor: discord.User | discord.Member | None, reply: Any = None, source = None) -> bool:
+        """
+        run a command with typed arguments by name (in a worker) and return if the command is valid
+        """
+        author = await self.resolveAuthor(rawAuthor)
+        # discord objects can't cross processes, argument types resolve their IDs again in the worker
+        payload = (commandName.lower(), plainValues(values), memberData(author) if author != None else None, source)
+        return await self.pool.submit(self.workerFor(commandName.lower(), author), self.tenant, "structured", payload, reply)
+
+    async def resolveAuthor(self, rawAuthor: discord.User | discord.Member | None) -> Optional[discord.Member]:
+        if rawAuthor == None:
+            return None
+        return await self.tenant.members.fetch(rawAuthor.id)
+
+    def workerFor(self, commandName: str, author: Optional[discord.Member]) -> int:
+        if isReadOnly(commandName) and author != None:
+            return self.pool.readerFor(author.id)
+        return 0
+
+
+class PendingRequest:
+    def __init__(self, tenant: tenantModule.Tenant, reply: Any):
+        self.tenant = tenant
+        self.reply = reply
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class WorkerPool:
+    """
+    Worker processes running commands for all tenants.
+
+    Should be created with start factory method.
+    """
+    bot: discord.Bot
+    processes: list[Any]
+    inQueues: list[Any]
+    outQueue: Any
+    requestIds: Iterator[int]
+    pending: dict[int, PendingRequest]
+
+    @staticmethod
+    def start(count: int, bot: discord.Bot) -> WorkerPool:
+        """
+        Starts [count] workers serving all currently registered tenants and replaces their command evaluators with forwarders.
+        """
+        # registers all commands, so we know which are read only
+        import commandEvaluator
+
+        pool = WorkerPool()
+        pool.bot = bot
+        pool.requestIds = itertools.count()
+        pool.pending = {}
+
+        context = multiprocessing.get_context("spawn")
+        pool.outQueue = context.Queue()
+        pool.inQueues = [context.Queue() for _ in range(count)]
+
+        tenants = tenantModule.getAll()
+        configs = [vars(tenant.config) for tenant in tenants]
+        guilds = [guildData(tenant.guild) for tenant in tenants]
+        pool.processes = [context.Process(target=workerMain, args=(i, configs, guilds, pool.inQueues[i], pool.outQueue), daemon=True) for i in range(count)]
+        for process in pool.processes:
+            process.start()
+
+        pool.attach(tenants)
+
+        asyncio.create_task(pool.pump())
+        logging.info(f"started {count} workers")
+        return pool
+
+    def attach(self, tenants: list[tenantModule.Tenant]) -> None:
+        """
+        replaces command evaluators of given tenants (e.g. added after a reconnect) with forwarders to this pool
+        """
+        for tenant in tenants:
+            tenant.commandEvaluator = RemoteCommandEvaluator(self, tenant)
+
+    async def stop(self) -> None:
+        for inQueue in self.inQueues:
+            inQueue.put(("stop",))
+        # joining blocks, so it's done in threads while the event loop keeps running
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, functools.partial(process.join, timeout=5)) for process in self.processes])
+        # wakes up the pump, so it can finish
+        self.outQueue.put(("stop",))
+
+    def readerFor(self, userId: int) -> int:
+        """
+        returns index of worker which should run read only commands of given user
+        """
+        if len(self.processes) == 1:
+            return 0
+        return 1 + userId % (len(self.processes) - 1)
+
+    def memberChanged(self, tenant: tenantModule.Tenant, member: discord.Member) -> None:
+        for inQueue in self.inQueues:
+            inQueue.put(("member", tenant.config.guildId, memberData(member)))
+
+    async def checkTimeouts(self, tenant: tenantModule.Tenant) -> None:
+        await self.submit(0, tenant, "timeouts", None, None)
+
+    async def setTeams(self, tenant: tenantModule.Tenant, teams: list[tuple[int, Optional[int]]]) -> None:
+        await self.submit(0, tenant, "teams", teams, None)
+
+    async def setMetaValue(self, tenant: tenantModule.Tenant, key: str, value: Optional[int]) -> None:
+        await self.submit(0, tenant, "meta", (key, value), None)
+
+    async def submit(self, worker: int, tenant: tenantModule.Tenant, kind: str, payload: Any, reply: Any) -> bool:
+        """
+        Sends request to given worker and waits until it's handled. Returns if it was successful.
+        """
+        requestId = next(self.requestIds)
+        request = PendingRequest(tenant, reply)
+        self.pending[requestId] = request
+        self.inQueues[worker].put(("request", requestId, tenant.config.guildId, kind, payload))
+        try:
+            return await request.done
+        finally:
+            self.pending.pop(requestId, None)
+
+    async def pump(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, self.outQueue.get)
+            match message[0]:
+                case "done":
+                    _, requestId, success = message
+                    if requestId in self.pending:
+                        self.pending[requestId].done.set_result(success)
+                case "log":
+                    record = message[1]
+                    logging.getLogger(record.name).handle(record)
+                case "metrics":
+                    metrics.merge(message[1])
+                case "call":
+                    # worker waits for the result, so calls of one request never overlap
+                    asyncio.create_task(self.handleCall(*message[1:]))
+                case "stop":
+                    return
+
+    async def handleCall(self, worker: int, requestId: int, callId: int, target: str, args: tuple) -> None:
+        value = None
+        error = None
+        request = self.pending.get(requestId)
+        try:
+            if target == "reply":
+                if request != None and request.reply != None:
+                    await request.reply(*args)
+
+            elif target == "send":
+                userId, content, path = args
+                if path != None:
+                    # the file may be a log with records of the worker still waiting to be written
+                    await asyncio.get_running_loop().run_in_executor(None, asyncLogging.flushAll)
+                user = await self.bot.fetch_user(userId)
+                await user.send(content, file=discord.File(path) if path != None else None)
+
+            elif target == "flush":
+                # records the worker logged before this call are already handed to the writer
+                await asyncio.get_running_loop().run_in_executor(None, asyncLogging.flushAll)
+
+            elif target == "messenger":
+                name, methodArgs, methodKwargs = args
+                if request == None:
+                    raise ValueError(f"request {requestId} is no longer pending")
+                with tenantModule.activate(request.tenant):
+                    value = getattr(request.tenant.messenger, name)(*methodArgs, **methodKwargs)
+                    if asyncio.iscoroutine(value):
+                        value = await value
+
+        except Exception as e:
+            logging.error(f"Error handling call {target} of worker {worker}")
+            logging.error(str(e))
+            error = str(e)
+
+        self.inQueues[worker].put(("result", callId, value, error))